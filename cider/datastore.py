@@ -3,9 +3,16 @@ from box import Box
 from geopandas import GeoDataFrame  # type: ignore[import]
 from enum import Enum
 import inspect
-from helpers.io_utils import load_antennas, load_shapefile, load_cdr, load_mobilemoney, load_mobiledata, load_recharges
-from helpers.opt_utils import generate_user_consent_list
-from helpers.utils import get_project_root, get_spark_session, filter_dates_dataframe, make_dir, save_df
+import json
+from helpers.cache_utils import files_fingerprint, fingerprint, is_cached, stage_fingerprint, write_fingerprint
+from helpers.io_utils import load_antennas, load_derived, load_generic, load_ingested, load_shapefile, load_cdr, \
+    load_mobilemoney, load_mobiledata, load_recharges, source_fingerprint
+from helpers.schema_utils import enforce_schema, read_schema
+from helpers.store_utils import load_feature_block, read_manifest
+from helpers.opt_utils import apply_consent_changes, generate_user_consent_list
+from helpers.profile_utils import profile_dataset
+from helpers.utils import get_project_root, get_spark_session, filter_dates_dataframe, make_dir, remove_ids, \
+    save_df, to_pandas
 import numpy as np
 import os
 import pandas as pd
@@ -13,7 +20,8 @@ from pandas import DataFrame as PandasDataFrame, Series
 from pyspark.sql import DataFrame as SparkDataFrame
 import pyspark.sql.functions as F
 from pyspark.sql.functions import col, count, countDistinct, lit
-from typing import Callable, Dict, List, Mapping, Optional, Set, Union
+from pyspark.sql.types import BooleanType, StringType, StructField, StructType
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set, Tuple, Union
 import yaml
 
 
@@ -36,7 +44,8 @@ class DataType(Enum):
 
 class InitializerInterface(ABC):
     @abstractmethod
-    def load_data(self, data_type_map: Dict[DataType, Optional[Union[SparkDataFrame, PandasDataFrame]]]) -> None:
+    def load_data(self, data_type_map: Dict[DataType, Optional[Union[SparkDataFrame, PandasDataFrame]]],
+                  lazy: bool = False) -> None:
         pass
 
 
@@ -62,16 +71,20 @@ class DataStore(InitializerInterface):
         # Create directories
         make_dir(self.outputs + '/datasets/')
 
+        # Raw datasets are converted once to typed parquet, and re-used on later runs, if the ingest cache is enabled
+        self.ingest_cache = 'ingest' in cfg and cfg.ingest.cache
+        if self.ingest_cache:
+            make_dir(self.outputs + '/ingest/')
+
         # Parameters
         self.filter_hours = self.cfg.params.home_location.filter_hours
         self.geo = self.cfg.col_names.geo
 
-        # Spark setup
+        # Spark setup: without spark, datasets are loaded and cleaned in memory with pandas, which is enough for
+        # datasets that fit on a single machine
         # TODO(lucio): Initialize spark separately ....
-        spark = None
-        if spark:
-            spark = get_spark_session(cfg)
-        self.spark = spark
+        self.backend = 'spark' if spark else 'pandas'
+        self.spark = get_spark_session(cfg) if spark else None
 
         # Possible datasets to opt in/out of
         self.datasets = ['cdr', 'cdr_bandicoot', 'recharges', 'mobiledata', 'mobilemoney', 'features']
@@ -99,6 +112,15 @@ class DataStore(InitializerInterface):
         self.rwi: PandasDataFrame
         # survey
         self.survey_data: PandasDataFrame
+        # validation reports of raw datasets, filled when loading them
+        self.validation_reports: Dict[str, Dict[str, Any]] = {}
+        # days present in the ingest cache of raw datasets, and those added by the last load - {'cdr': {'days': {...},
+        # 'new_days': [...]}, ...}
+        self.ingest_info: Dict[str, Dict[str, Any]] = {}
+        # profiles of transaction datasets, with the version of the dataset they were computed on
+        self.profiles: Dict[str, Tuple[Union[SparkDataFrame, PandasDataFrame], Dict[str, Any]]] = {}
+        # fingerprints of the content of datasets loaded from disk, with the version of the dataset they describe
+        self.fingerprints: Dict[str, Tuple[Any, Optional[str]]] = {}
 
         # Define mapping between data types and loading methods
         self.data_type_to_fn_map: Dict[DataType, Callable] = {DataType.CDR: self._load_cdr,
@@ -115,6 +137,102 @@ class DataStore(InitializerInterface):
                                                               DataType.FAIRNESS: self._load_fairness,
                                                               DataType.RWI: self._load_wealth_map,
                                                               DataType.SURVEY_DATA: self._load_survey}
+        # Attributes set by loading methods besides the one named after the data type
+        self.derived_attributes: Dict[DataType, List[str]] = {
+            DataType.TARGETING: ['unweighted_targeting', 'weighted_targeting'],
+            DataType.FAIRNESS: ['unweighted_fairness', 'weighted_fairness']}
+        # Datasets registered for lazy loading, which have not been accessed yet
+        self._pending: Dict[str, Tuple[DataType, Optional[Union[SparkDataFrame, PandasDataFrame]]]] = {}
+
+    def _load_raw(self,
+                  name: str,
+                  loader: Callable[..., SparkDataFrame],
+                  fpath: Optional[str],
+                  dataframe: Optional[Union[SparkDataFrame, PandasDataFrame]],
+                  validate: bool = False,
+                  partition_by: Optional[List[str]] = None) -> Union[SparkDataFrame, PandasDataFrame]:
+        """
+        Load raw dataset with its loader, going through the parquet ingest cache when reading from disk with spark
+
+        Args:
+            name: name of the dataset, used to name the cache folder and the validation report
+            loader: io_utils loading function
+            fpath: path to file or folder with files
+            dataframe: spark/pandas df to assign if available
+            validate: whether the loader produces a validation report, stored in self.validation_reports
+            partition_by: columns by which to partition the cached parquet dataset
+
+        Returns: spark or pandas df, depending on the backend
+        """
+        use_cache = self.ingest_cache and self.backend == 'spark' and dataframe is None and fpath is not None
+        report: Optional[Dict[str, Any]] = {} if validate else None
+        if use_cache:
+            info: Dict[str, Any] = {}
+            df = load_ingested(self.cfg, loader, fpath, self.outputs + '/ingest/' + name, report=report,
+                               partition_by=partition_by, info=info, dataset=name)
+            if info:
+                self.ingest_info[name] = info
+        elif validate:
+            df = loader(self.cfg, fpath, df=dataframe, report=report, backend=self.backend)
+        else:
+            df = loader(self.cfg, fpath, df=dataframe, backend=self.backend)
+        if report is not None:
+            self.validation_reports[name] = report
+        # Datasets provided as dfs have unknown content, so that outputs computed from them are never cached
+        raw_fingerprint = None
+        if dataframe is None and fpath is not None:
+            col_names = self.cfg.col_names[name] if name in self.cfg.col_names else None
+            raw_fingerprint = fingerprint(name, source_fingerprint(fpath), col_names)
+        self.fingerprints[name] = (df, raw_fingerprint)
+        return df
+
+    def fingerprint(self, name: str) -> Optional[str]:
+        """
+        Fingerprint of the current content of a dataset: its raw files and the cleaning steps applied to it since
+
+        Args:
+            name: name of the dataset, e.g. 'cdr'
+
+        Returns: fingerprint, or None if unknown, e.g. if the dataset was provided as a df or modified outside of the
+            datastore
+        """
+        df = getattr(self, name, None)
+        if df is None or name not in self.fingerprints or self.fingerprints[name][0] is not df:
+            return None
+        return self.fingerprints[name][1]
+
+    def _set_dataset(self, name: str, df: Union[SparkDataFrame, PandasDataFrame], *step: Any) -> None:
+        """
+        Replace a dataset by a transformed version, deriving its fingerprint from the previous one and the step applied
+
+        Args:
+            name: name of the dataset, e.g. 'cdr'
+            df: transformed dataset
+            step: name and parameters of the step; the fingerprint is unknown if any of them is None
+        """
+        previous = self.fingerprint(name)
+        setattr(self, name, df)
+        known = previous is not None and all(p is not None for p in step)
+        self.fingerprints[name] = (df, fingerprint(previous, *step) if known else None)
+
+    def new_data(self, name: str) -> Union[SparkDataFrame, PandasDataFrame]:
+        """
+        Restrict a dataset to the days added or extended by the last load from the ingest cache, so that stages whose
+        outputs are computed by day can only process the new data; without ingest information, the whole dataset is
+        returned
+
+        Args:
+            name: name of the dataset, e.g. 'cdr'
+
+        Returns: spark or pandas df, depending on the backend
+        """
+        df = getattr(self, name)
+        if name not in self.ingest_info:
+            return df
+        new_days = list(pd.to_datetime(self.ingest_info[name]['new_days']))
+        if self.backend == 'pandas':
+            return df[df['day'].isin(new_days)]
+        return df.where(col('day').isin(new_days))
 
     def _load_cdr(self, dataframe: Optional[Union[SparkDataFrame, PandasDataFrame]] = None) -> None:
         """
@@ -126,7 +244,7 @@ class DataStore(InitializerInterface):
         fpath = os.path.join(self.data, self.file_names.cdr) if self.file_names.cdr is not None else None
         if fpath or dataframe is not None:
             print('Loading CDR...')
-            cdr = load_cdr(self.cfg, fpath, df=dataframe)
+            cdr = self._load_raw('cdr', load_cdr, fpath, dataframe, validate=True, partition_by=['day'])
             self.cdr = cdr
 
     def _load_antennas(self, dataframe: Optional[Union[SparkDataFrame, PandasDataFrame]] = None) -> None:
@@ -139,7 +257,10 @@ class DataStore(InitializerInterface):
         fpath = os.path.join(self.data, self.file_names.antennas) if self.file_names.antennas is not None else None
         if fpath or dataframe is not None:
             print('Loading antennas...')
-            self.antennas = load_antennas(self.cfg, fpath, df=dataframe)
+            self.antennas = self._load_raw('antennas', load_antennas, fpath, dataframe, validate=True)
+            report = self.validation_reports['antennas']
+            if report:
+                print('Warning: %i antennas missing location' % report['invalid']['location'])
 
     def _load_recharges(self, dataframe: Optional[Union[SparkDataFrame, PandasDataFrame]] = None) -> None:
         """
@@ -151,7 +272,7 @@ class DataStore(InitializerInterface):
         fpath = os.path.join(self.data, self.file_names.recharges) if self.file_names.recharges is not None else None
         if fpath or dataframe is not None:
             print('Loading recharges...')
-            self.recharges = load_recharges(self.cfg, fpath, df=dataframe)
+            self.recharges = self._load_raw('recharges', load_recharges, fpath, dataframe, partition_by=['day'])
             print("SUCCESS!")
 
     def _load_mobiledata(self, dataframe: Optional[Union[SparkDataFrame, PandasDataFrame]] = None) -> None:
@@ -164,7 +285,7 @@ class DataStore(InitializerInterface):
         fpath = os.path.join(self.data, self.file_names.mobiledata) if self.file_names.mobiledata is not None else None
         if fpath or dataframe is not None:
             print('Loading mobile data...')
-            self.mobiledata = load_mobiledata(self.cfg, fpath, df=dataframe)
+            self.mobiledata = self._load_raw('mobiledata', load_mobiledata, fpath, dataframe, partition_by=['day'])
 
     def _load_mobilemoney(self, dataframe: Optional[Union[SparkDataFrame, PandasDataFrame]] = None) -> None:
         """
@@ -177,7 +298,8 @@ class DataStore(InitializerInterface):
                              self.file_names.mobilemoney) if self.file_names.mobilemoney is not None else None
         if fpath or dataframe is not None:
             print('Loading mobile data...')
-            self.mobilemoney = load_mobilemoney(self.cfg, fpath, df=dataframe)
+            self.mobilemoney = self._load_raw('mobilemoney', load_mobilemoney, fpath, dataframe, validate=True,
+                                            partition_by=['day'])
 
     def _load_shapefiles(self) -> None:
         """
@@ -185,8 +307,10 @@ class DataStore(InitializerInterface):
         """
         # Load shapefiles
         shapefiles = self.file_names.shapefiles
-        for shapefile_fname in shapefiles.keys():
-            self.shapefiles[shapefile_fname] = load_shapefile(self.data + shapefiles[shapefile_fname])
+        self.shapefiles = {shapefile_fname: load_shapefile(self.data + shapefiles[shapefile_fname])
+                           for shapefile_fname in shapefiles.keys()}
+        self.fingerprints['shapefiles'] = (self.shapefiles, fingerprint(
+            files_fingerprint([self.data + shapefiles[shapefile_fname] for shapefile_fname in sorted(shapefiles)])))
 
     def _load_home_ground_truth(self) -> None:
         """
@@ -212,7 +336,16 @@ class DataStore(InitializerInterface):
         """
         feat_path = self.cfg.path.features if '/' in self.cfg.path.features else \
             os.path.join(self.data, self.cfg.path.features)
-        self.features = self.spark.read.csv(feat_path, header=True)
+        # Use schema stored by the featurizer (in the feature store manifest or alongside a csv export) if available,
+        # otherwise parse all columns but 'name' as numeric
+        if self.backend == 'pandas':
+            self.features = enforce_schema(load_generic(self.cfg, feat_path, backend='pandas'), 'features')
+        elif read_manifest(feat_path) is not None:
+            self.features = load_feature_block(self.cfg, feat_path)
+        elif read_schema(feat_path) is not None:
+            self.features = load_derived(self.cfg, feat_path)
+        else:
+            self.features = load_generic(self.cfg, feat_path, dataset='features')
         if 'name' not in self.features.columns:
             raise ValueError('Features dataframe must include name column')
 
@@ -220,14 +353,22 @@ class DataStore(InitializerInterface):
         """
         Load labels to train ML model on
         """
-        self.labels = self.spark.read.csv(os.path.join(self.data, self.file_names.labels), header=True)
+        labels_path = os.path.join(self.data, self.file_names.labels)
+        if self.backend == 'pandas':
+            self.labels = enforce_schema(load_generic(self.cfg, labels_path, backend='pandas'), 'labels')
+        else:
+            self.labels = load_generic(self.cfg, labels_path, dataset='labels')
         if 'name' not in self.labels.columns:
             raise ValueError('Labels dataframe must include name column')
         if 'label' not in self.labels.columns:
             raise ValueError('Labels dataframe must include label column')
         if 'weight' not in self.labels.columns:
-            self.labels = self.labels.withColumn('weight', lit(1))
-        self.labels = self.labels.select(['name', 'label', 'weight'])
+            if self.backend == 'pandas':
+                self.labels['weight'] = 1.
+            else:
+                self.labels = self.labels.withColumn('weight', lit(1))
+        self.labels = self.labels[['name', 'label', 'weight']] if self.backend == 'pandas' else \
+            self.labels.select(['name', 'label', 'weight'])
 
     def _load_targeting(self) -> None:
         """
@@ -241,18 +382,13 @@ class DataStore(InitializerInterface):
         self.unweighted_targeting = self.targeting.copy()
         self.unweighted_targeting['weight'] = 1
 
-        # Weighted data
+        # Weighted data: weights are used directly by targeting and fairness metrics, rather than repeating records
         self.weighted_targeting = self.targeting.copy()
         if 'weight' not in self.weighted_targeting.columns:
             self.weighted_targeting['weight'] = 1
         else:
             self.weighted_targeting['weight'] = (self.weighted_targeting['weight'] /
                                                  self.weighted_targeting['weight'].min())
-        self.weighted_targeting = pd.DataFrame(np.repeat(self.weighted_targeting.values,
-                                                         self.weighted_targeting['weight'],
-                                                         axis=0),
-                                               columns=self.weighted_targeting.columns) \
-            .astype(self.unweighted_targeting.dtypes)
 
     def _load_fairness(self) -> None:
         """
@@ -266,18 +402,13 @@ class DataStore(InitializerInterface):
         self.unweighted_fairness = self.fairness.copy()
         self.unweighted_fairness['weight'] = 1
 
-        # Weighted data
+        # Weighted data: weights are used directly by targeting and fairness metrics, rather than repeating records
         self.weighted_fairness = self.fairness.copy()
         if 'weight' not in self.weighted_fairness.columns:
             self.weighted_fairness['weight'] = 1
         else:
             self.weighted_fairness['weight'] = (self.weighted_fairness['weight'] /
                                                 self.weighted_fairness['weight'].min())
-        self.weighted_fairness = pd.DataFrame(np.repeat(self.weighted_fairness.values,
-                                                        self.weighted_fairness['weight'],
-                                                        axis=0),
-                                              columns=self.weighted_fairness.columns) \
-            .astype(self.unweighted_fairness.dtypes)
 
     def _load_wealth_map(self) -> None:
         # Load wealth/income map
@@ -304,36 +435,68 @@ class DataStore(InitializerInterface):
         """
         if getattr(self, 'features', None) is None or getattr(self, 'labels', None) is None:
             raise ValueError("Features and/or labels have not been loaded!")
-        print('Number of observations with features: %i (%i unique)' %
-              (self.features.count(), self.features.select('name').distinct().count()))
-        print('Number of observations with labels: %i (%i unique)' %
-              (self.labels.count(), self.labels.select('name').distinct().count()))
 
-        merged = self.labels.join(self.features, on='name', how='inner')
-        print('Number of matched observations: %i (%i unique)' %
-              (merged.count(), merged.select('name').distinct().count()))
+        if self.backend == 'pandas':
+            self._merge_pandas()
+            return
+
+        # Compute all merge diagnostics in one job, from the number of records of each name in features and labels
+        counts = (self.features.groupby('name').agg(count(lit(1)).alias('n_features'))
+                  .join(self.labels.groupby('name').agg(count(lit(1)).alias('n_labels')), on='name', how='full_outer')
+                  .agg(F.sum('n_features'), count('n_features'),
+                       F.sum('n_labels'), count('n_labels'),
+                       F.sum(col('n_features') * col('n_labels')),
+                       count(F.when(col('n_features').isNotNull() & col('n_labels').isNotNull(), 1)))
+                  .collect()[0])
+        counts = [c if c is not None else 0 for c in counts]
+        print('Number of observations with features: %i (%i unique)' % (counts[0], counts[1]))
+        print('Number of observations with labels: %i (%i unique)' % (counts[2], counts[3]))
+        print('Number of matched observations: %i (%i unique)' % (counts[4], counts[5]))
+
+        # Convert to pandas directly, without writing to disk; labels and weights are numeric
+        merged = self.labels.withColumn('label', col('label').cast('double')) \
+            .withColumn('weight', col('weight').cast('double')) \
+            .join(self.features, on='name', how='inner')
+        self.merged = to_pandas(merged)
+        self.x = self.merged.drop(['name', 'label', 'weight'], axis=1)
+        self.y = self.merged['label']
+        # Make the smallest weight 1
+        self.weights = self.merged['weight'] / self.merged['weight'].min()
 
-        save_df(merged, self.outputs + '/merged.csv')
-        self.merged = pd.read_csv(self.outputs + '/merged.csv')
+    def _merge_pandas(self) -> None:
+        """
+        Merge features and labels held in memory with the pandas backend
+        """
+        features, labels = self.features, self.labels
+        print('Number of observations with features: %i (%i unique)' % (len(features), features['name'].nunique()))
+        print('Number of observations with labels: %i (%i unique)' % (len(labels), labels['name'].nunique()))
+        self.merged = labels.astype({'label': 'float64', 'weight': 'float64'}).merge(features, on='name', how='inner')
+        print('Number of matched observations: %i (%i unique)' % (len(self.merged), self.merged['name'].nunique()))
         self.x = self.merged.drop(['name', 'label', 'weight'], axis=1)
         self.y = self.merged['label']
         # Make the smallest weight 1
         self.weights = self.merged['weight'] / self.merged['weight'].min()
 
-    def load_data(self, data_type_map: Mapping[DataType, Optional[Union[SparkDataFrame, PandasDataFrame]]]) -> None:
+    def load_data(self, data_type_map: Mapping[DataType, Optional[Union[SparkDataFrame, PandasDataFrame]]],
+                  lazy: bool = False) -> None:
         """
         Load all datasets defined by data_type_map; raise an error if any of them failed to load
 
         Args:
             data_type_map: mapping between DataType(s) and dataframes, if provided. If None look at config file
+            lazy: if True, datasets are only registered, and loaded (and validated) the first time they are accessed
         """
+        if lazy:
+            for key, value in data_type_map.items():
+                for attribute in [key.name.lower()] + self.derived_attributes.get(key, []):
+                    # Drop previously loaded versions, so that the next access reloads the dataset
+                    self.__dict__.pop(attribute, None)
+                    self._pending[attribute] = (key, value)
+            return
+
         # Iterate through provided dtypes and load respective datasets
         for key, value in data_type_map.items():
-            fn = self.data_type_to_fn_map[key]
-            if 'dataframe' in inspect.getfullargspec(fn).args:
-                fn(dataframe=value)
-            else:
-                fn()
+            self._load_data_type(key, value)
 
         # Check if any datasets failed to load, raise an error if true
         failed_load = []
@@ -344,6 +507,35 @@ class DataStore(InitializerInterface):
         if failed_load:
             raise ValueError(f"The following datasets failed to load: {', '.join(failed_load)}")
 
+    def _load_data_type(self, key: DataType, value: Optional[Union[SparkDataFrame, PandasDataFrame]]) -> None:
+        """
+        Call the loading method of a data type, passing the dataframe provided if the method accepts one
+        """
+        for attribute in [key.name.lower()] + self.derived_attributes.get(key, []):
+            self._pending.pop(attribute, None)
+        fn = self.data_type_to_fn_map[key]
+        if 'dataframe' in inspect.getfullargspec(fn).args:
+            fn(dataframe=value)
+        else:
+            fn()
+
+    def __getattr__(self, name: str) -> Any:
+        """
+        Load datasets registered with load_data(..., lazy=True) the first time they are accessed; only called for
+        attributes that are not set. Datasets that are neither loaded nor registered are None
+        """
+        pending = self.__dict__.get('_pending', {})
+        if name in pending:
+            self._load_data_type(*pending[name])
+            if self.__dict__.get(name) is None:
+                raise ValueError(f"The following datasets failed to load: {name}")
+            return self.__dict__[name]
+        derived = [attribute for attributes in self.__dict__.get('derived_attributes', {}).values()
+                   for attribute in attributes]
+        if name in [data_type.name.lower() for data_type in DataType] + self.__dict__.get('datasets', []) + derived:
+            return None
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
     def filter_dates(self, start_date: str, end_date: str) -> None:
         """
         Filter data outside [start_date, end_date] (inclusive) in all available datasets
@@ -355,7 +547,8 @@ class DataStore(InitializerInterface):
         for dataset_name in self.datasets:
             dataset = getattr(self, dataset_name, None)
             if dataset is not None:
-                setattr(self, dataset_name, filter_dates_dataframe(dataset, start_date, end_date))
+                self._set_dataset(dataset_name, filter_dates_dataframe(dataset, start_date, end_date),
+                                  'filter_dates', str(start_date), str(end_date))
 
     def deduplicate(self) -> None:
         """
@@ -364,54 +557,152 @@ class DataStore(InitializerInterface):
         for dataset_name in self.datasets:
             dataset = getattr(self, dataset_name, None)
             if dataset is not None:
-                setattr(self, dataset_name, dataset.distinct())
+                if isinstance(dataset, PandasDataFrame):
+                    self._set_dataset(dataset_name, dataset.drop_duplicates(), 'deduplicate')
+                else:
+                    self._set_dataset(dataset_name, dataset.distinct(), 'deduplicate')
 
     # TODO: adapt for OptDataStore
-    def remove_spammers(self, spammer_threshold: float = 100) -> List[str]:
+    def remove_spammers(self, spammer_threshold: float = 100,
+                        broadcast_limit: int = 1000000,
+                        as_df: bool = False) -> Union[List[str], SparkDataFrame, PandasDataFrame]:
+        """
+        Identify spammers, i.e. subscribers with more than spammer_threshold calls or texts per active day, and remove
+        their transactions (incoming or outgoing) from all datasets
+
+        Args:
+            spammer_threshold: maximum average number of transactions per day of a regular subscriber
+            broadcast_limit: maximum number of spammers for which the list is broadcast to executors; above it
+                spammers are removed with shuffled anti-joins
+            as_df: return spammers as a df, which is not collected to the driver, rather than as a list of IDs
+
+        Returns: list of spammers' IDs, or if as_df spark (or pandas, with the pandas backend) df of spammers' IDs
+            ('caller_id')
+        """
         # Raise exception if no CDR, since spammers are calculated only on the basis of call and text
         if getattr(self, 'cdr', None) is None:
             raise ValueError('CDR must be loaded to identify and remove spammers.')
 
-        # Get average number of calls and SMS per day
-        grouped = (self.cdr
-                   .groupby('caller_id', 'txn_type')
-                   .agg(count(lit(0)).alias('n_transactions'),
-                        countDistinct(col('day')).alias('active_days'))
-                   .withColumn('count', col('n_transactions') / col('active_days')))
-
-        # Get list of spammers
-        self.spammers = grouped.where(col('count') > spammer_threshold).select('caller_id').distinct().rdd.map(
-            lambda r: r[0]).collect()
-        pd.DataFrame(self.spammers).to_csv(self.outputs + 'datasets/spammers.csv', index=False)
-        print('Number of spammers identified: %i' % len(self.spammers))
+        # Spammers identified on the same CDR with the same threshold are read back from disk
+        key = stage_fingerprint([self.fingerprint('cdr')], 'spammers', spammer_threshold)
+        fname = self.outputs + 'datasets/spammers.csv'
+        if self.backend == 'pandas':
+            spammers = self._remove_spammers_pandas(spammer_threshold, key)
+            return spammers if as_df else list(spammers['caller_id'])
+
+        if is_cached(fname, key):
+            self.spammers = load_derived(self.cfg, fname).cache()
+        else:
+            # Get average number of calls and SMS per day
+            grouped = (self.cdr
+                       .groupby('caller_id', 'txn_type')
+                       .agg(count(lit(0)).alias('n_transactions'),
+                            countDistinct(col('day')).alias('active_days'))
+                       .withColumn('count', col('n_transactions') / col('active_days')))
+
+            # Get spammers, kept distributed rather than collected to the driver
+            self.spammers = grouped.where(col('count') > spammer_threshold).select('caller_id').distinct().cache()
+            save_df(self.spammers, fname)
+            write_fingerprint(fname, key)
+        n_spammers = self.spammers.count()
+        print('Number of spammers identified: %i' % n_spammers)
 
         # Remove transactions (incoming or outgoing) associated with spammers from all dataframes
-        self.cdr = self.cdr.where(~col('caller_id').isin(self.spammers))
-        self.cdr = self.cdr.where(~col('recipient_id').isin(self.spammers))
-        if getattr(self, 'recharges', None) is not None:
-            self.recharges = self.recharges.where(~col('caller_id').isin(self.spammers))
-        if getattr(self, 'mobiledata', None) is not None:
-            self.mobiledata = self.mobiledata.where(~col('caller_id').isin(self.spammers))
-        if getattr(self, 'mobilemoney', None) is not None:
-            self.mobilemoney = self.mobilemoney.where(~col('caller_id').isin(self.spammers))
-            self.mobilemoney = self.mobilemoney.where(~col('recipient_id').isin(self.spammers))
+        broadcast_ids = n_spammers <= broadcast_limit
+        for df_name, colnames in [('cdr', ['caller_id', 'recipient_id']), ('recharges', ['caller_id']),
+                                  ('mobiledata', ['caller_id']), ('mobilemoney', ['caller_id', 'recipient_id'])]:
+            df = getattr(self, df_name, None)
+            if df is not None:
+                self._set_dataset(df_name, remove_ids(df, self.spammers, colnames, broadcast_ids),
+                                  'remove_spammers', key)
+
+        if as_df:
+            return self.spammers
+        return [row['caller_id'] for row in self.spammers.collect()]
+
+    def _remove_spammers_pandas(self, spammer_threshold: float, key: Optional[str]) -> PandasDataFrame:
+        """
+        Identify and remove spammers from datasets held in memory with the pandas backend
+        """
+        fname = self.outputs + 'datasets/spammers.csv'
+        if is_cached(fname, key):
+            self.spammers = pd.read_csv(fname, dtype=str)
+        else:
+            grouped = self.cdr.groupby(['caller_id', 'txn_type']).agg(n_transactions=('day', 'size'),
+                                                                       active_days=('day', 'nunique'))
+            grouped = grouped[grouped['n_transactions'] / grouped['active_days'] > spammer_threshold]
+            self.spammers = PandasDataFrame({'caller_id': grouped.index.get_level_values('caller_id').unique()})
+            self.spammers.to_csv(fname, index=False)
+            write_fingerprint(fname, key)
+        print('Number of spammers identified: %i' % len(self.spammers))
+
+        spammer_ids = set(self.spammers['caller_id'])
+        for df_name, colnames in [('cdr', ['caller_id', 'recipient_id']), ('recharges', ['caller_id']),
+                                  ('mobiledata', ['caller_id']), ('mobilemoney', ['caller_id', 'recipient_id'])]:
+            df = getattr(self, df_name, None)
+            if df is not None:
+                keep = ~np.logical_or.reduce([df[c].isin(spammer_ids) for c in colnames])
+                self._set_dataset(df_name, df[keep], 'remove_spammers', key)
 
         return self.spammers
 
+    def profile(self, name: str) -> Dict[str, Any]:
+        """
+        Profile a transaction dataset - summary statistics and daily timeseries - in a single pass; the profile is
+        reused until the dataset is modified, e.g. by a cleaning step, and stored on disk to be reused in later runs on
+        the same data
+
+        Args:
+            name: name of the dataset, e.g. 'cdr'
+
+        Returns: profile, see profile_dataset
+        """
+        df = getattr(self, name)
+        if name in self.profiles and self.profiles[name][0] is df:
+            return self.profiles[name][1]
+
+        key = stage_fingerprint([self.fingerprint(name)], 'profile')
+        fname = self.outputs + 'datasets/' + name + '_profile.json'
+        if is_cached(fname, key):
+            with open(fname, 'r') as f:
+                profile = json.load(f)
+            profile['daily'] = pd.DataFrame(profile['daily'],
+                                            columns=['txn_type', 'day', 'transactions', 'subscribers'])
+            profile['daily']['day'] = pd.to_datetime(profile['daily']['day'])
+        else:
+            profile = profile_dataset(df)
+            with open(fname, 'w') as f:
+                daily = profile['daily'].assign(day=profile['daily']['day'].dt.strftime('%Y-%m-%d'))
+                json.dump({'statistics': profile['statistics'], 'daily': daily.to_dict('records')}, f)
+            write_fingerprint(fname, key)
+        self.profiles[name] = (df, profile)
+        return profile
+
+    def _transactions_by_day(self) -> PandasDataFrame:
+        """
+        Compute the timeseries of all CDR transactions (voice + SMS together) by day, from the CDR profile
+
+        Returns: pandas df with columns 'day' and 'count'
+        """
+        daily = self.profile('cdr')['daily']
+        return daily.groupby('day', as_index=False)['transactions'].sum().rename(columns={'transactions': 'count'})
+
     def filter_outlier_days(self, num_sds: float = 2) -> List:
+        """
+        Identify days whose number of CDR transactions is more than num_sds standard deviations away from the mean, and
+        remove them from all datasets
+
+        Args:
+            num_sds: number of standard deviations used to identify outlier days
+
+        Returns: list of outlier days - ['2020-01-01', ...]
+        """
         # Raise exception if no CDR, since spammers are calculated only on the basis of call and text
         if getattr(self, 'cdr', None) is None:
             raise ValueError('CDR must be loaded to identify and remove outlier days.')
 
-        # If haven't already obtained timeseries of subscribers by day (e.g. in diagnostic plots), calculate it
-        if not os.path.isfile(self.outputs + 'datasets/CDR_transactionsbyday.csv'):
-            save_df(self.cdr.groupby(['txn_type', 'day']).count(), self.outputs + 'datasets/CDR_transactionsbyday.csv')
-
-        # Read in timeseries of subscribers by day
-        timeseries = pd.read_csv(self.outputs + 'datasets/CDR_transactionsbyday.csv')
-
-        # Calculate timeseries of all transaction (voice + SMS together)
-        timeseries = timeseries.groupby('day', as_index=False).agg('sum')
+        # Compute timeseries of transactions by day from the current data, so that earlier filters are accounted for
+        timeseries = self._transactions_by_day()
 
         # Calculate top and bottom acceptable values
         bottomrange = timeseries['count'].mean() - num_sds * timeseries['count'].std()
@@ -420,22 +711,19 @@ class DataStore(InitializerInterface):
         # Obtain list of outlier days
         outliers = timeseries[(timeseries['count'] < bottomrange) | (timeseries['count'] > toprange)]
         outliers.to_csv(self.outputs + 'datasets/outlier_days.csv', index=False)
-        outliers = list(outliers['day'])
-        if outliers and isinstance(outliers[0], str):
-            outliers = [outlier.split('T')[0] for outlier in outliers]
-            print('Outliers removed: ' + ', '.join(outliers))
-        else:
-            outliers = [outlier.strftime("%Y-%m-%d") for outlier in outliers]
-            print('Outliers removed: ' + ', '.join(outliers))
-
-        # Remove outlier days from all datasets
-        for df_name in ['cdr', 'recharges', 'mobiledata', 'mobilemoney']:
-            for outlier in outliers:
-                outlier = pd.to_datetime(outlier)
-                if getattr(self, df_name, None) is not None:
-                    setattr(self, df_name, getattr(self, df_name)
-                            .where((col('timestamp') < outlier) |
-                                   (col('timestamp') >= outlier + pd.Timedelta(value=1, unit='days'))))
+        outlier_days = list(pd.to_datetime(outliers['day']))
+        outliers = [outlier.strftime("%Y-%m-%d") for outlier in outlier_days]
+        print('Outliers removed: ' + ', '.join(outliers))
+
+        # Remove outlier days from all datasets with a single predicate on the day column, which prunes day partitions
+        if outlier_days:
+            for df_name in ['cdr', 'recharges', 'mobiledata', 'mobilemoney']:
+                df = getattr(self, df_name, None)
+                if isinstance(df, PandasDataFrame):
+                    self._set_dataset(df_name, df[~df['day'].isin(outlier_days)], 'filter_outlier_days', outliers)
+                elif df is not None:
+                    self._set_dataset(df_name, df.where(~col('day').isin(outlier_days)), 'filter_outlier_days',
+                                      outliers)
 
         return outliers
 
@@ -525,8 +813,8 @@ class OptDataStore(DataStore):
             user_col_name = 'caller_id'
         else:  # ml
             user_col_name = 'name'
-        self.user_consent = generate_user_consent_list(data, user_id_col=user_col_name,
-                                                       opt_in=self.cfg.params.opt_in_default)
+        user_consent = generate_user_consent_list(data, user_id_col=user_col_name,
+                                                  opt_in=self.cfg.params.opt_in_default).localCheckpoint()
 
         # Check if a user consent file has been provided, and if so set consent flags appropriately
         if read_from_file and self.file_names.user_consent is not None:
@@ -535,21 +823,45 @@ class OptDataStore(DataStore):
                 raise ValueError("The user consent table should have a 'user_id' column")
             # If there's just a user id column, set those user ids' consent to the opposite of opt_in_default
             if len(user_consent_df.columns) == 1:
-                user_ids = list(user_consent_df['user_id'])
-                if self.cfg.params.opt_in_default:
-                    self.opt_out(user_ids=user_ids)
-                else:
-                    self.opt_in(user_ids=user_ids)
+                user_consent_df['include'] = not self.cfg.params.opt_in_default
             elif len(user_consent_df.columns) == 2:
                 if 'include' not in user_consent_df.columns or user_consent_df['include'].dtype != bool:
                     raise ValueError("The consent column should be called 'include' and have True/False values")
-                user_ids_in = list(user_consent_df[user_consent_df['include'] == True]['user_id'])
-                user_ids_out = list(user_consent_df[user_consent_df['include'] == False]['user_id'])
-                self.opt_in(user_ids=user_ids_in)
-                self.opt_out(user_ids=user_ids_out)
             else:
                 raise ValueError("The user consent table should have at most two columns, one for the user id and "
                                  "another for the consent flag")
+            # Apply all flags from the file as a single batch
+            user_consent = apply_consent_changes(user_consent, self._consent_changes(user_consent_df, user_col_name))
+
+        # Datasets are only refreshed once, with the final consent table
+        self.user_consent = user_consent
+
+    def _consent_changes(self, changes: PandasDataFrame, user_col_name: str) -> SparkDataFrame:
+        """
+        Convert a pandas df of consent changes, with 'user_id' and 'include' columns, to a spark df that can be merged
+        into the user consent table
+
+        Args:
+            changes: pandas df of consent changes
+            user_col_name: name of the user id column in the user consent table
+
+        Returns: spark df with user id and 'include' columns
+        """
+        changes = changes[['user_id', 'include']].rename(columns={'user_id': user_col_name})
+        changes[user_col_name] = changes[user_col_name].astype(str)
+        schema = StructType([StructField(user_col_name, StringType()), StructField('include', BooleanType())])
+        return get_spark_session(self.cfg).createDataFrame(changes, schema=schema)
+
+    def update_consent(self, changes: PandasDataFrame) -> None:
+        """
+        Apply a batch of consent changes to the user consent table, and refresh the datasets once
+
+        Args:
+            changes: pandas df with 'user_id' and 'include' columns; if a user appears with both values, opting out
+                prevails
+        """
+        user_col_name = self.user_consent.columns[0]
+        self.user_consent = apply_consent_changes(self.user_consent, self._consent_changes(changes, user_col_name))
 
     def opt_in(self, user_ids: List[str]) -> None:
         """
@@ -558,10 +870,7 @@ class OptDataStore(DataStore):
         Args:
             user_ids: list of user ids to flag as opted in, i.e. include = True
         """
-        user_col_name = self.user_consent.columns[0]
-        self.user_consent = (self.user_consent
-                             .withColumn('include', F.when(col(user_col_name).isin(user_ids), True)
-                                         .otherwise(col('include'))))
+        self.update_consent(pd.DataFrame({'user_id': user_ids, 'include': True}))
 
     def opt_out(self, user_ids: List[str]) -> None:
         """
@@ -570,7 +879,4 @@ class OptDataStore(DataStore):
         Args:
             user_ids: list of user ids to flag as opted out, i.e. include = False
         """
-        user_col_name = self.user_consent.columns[0]
-        self.user_consent = (self.user_consent
-                             .withColumn('include', F.when(col(user_col_name).isin(user_ids), False)
-                                         .otherwise(col('include'))))
+        self.update_consent(pd.DataFrame({'user_id': user_ids, 'include': False}))
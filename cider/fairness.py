@@ -9,9 +9,9 @@ from helpers.utils import *
 from helpers.plot_utils import *
 from helpers.io_utils import *
 from helpers.ml_utils import *
-from scipy.stats import f_oneway, chi2_contingency
+from helpers.weighted_utils import boxplot_stats, targeted_overlap, targeted_weights, weighted_f_oneway, weighted_std
+from scipy.stats import chi2_contingency
 from datastore import *
-from sklearn.metrics import recall_score, precision_score
 
 
 class Fairness:
@@ -32,14 +32,27 @@ class Fairness:
         self.unweighted_data = self.data.copy()
         self.unweighted_data['weight'] = 1
 
-        # Weighted data
+        # Weighted data: records are weighted rather than repeated, smallest weight being 1
         self.weighted_data = self.data.copy()
         if 'weight' not in self.weighted_data.columns:
-            self.data['weight'] = 1
+            self.weighted_data['weight'] = 1
         else:
             self.weighted_data['weight'] = self.weighted_data['weight']/self.weighted_data['weight'].min()
-        self.weighted_data = pd.DataFrame(np.repeat(self.weighted_data.values, self.weighted_data['weight'], axis=0), columns=self.weighted_data.columns)\
-            .astype(self.unweighted_data.dtypes)
+
+    @staticmethod
+    def targeted(data: pd.DataFrame, var: str, p: float) -> np.ndarray:
+        """
+        Simulate targeting of the bottom p% of the (weighted) population according to a variable, see targeted_weights.
+
+        Args:
+            data: Records with the variable, a 'weight' column and a 'random' column used to break ties.
+            var: Name of the variable by which to rank records.
+            p: Percentage of the population to target.
+
+        Returns: Targeted weight of each record, between 0 and its weight.
+        """
+        return targeted_weights(data[var].values, data['weight'].values, p, tiebreak=data['random'].values)
+
     # --------------------------------
     # SINGLULAR FUNCTIONS
     # --------------------------------
@@ -48,17 +61,23 @@ class Fairness:
         
         data = self.weighted_data if weighted else self.unweighted_data
         
-        # Get rankings according to var1 and var2
-        data = data.sort_values([var1, 'random'], ascending=True)
-        data['rank1'] = range(len(data))
-        data = data.sort_values([var2, 'random'], ascending=True)
-        data['rank2'] = range(len(data))
+        # Get rankings according to var1 and var2; all repetitions of a record are shifted by the same amount, so its
+        # residual is that of its first repetition
+        data = data.copy()
+        weights = data['weight'].values.astype('float')
+        for var, rank in [(var1, 'rank1'), (var2, 'rank2')]:
+            order = np.lexsort((data['random'].values, data[var].values))
+            ranks = np.empty(len(data))
+            ranks[order] = np.cumsum(weights[order]) - weights[order]
+            data[rank] = ranks
 
         # Calcualte normalized rank residual
-        data['rank_residual'] = (data['rank2'] - data['rank1'])/data['rank2'].max()
+        data['rank_residual'] = (data['rank2'] - data['rank1'])/(weights.sum() - 1)
 
-        # Return rank residual distributions for each group
-        return {group: data[data[characteristic] == group]['rank_residual'].values.flatten() for group in data[characteristic].unique()}
+        # Return rank residual distributions for each group, along with the weights of the residuals
+        return {group: (data[data[characteristic] == group]['rank_residual'].values.flatten(),
+                        data[data[characteristic] == group]['weight'].values.flatten())
+                for group in data[characteristic].unique()}
 
     def demographic_parity(self, var1, var2, characteristic, p, weighted=False):
         """
@@ -68,24 +87,21 @@ class Fairness:
         p = target the top p percent
         """
 
-        data = self.weighted_data if weighted else self.unweighted_data
+        data = (self.weighted_data if weighted else self.unweighted_data).copy()
 
         # Simulate targeting by var1 and var2
-        num_ones = int((p/100)*len(data))
-        num_zeros = len(data) - num_ones
-        targeting_vector = np.concatenate([np.ones(num_ones), np.zeros(num_zeros)])
-        data = data.sort_values([var1, 'random'], ascending=True)
-        data['targeted_var1'] = targeting_vector
-        data = data.sort_values([var2, 'random'], ascending=True)
-        data['targeted_var2'] = targeting_vector
+        data['targeted_var1'] = self.targeted(data, var1, p)
+        data['targeted_var2'] = self.targeted(data, var2, p)
 
         # Get demographic parity and poverty share for each group
         results = {}
         for group in data[characteristic].unique():
             subset = data[data[characteristic] == group]
+            share_var1 = 100*subset['targeted_var1'].sum()/subset['weight'].sum()
+            share_var2 = 100*subset['targeted_var2'].sum()/subset['weight'].sum()
             results[group] = {}
-            results[group]['poverty_share'] = 100*subset['targeted_var1'].mean()
-            results[group]['demographic_parity'] = 100*subset['targeted_var2'].mean() - 100*subset['targeted_var1'].mean()
+            results[group]['poverty_share'] = share_var1
+            results[group]['demographic_parity'] = share_var2 - share_var1
         return results
     
     def independence(self, var1, var2, characteristic, p, weighted=False):
@@ -96,23 +112,20 @@ class Fairness:
         characteristic -- sensitive characteristic
 
         """
-        data = self.weighted_data if weighted else self.unweighted_data
+        data = (self.weighted_data if weighted else self.unweighted_data).copy()
 
-        # Simulate targeting by var1 and var2
-        num_ones = int((p/100)*len(data))
-        num_zeros = len(data) - num_ones
-        targeting_vector = np.concatenate([np.ones(num_ones), np.zeros(num_zeros)])
-        data = data.sort_values([var2, 'random'], ascending=True)
-        data['targeted_var2'] = targeting_vector
+        # Simulate targeting by var2
+        data['targeted_var2'] = self.targeted(data, var2, p)
+        data['not_targeted_var2'] = data['weight'] - data['targeted_var2']
 
         # Get targeted percent for each group
         results = {}
         for group in data[characteristic].unique():
             subset = data[data[characteristic] == group]
-            results[group] = subset['targeted_var2'].mean()
+            results[group] = subset['targeted_var2'].sum()/subset['weight'].sum()
 
-        # Create a pivot table between the characteristic and the proxy
-        pivot = data.pivot_table(index=characteristic, columns='targeted_var2', aggfunc='count', fill_value=0).iloc[:, 0:2]
+        # Create a contingency table between the characteristic and the proxy
+        pivot = data.groupby(characteristic)[['not_targeted_var2', 'targeted_var2']].sum()
 
         # Run independence test
         chi2, p, dof, ex = chi2_contingency(pivot)
@@ -127,25 +140,23 @@ class Fairness:
         p = target the top p percent
         """
 
-        data = self.weighted_data if weighted else self.unweighted_data
+        data = (self.weighted_data if weighted else self.unweighted_data).copy()
 
         # Simulate targeting by var1 and var2
-        num_ones = int((p/100)*len(data))
-        num_zeros = len(data) - num_ones
-        targeting_vector = np.concatenate([np.ones(num_ones), np.zeros(num_zeros)])
-        data = data.sort_values([var1, 'random'], ascending=True)
-        data['targeted_var1'] = targeting_vector
-        data = data.sort_values([var2, 'random'], ascending=True)
-        data['targeted_var2'] = targeting_vector
+        data['targeted_var1'] = self.targeted(data, var1, p)
+        data['targeted_var2'] = self.targeted(data, var2, p)
+        data['true_positive'] = targeted_overlap(data['targeted_var1'], data['targeted_var2'], data['weight'])
+        data['false_negative'] = data['targeted_var1'] - data['true_positive']
 
         # Get recall for each group
         results = {}
         for group in data[characteristic].unique():
             subset = data[data[characteristic] == group]
-            results[group] = recall_score(subset['targeted_var1'], subset['targeted_var2'], zero_division=0)
+            positives = subset['targeted_var1'].sum()
+            results[group] = subset['true_positive'].sum()/positives if positives > 0 else 0
         
-        # Create a pivot table between true positives and false negatives
-        pivot = data[data['targeted_var1']==1].pivot_table(index=characteristic, columns='targeted_var2', aggfunc='count', fill_value=0).iloc[:, 0:2]
+        # Create a contingency table between true positives and false negatives
+        pivot = data.groupby(characteristic)[['false_negative', 'true_positive']].sum()
 
         # Run independence test
         chi2, p, dof, ex = chi2_contingency(pivot)
@@ -160,25 +171,23 @@ class Fairness:
         p = target the top p percent
         """
 
-        data = self.weighted_data if weighted else self.unweighted_data
+        data = (self.weighted_data if weighted else self.unweighted_data).copy()
 
         # Simulate targeting by var1 and var2
-        num_ones = int((p/100)*len(data))
-        num_zeros = len(data) - num_ones
-        targeting_vector = np.concatenate([np.ones(num_ones), np.zeros(num_zeros)])
-        data = data.sort_values([var1, 'random'], ascending=True)
-        data['targeted_var1'] = targeting_vector
-        data = data.sort_values([var2, 'random'], ascending=True)
-        data['targeted_var2'] = targeting_vector
+        data['targeted_var1'] = self.targeted(data, var1, p)
+        data['targeted_var2'] = self.targeted(data, var2, p)
+        data['true_positive'] = targeted_overlap(data['targeted_var1'], data['targeted_var2'], data['weight'])
+        data['false_positive'] = data['targeted_var2'] - data['true_positive']
 
-        # Get demographic parity and poverty share for each group
+        # Get precision for each group
         results = {}
         for group in data[characteristic].unique():
             subset = data[data[characteristic] == group]
-            results[group] = precision_score(subset['targeted_var1'], subset['targeted_var2'], zero_division=0)
+            predicted_positives = subset['targeted_var2'].sum()
+            results[group] = subset['true_positive'].sum()/predicted_positives if predicted_positives > 0 else 0
 
-        # Create a pivot table between true and false positives
-        pivot = data[data['targeted_var2']==1].pivot_table(index=characteristic, columns='targeted_var1', aggfunc='count', fill_value=0).iloc[:, 0:2]
+        # Create a contingency table between true and false positives
+        pivot = data.groupby(characteristic)[['false_positive', 'true_positive']].sum()
 
         # Run independence test
         chi2, p, dof, ex = chi2_contingency(pivot)
@@ -203,12 +212,13 @@ class Fairness:
             distributions, means = [], []
             results = self.rank_residual(groundtruth, proxy, characteristic, weighted=weighted)
             for group in sorted(data[characteristic].unique()):
-                distribution = list(results[group])
-                distributions.append(distribution)
-                means.append('%.2f (%.2f)' % (np.mean(distribution), np.std(distribution)))
+                distribution, weights = results[group]
+                distributions.append((distribution, weights))
+                mean, std = weighted_mean(distribution, weights), weighted_std(distribution, weights)
+                means.append('%.2f (%.2f)' % (mean, std))
 
             # Anova test to determine whether means of distributions are statistically significantly different
-            anova = f_oneway(*tuple(distributions))
+            anova = weighted_f_oneway(distributions)
             column = means + [anova[0]] + [anova[1]]
 
             # Add column to table
@@ -223,7 +233,6 @@ class Fairness:
     def demographic_parity_table(self, groundtruth, proxies, characteristic, p, weighted=False, format_table=True):
 
         data = self.weighted_data if weighted else self.unweighted_data
-        data['count'] = 1
 
         # Set up table
         table=pd.DataFrame()
@@ -231,8 +240,8 @@ class Fairness:
         table[characteristic] = groups
 
         # Get share of population for each group
-        population_shares = data.groupby(characteristic).agg('count')
-        table["Group's share of population"] = 100*(population_shares['count'].values.flatten()/len(data))
+        population_shares = data.groupby(characteristic)['weight'].sum()
+        table["Group's share of population"] = 100*(population_shares.values.flatten()/data['weight'].sum())
 
         # Get demographic parity and poverty share for each group
         for proxy in proxies:
@@ -254,7 +263,6 @@ class Fairness:
 
     def create_table(self, function, name, groundtruth, proxies, characteristic, p, weighted=False, format_table=True):
         data = self.weighted_data if weighted else self.unweighted_data
-        data['count'] = 1
 
         # Set up table
         table=pd.DataFrame()
@@ -263,8 +271,8 @@ class Fairness:
         table[characteristic] = groups
 
         # Get share of population for each group
-        population_shares = data.groupby(characteristic).agg('count')
-        table["Group's share of population"] = list(100*(population_shares['count'].values.flatten()/len(data))) + [0]
+        population_shares = data.groupby(characteristic)['weight'].sum()/data['weight'].sum()
+        table["Group's share of population"] = list(100*population_shares.values.flatten()) + [0]
 
         # Get demographic parity and poverty share for each group
         for proxy in proxies:
@@ -310,28 +318,20 @@ class Fairness:
 
         for i, proxy in enumerate(proxies):
 
-            # Obtain rank residual distribution for each group
-            distributions, groups = [], []
+            # Obtain weighted box plot statistics of the rank residual distribution of each group
+            groups = sorted(data[characteristic].unique())
             results = self.rank_residual(groundtruth, proxy, characteristic, weighted=weighted)
-            for g, group in enumerate(sorted(data[characteristic].unique())):
-                distribution = list(results[group])
-                distributions = distributions + distribution
-                groups = groups + [group for _ in range(len(distribution))]
-
-            # Combine rank residual distributions for all groups into dataframe
-            results = pd.DataFrame([distributions, groups]).T
-            results.columns = ['Normalized Rank Residual', characteristic]
-            results = results.sort_values(characteristic, ascending=True)
+            stats = [boxplot_stats(results[group][0], results[group][1], group) for group in groups]
 
             # Update range for plotting
-            if np.abs(results['Normalized Rank Residual'].max()) > max_resid:
-                max_resid = np.abs(results['Normalized Rank Residual'].max())
-            if np.abs(results['Normalized Rank Residual'].min()) > max_resid:
-                max_resid = np.abs(results['Normalized Rank Residual'].min())
-
-            # Create boxplot
-            sns.boxplot(data=results, x='Normalized Rank Residual', y=characteristic, orient='h', ax=ax[i], showfliers=False, 
-                palette={group: colors[g] for g, group in enumerate(sorted(data[characteristic].unique()))})
+            for distribution, _ in results.values():
+                max_resid = max(max_resid, np.abs(distribution).max())
+
+            # Create boxplot, first group on top
+            boxes = ax[i].bxp(stats[::-1], vert=False, showfliers=False, patch_artist=True,
+                              medianprops={'color': 'grey'})
+            for box, g in zip(boxes['boxes'], range(len(groups))[::-1]):
+                box.set_facecolor(colors[g])
             ax[i].axvline(0, color='grey', dashes=[1, 1])
 
             # Clean up subplot
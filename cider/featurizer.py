@@ -1,25 +1,38 @@
 from collections import defaultdict
 import bandicoot as bc  # type: ignore[import]
+import builtins
 from datastore import DataStore, DataType
 import geopandas as gpd  # type: ignore[import]
-from helpers.utils import cdr_bandicoot_format, flatten_folder, flatten_lst, long_join_pyspark, long_join_pandas, \
-    make_dir, save_df, save_parquet
-from helpers.features import all_spark
+import glob
+from helpers.cache_utils import is_cached, stage_fingerprint, write_fingerprint
+from helpers.utils import bandicoot_user, cdr_bandicoot_format, long_join_pandas, make_dir, persist_df, save_df, \
+    save_parquet, wide_join_pyspark
+from helpers.features import all_spark, all_spark_partials, daily_partials, prepare_cdr
+from helpers.features_utils import check_sketch_error
 from helpers.io_utils import get_spark_session
 from helpers.plot_utils import clean_plot, dates_xaxis, distributions_plot
+from helpers.store_utils import export_csv, load_feature_block, save_feature_block
 import json
 import matplotlib.pyplot as plt  # type: ignore[import]
-from multiprocessing import Pool
 import os
 import pandas as pd
 from pandas import DataFrame as PandasDataFrame
 from pyspark.sql import DataFrame as SparkDataFrame
-from pyspark.sql.types import StringType
-from pyspark.sql.functions import array, col, count, countDistinct, explode, first, lit, max, mean, min, stddev, sum
-from pyspark.sql.utils import AnalysisException
+from pyspark.sql.functions import array, col, count, countDistinct, explode, first, lit, max, mean, min, stddev, sum, \
+    xxhash64
 import seaborn as sns  # type: ignore[import]
+import shutil
 from typing import Any, Dict, List, Optional, Union
 
+# Datastore datasets from which each feature block, saved under outputs/featurizer/datasets/, is computed
+FEATURE_INPUTS = {'bandicoot_features/all': ['cdr', 'antennas'],
+                  'cdr_features_spark/all': ['cdr', 'antennas'],
+                  'international_feats': ['cdr'],
+                  'location_features': ['cdr', 'antennas', 'shapefiles'],
+                  'mobiledata_features': ['mobiledata'],
+                  'mobilemoney_feats': ['mobilemoney'],
+                  'recharges_feats': ['recharges']}
+
 
 class Featurizer:
 
@@ -53,13 +66,13 @@ class Featurizer:
                          DataType.MOBILEMONEY: dataframes['mobilemoney'],
                          DataType.ANTENNAS: dataframes['antennas'],
                          DataType.SHAPEFILES: None}
-        # Load data into datastore, initialize bandicoot attribute
-        self.ds.load_data(data_type_map=data_type_map)
+        # Register data in datastore, to be loaded when first accessed, initialize bandicoot attribute
+        self.ds.load_data(data_type_map=data_type_map, lazy=True)
         self.ds.cdr_bandicoot = None
 
     def diagnostic_statistics(self, write: bool = True) -> Dict[str, Dict[str, int]]:
         """
-        Compute summary statistics of datasets
+        Compute summary statistics of datasets, from their profiles
 
         Args:
             write: whether to write json to disk
@@ -68,28 +81,12 @@ class Featurizer:
         """
         statistics: Dict[str, Dict[str, int]] = {}
 
-        for name, df in [('CDR', self.ds.cdr),
-                         ('Recharges', self.ds.recharges),
-                         ('Mobile Data', self.ds.mobiledata),
-                         ('Mobile Money', self.ds.mobilemoney)]:
-            if df is not None:
-
-                statistics[name] = {}
-
-                # Number of days
-                lastday = pd.to_datetime(df.agg({'timestamp': 'max'}).collect()[0][0])
-                firstday = pd.to_datetime(df.agg({'timestamp': 'min'}).collect()[0][0])
-                statistics[name]['Days'] = (lastday - firstday).days + 1
-
-                # Number of transactions
-                statistics[name]['Transactions'] = df.count()
-
-                # Number of subscribers
-                statistics[name]['Subscribers'] = df.select('caller_id').distinct().count()
-
-                # Number of recipients
-                if 'recipient_id' in df.columns:
-                    statistics[name]['Recipients'] = df.select('recipient_id').distinct().count()
+        for name, dataset in [('CDR', 'cdr'),
+                              ('Recharges', 'recharges'),
+                              ('Mobile Data', 'mobiledata'),
+                              ('Mobile Money', 'mobilemoney')]:
+            if getattr(self.ds, dataset, None) is not None:
+                statistics[name] = self.ds.profile(dataset)['statistics']
 
         if write:
             with open(self.outputs + '/tables/statistics.json', 'w') as f:
@@ -99,155 +96,144 @@ class Featurizer:
 
     def diagnostic_plots(self, plot: bool = True) -> None:
         """
-        Compute time series of transactions, save to disk, and plot if requested
+        Save time series of transactions and subscribers by day, from the datasets' profiles, and plot if requested
 
         Args:
             plot: whether to plot graphs
         """
-        for name, df in [('CDR', self.ds.cdr),
-                         ('Recharges', self.ds.recharges),
-                         ('Mobile Data', self.ds.mobiledata),
-                         ('Mobile Money', self.ds.mobilemoney)]:
-            if df is not None:
-
-                if 'txn_type' not in df.columns:
-                    df = df.withColumn('txn_type', lit('txn'))
-
-                # Save timeseries of transactions by day
-                save_df(df.groupby(['txn_type', 'day']).count(),
-                        self.outputs + '/datasets/' + name.replace(' ', '') + '_transactionsbyday.csv')
-
-                # Save timeseries of subscribers by day
-                save_df(df
-                        .groupby(['txn_type', 'day'])
-                        .agg(countDistinct('caller_id'))
-                        .withColumnRenamed('count(caller_id)', 'count'),
-                        self.outputs + '/datasets/' + name.replace(' ', '') + '_subscribersbyday.csv')
-
-                if plot:
-                    # Plot timeseries of transactions by day
-                    timeseries = pd.read_csv(
-                        self.outputs + '/datasets/' + name.replace(' ', '') + '_transactionsbyday.csv')
-                    timeseries['day'] = pd.to_datetime(timeseries['day'])
-                    timeseries = timeseries.sort_values('day', ascending=True)
-                    fig, ax = plt.subplots(1, figsize=(20, 6))
-                    for txn_type in timeseries['txn_type'].unique():
-                        subset = timeseries[timeseries['txn_type'] == txn_type]
-                        ax.plot(subset['day'], subset['count'], label=txn_type)
-                        ax.scatter(subset['day'], subset['count'], label='')
-                    if len(timeseries['txn_type'].unique()) > 1:
-                        ax.legend(loc='best')
-                    ax.set_title(name + ' Transactions by Day', fontsize='large')
-                    dates_xaxis(ax, frequency='week')
-                    clean_plot(ax)
-                    plt.savefig(self.outputs + '/plots/' + name.replace(' ', '') + '_transactionsbyday.png', dpi=300)
-
-                    # Plot timeseries of subscribers by day
-                    timeseries = pd.read_csv(
-                        self.outputs + '/datasets/' + name.replace(' ', '') + '_subscribersbyday.csv')
-                    timeseries['day'] = pd.to_datetime(timeseries['day'])
-                    timeseries = timeseries.sort_values('day', ascending=True)
-                    fig, ax = plt.subplots(1, figsize=(20, 6))
-                    for txn_type in timeseries['txn_type'].unique():
-                        subset = timeseries[timeseries['txn_type'] == txn_type]
-                        ax.plot(subset['day'], subset['count'], label=txn_type)
-                        ax.scatter(subset['day'], subset['count'], label='')
-                    if len(timeseries['txn_type'].unique()) > 1:
-                        ax.legend(loc='best')
-                    ax.set_title(name + ' Subscribers by Day', fontsize='large')
-                    dates_xaxis(ax, frequency='week')
-                    clean_plot(ax)
-                    plt.savefig(self.outputs + '/plots/' + name.replace(' ', '') + '_subscribersbyday.png', dpi=300)
+        for name, dataset in [('CDR', 'cdr'),
+                              ('Recharges', 'recharges'),
+                              ('Mobile Data', 'mobiledata'),
+                              ('Mobile Money', 'mobilemoney')]:
+            if getattr(self.ds, dataset, None) is not None:
+                daily = self.ds.profile(dataset)['daily']
+
+                for column, title, suffix in [('transactions', 'Transactions', '_transactionsbyday'),
+                                              ('subscribers', 'Subscribers', '_subscribersbyday')]:
+                    # Save timeseries by day
+                    timeseries = daily[['txn_type', 'day', column]].rename(columns={column: 'count'})
+                    timeseries.to_csv(self.outputs + '/datasets/' + name.replace(' ', '') + suffix + '.csv',
+                                      index=False)
+
+                    if plot:
+                        # Plot timeseries by day
+                        fig, ax = plt.subplots(1, figsize=(20, 6))
+                        for txn_type in timeseries['txn_type'].unique():
+                            subset = timeseries[timeseries['txn_type'] == txn_type]
+                            ax.plot(subset['day'], subset['count'], label=txn_type)
+                            ax.scatter(subset['day'], subset['count'], label='')
+                        if len(timeseries['txn_type'].unique()) > 1:
+                            ax.legend(loc='best')
+                        ax.set_title(name + ' ' + title + ' by Day', fontsize='large')
+                        dates_xaxis(ax, frequency='week')
+                        clean_plot(ax)
+                        plt.savefig(self.outputs + '/plots/' + name.replace(' ', '') + suffix + '.png', dpi=300)
+
+    def _features_fingerprint(self, dataset: str) -> Optional[str]:
+        """
+        Fingerprint of a feature block, from the datasets it is computed from, its parameters and the code version
+
+        Args:
+            dataset: name of the feature block, e.g. 'recharges_feats'
+
+        Returns: fingerprint, or None if the content of any input is unknown
+        """
+        params = self.cfg.params.cdr if dataset == 'cdr_features_spark/all' else None
+        return stage_fingerprint([self.ds.fingerprint(name) for name in FEATURE_INPUTS[dataset]], dataset, params)
+
+    def _load_cached_features(self, feature: str, dataset: str, key: Optional[str]) -> bool:
+        """
+        Load a feature block from disk if it was computed from the same inputs, parameters and code
+
+        Args:
+            feature: key of the block in self.features, e.g. 'recharges'
+            dataset: name of the feature block, e.g. 'recharges_feats'
+            key: fingerprint of the block
+
+        Returns: whether the block was loaded
+        """
+        fname = self.outputs + '/datasets/' + dataset + '.parquet'
+        if not is_cached(fname, key):
+            return False
+        print('Loading %s features computed from the same data...' % feature)
+        self.features[feature] = load_feature_block(self.cfg, fname)
+        return True
+
+    def _save_features(self, feature: str, dataset: str, df: SparkDataFrame, key: Optional[str]) -> None:
+        """
+        Write a feature block to the feature store, load it back from there, and store its fingerprint
+
+        Args:
+            feature: key of the block in self.features, e.g. 'recharges'
+            dataset: name of the feature block, e.g. 'recharges_feats'
+            df: spark df of the feature block
+            key: fingerprint of the block
+        """
+        fname = self.outputs + '/datasets/' + dataset + '.parquet'
+        save_feature_block(df, fname, feature, key)
+        self.features[feature] = load_feature_block(self.cfg, fname)
+        write_fingerprint(fname, key)
 
     def cdr_features(self, bc_chunksize: int = 500000, bc_processes: int = 55) -> None:
         """
-        Compute CDR features using bandicoot library and save to disk
+        Compute CDR features using bandicoot library and save to disk. Records are grouped by user in memory and
+        bandicoot users are built directly from them, without writing one file per user
 
         Args:
-            bc_chunksize: number of users per chunk
-            bc_processes: number of processes to run in parallel
+            bc_chunksize: maximum number of users per partition
+            bc_processes: minimum number of spark partitions, i.e. tasks, in which users are processed; bandicoot
+                runs within spark tasks rather than in a pool of local processes, so parallelism is bounded by the
+                cores of the spark cluster
         """
         # Check that CDR is present to calculate international features
         if self.ds.cdr is None:
             raise ValueError('CDR file must be loaded to calculate CDR features.')
+        key = self._features_fingerprint('bandicoot_features/all')
+        if self._load_cached_features('cdr', 'bandicoot_features/all', key):
+            return
         print('Calculating CDR features...')
 
         # Convert CDR into bandicoot format
         self.ds.cdr_bandicoot = cdr_bandicoot_format(self.ds.cdr, self.ds.antennas, self.cfg.col_names.cdr)
 
         # Get list of unique subscribers, write to file
-        save_df(self.ds.cdr_bandicoot.select('name').distinct(), self.outputs + '/datasets/subscribers.csv')
-        subscribers = self.ds.cdr_bandicoot.select('name').distinct().rdd.map(lambda r: r[0]).collect()
+        subscribers = persist_df(self.ds.cdr_bandicoot.select('name').distinct(), 'MEMORY_AND_DISK')
+        save_df(subscribers, self.outputs + '/datasets/subscribers.csv')
+        n_subscribers = subscribers.count()
+        subscribers.unpersist()
+        n_partitions = builtins.max(bc_processes, (n_subscribers + bc_chunksize - 1) // bc_chunksize, 1)
 
-        # Make adjustments to chunk size and parallelization if necessary
-        if bc_chunksize > len(subscribers):
-            bc_chunksize = len(subscribers)
-        if bc_processes > int(len(subscribers) / bc_chunksize):
-            bc_processes = int(len(subscribers) / bc_chunksize)
-
-        # Make output folders
-        make_dir(self.outputs + '/datasets/bandicoot_records')
+        # Make output folder, removing features from previous runs
         make_dir(self.outputs + '/datasets/bandicoot_features')
+        bc_folder = self.outputs + '/datasets/bandicoot_features/users'
+        make_dir(bc_folder, remove=True)
+
+        # Calculate bandicoot features, counting records that cannot be parsed
+        skipped = self.spark.sparkContext.accumulator(0)
 
-        # Get bandicoot features in chunks
-        start = 0
-        end = 0
-        while end < len(subscribers):
-
-            # Get start and end point of chunk
-            end = start + bc_chunksize
-            chunk = subscribers[start:end]
-
-            # Name outfolders
-            recs_folder = self.outputs + '/datasets/bandicoot_records/' + str(start) + 'to' + str(end)
-            bc_folder = self.outputs + '/datasets/bandicoot_features/' + str(start) + 'to' + str(end)
-            make_dir(bc_folder)
-
-            # Get records for this chunk and write out to csv files per person
-            nums_spark = self.spark.createDataFrame(chunk, StringType()).withColumnRenamed('value', 'name')
-            matched_chunk = self.ds.cdr_bandicoot.join(nums_spark, on='name', how='inner')
-            matched_chunk.repartition('name').write.partitionBy('name').mode('append').format('csv').save(recs_folder,
-                                                                                                          header=True)
-
-            # Move csv files around on disk to get into position for bandicoot
-            n = int(len(chunk) / bc_processes)
-            subchunks = [chunk[i:i + n] for i in range(0, len(chunk), n)]
-            pool = Pool(bc_processes)
-            unmatched = pool.map(flatten_folder, [(subchunk, recs_folder) for subchunk in subchunks])
-            unmatched = flatten_lst(unmatched)
-            pool.close()
-            if len(unmatched) > 0:
-                print('Warning: lost %i subscribers in file shuffling' % len(unmatched))
-
-            # Calculate bandicoot features
-            def get_bc(sub: Any) -> Any:
-                return bc.utils.all(bc.read_csv(str(sub), recs_folder, describe=True), summary='extended',
-                                    split_week=True,
-                                    split_day=True, groupby=None)
-
-            # Write out bandicoot feature files
-            def write_bc(index: Any, iterator: Any) -> Any:
-                bc.to_csv(list(iterator), bc_folder + '/' + str(index) + '.csv')
-                return ['index: ' + str(index)]
-
-            # Run calculations and writing of bandicoot features in parallel
-            feature_df = self.spark.sparkContext.emptyRDD()
-            subscriber_rdd = self.spark.sparkContext.parallelize(chunk)
-            features = subscriber_rdd.mapPartitions(
-                lambda s: [get_bc(sub) for sub in s if os.path.isfile(recs_folder + '/' + sub + '.csv')])
-            feature_df = feature_df.union(features)
-            out = feature_df.coalesce(bc_processes).mapPartitionsWithIndex(write_bc)
-            out.count()
-            start = start + bc_chunksize
+        def get_bc(name: str, records: Any) -> Any:
+            return bc.utils.all(bandicoot_user(name, records, skipped), summary='extended', split_week=True,
+                                split_day=True, groupby=None)
+
+        # Write out bandicoot feature files, one per partition
+        def write_bc(index: Any, iterator: Any) -> Any:
+            features = list(iterator)
+            if len(features) > 0:
+                bc.to_csv(features, bc_folder + '/' + str(index) + '.csv')
+            return ['index: ' + str(index)]
+
+        # Group records by user in memory, then run calculations and writing of bandicoot features in parallel
+        records = self.ds.cdr_bandicoot.rdd.map(lambda r: (r['name'], r.asDict())).groupByKey(n_partitions)
+        records.map(lambda user: get_bc(*user)).mapPartitionsWithIndex(write_bc).count()
+        if skipped.value > 0:
+            print('Warning: %i records could not be parsed and were skipped' % skipped.value)
 
         # Combine all bandicoot features into a single file, fix column names, and write to disk
-        cdr_features = self.spark.read.csv(self.outputs + '/datasets/bandicoot_features/*/*', header=True)
+        cdr_features = self.spark.read.csv(bc_folder + '/*.csv', header=True)
         cdr_features = cdr_features.select([col for col in cdr_features.columns if
                                             ('reporting' not in col) or (col == 'reporting__number_of_records')])
         cdr_features = cdr_features.toDF(*[c if c == 'name' else 'cdr_' + c for c in cdr_features.columns])
-        save_df(cdr_features, self.outputs + '/datasets/bandicoot_features/all.csv')
-        self.features['cdr'] = self.spark.read.csv(self.outputs + '/datasets/bandicoot_features/all.csv',
-                                                   header=True, inferSchema=True)
+        self._save_features('cdr', 'bandicoot_features/all', cdr_features, key)
 
     def cdr_features_spark(self) -> None:
         """
@@ -256,20 +242,172 @@ class Featurizer:
         # Check that CDR is present to calculate international features
         if self.ds.cdr is None:
             raise ValueError('CDR file must be loaded to calculate CDR features.')
+        key = self._features_fingerprint('cdr_features_spark/all')
+        if self._load_cached_features('cdr', 'cdr_features_spark/all', key):
+            return
         print('Calculating CDR features...')
 
-        cdr_features = all_spark(self.ds.cdr, self.ds.antennas, cfg=self.cfg.params.cdr)
-        cdr_features_df = long_join_pyspark(cdr_features, on='caller_id', how='outer')
+        # Prepare the CDR once and materialize it, so that all feature functions share a single computation of it
+        cfg = self.cfg.params.cdr
+        check_sketch_error(cfg.sketch_error if 'sketch_error' in cfg else None)
+        storage = cfg.prepared_storage if 'prepared_storage' in cfg else 'MEMORY_AND_DISK'
+        prepared_path = self.outputs + '/datasets/cdr_prepared.parquet'
+        cdr = persist_df(prepare_cdr(self.ds.cdr, cfg), storage, prepared_path)
+
+        # The prepared CDR is only needed until the features are written: release it, and remove its checkpoint
+        try:
+            cdr_features = all_spark(cdr, self.ds.antennas, cfg=cfg, prepared=True)
+            cdr_features_df = wide_join_pyspark(cdr_features, on='caller_id', how='outer')
+            cdr_features_df = cdr_features_df.withColumnRenamed('caller_id', 'name')
+
+            self._save_features('cdr', 'cdr_features_spark/all', cdr_features_df, key)
+        finally:
+            cdr.unpersist()
+            if os.path.isdir(prepared_path):
+                shutil.rmtree(prepared_path)
+
+    def cdr_partials_spark(self, since: Optional[str] = None) -> None:
+        """
+        Compute per-user, per-day partial aggregates of the CDR and add them to the partial aggregate store, from which
+        CDR features for any date window are assembled (see cdr_features_window). The store records a signature of the
+        CDR of each day, and only days whose records changed, e.g. were added or extended by the last ingest of the CDR
+        or cleaned differently, are recomputed. Days of the store that are no longer in the CDR are removed, but only
+        within the range of days of the CDR, so that refreshing the store from the CDR of recent days keeps the older
+        days. The whole store is recomputed if the parameters or the code that produced it changed
+
+        Unless the store was computed from the same CDR, computing the signatures reads the whole CDR; with since, only
+        the days from since onwards are read and checked, e.g. those of the last delivery, and older days of the store
+        are kept as they are
+
+        Args:
+            since: first day to check, e.g. '2020-03-01'; None to check all days of the CDR
+        """
+        if self.ds.cdr is None:
+            raise ValueError('CDR file must be loaded to calculate CDR partial aggregates.')
+        cfg = self.cfg.params.cdr
+        check_sketch_error(cfg.sketch_error if 'sketch_error' in cfg else None)
+        path = self.outputs + '/datasets/cdr_partials'
+        key = stage_fingerprint([], 'cdr_partials', cfg, self._partials_accuracy())
+        cdr_fingerprint = self.ds.fingerprint('cdr')
+
+        manifest: Dict[str, Any] = {'fingerprint': key, 'cdr': None, 'days': {}}
+        if os.path.isfile(path + '/manifest.json'):
+            with open(path + '/manifest.json', 'r') as f:
+                stored = json.load(f)
+            if stored['fingerprint'] == key:
+                manifest = stored
+            else:
+                make_dir(path, remove=True)
+        # The store is up to date if it was computed from the same CDR; if the content of the CDR is unknown, e.g. it
+        # was provided as a df, compare the signatures of each day
+        if cdr_fingerprint is not None and manifest['cdr'] == cdr_fingerprint:
+            print('CDR partial aggregates are up to date.')
+            return
+
+        cdr = self.ds.cdr
+        if since is not None:
+            since = str(pd.to_datetime(since).date())
+            cdr = cdr.where(col('day') >= pd.to_datetime(since))
+        signatures = self._day_signatures(cdr)
+        days = sorted(day for day, signature in signatures.items() if manifest['days'].get(day) != signature)
+        removed = sorted(day for day in manifest['days']
+                         if signatures and min(signatures) <= day <= max(signatures) and day not in signatures)
+        for day in removed:
+            for name in ['interactions', 'durations']:
+                for folder in glob.glob(path + '/' + name + '/day=' + day + '*'):
+                    shutil.rmtree(folder)
+        if days:
+            print('Calculating CDR partial aggregates for %i days...' % len(days))
+
+            # Write partial aggregates by day, replacing only the days that were recomputed
+            partials = daily_partials(cdr.where(col('day').isin(list(pd.to_datetime(days)))), cfg,
+                                      self._partials_accuracy())
+            for name, partial in partials.items():
+                partial.write.mode('overwrite').option('partitionOverwriteMode', 'dynamic').partitionBy('day') \
+                    .parquet(path + '/' + name)
+        else:
+            print('CDR partial aggregates are up to date.')
+
+        # The store only matches the whole CDR if all of its days were checked
+        manifest['cdr'] = cdr_fingerprint if since is None else None
+        manifest['days'] = {**{day: signature for day, signature in manifest['days'].items() if day not in removed},
+                            **signatures}
+        make_dir(path)
+        with open(path + '/manifest.json', 'w') as f:
+            json.dump(manifest, f)
+
+    @staticmethod
+    def _day_signatures(cdr: SparkDataFrame) -> Dict[str, List[str]]:
+        """
+        Signature of the records of each day of the CDR: their number and the sum of their hashes, which changes if
+        records of the day are added, removed or modified
+
+        Args:
+            cdr: spark df with the CDR
+
+        Returns: dict mapping each day, e.g. '2020-01-01', to its signature
+        """
+        rows = (cdr
+                .groupby('day')
+                .agg(count(lit(1)).alias('records'),
+                     sum(xxhash64(*cdr.columns).cast('decimal(38,0)')).alias('hash'))
+                .collect())
+        return {row['day'].strftime('%Y-%m-%d'): [str(row['records']), str(row['hash'])] for row in rows}
+
+    def cdr_features_window(self, start_date: str, end_date: str) -> None:
+        """
+        Assemble CDR features over a date window from the partial aggregate store (see cdr_partials_spark), e.g. for
+        rolling windows, without rescanning the CDR. Features that depend on the sequence of interactions cannot be
+        assembled from partial aggregates, see all_spark_partials. Features of a window are reused as long as the
+        partial aggregates of its days are unchanged
+
+        Args:
+            start_date: first day of the window, e.g. '2020-01-01'
+            end_date: last day of the window, e.g. '2020-03-31'
+        """
+        path = self.outputs + '/datasets/cdr_partials'
+        if not os.path.isfile(path + '/manifest.json'):
+            raise ValueError('CDR partial aggregates must be computed to calculate CDR features over a window.')
+        with open(path + '/manifest.json', 'r') as f:
+            manifest = json.load(f)
+        window = [str(day.date()) for day in pd.date_range(start_date, end_date)]
+        missing = [day for day in window if day not in manifest['days']]
+        if missing:
+            print('Warning: %i days of the window are not in the partial aggregates' % len(missing))
+
+        # The features of the window only change with the partial aggregates of its days and the antennas
+        dataset = 'cdr_features_spark/' + start_date + '_' + end_date
+        key = stage_fingerprint([manifest['fingerprint'], self.ds.fingerprint('antennas')], 'cdr_features_window',
+                                {day: manifest['days'][day] for day in window if day in manifest['days']})
+        if self._load_cached_features('cdr', dataset, key):
+            return
+        print('Calculating CDR features from %s to %s...' % (start_date, end_date))
+
+        partials = {name: self.spark.read.parquet(path + '/' + name)
+                    .where((col('day') >= pd.to_datetime(start_date)) & (col('day') <= pd.to_datetime(end_date)))
+                    for name in ['interactions', 'durations']}
+        cdr_features = all_spark_partials(partials, self.ds.antennas, cfg=self.cfg.params.cdr,
+                                          accuracy=self._partials_accuracy())
+        cdr_features_df = wide_join_pyspark(cdr_features, on='caller_id', how='outer')
         cdr_features_df = cdr_features_df.withColumnRenamed('caller_id', 'name')
 
-        save_df(cdr_features_df, self.outputs + '/datasets/cdr_features_spark/all.csv')
-        self.features['cdr'] = self.spark.read.csv(self.outputs + '/datasets/cdr_features_spark/all.csv',
-                                                   header=True, inferSchema=True)
+        self._save_features('cdr', dataset, cdr_features_df, key)
+
+    def _partials_accuracy(self) -> float:
+        """
+        Relative accuracy of the sketches of call durations in CDR partial aggregates: the sketch error if set, 1%
+        otherwise
+        """
+        cfg = self.cfg.params.cdr
+        return cfg.sketch_error if 'sketch_error' in cfg and cfg.sketch_error is not None else 0.01
 
     def international_features(self) -> None:
         # Check that CDR is present to calculate international features
         if self.ds.cdr is None:
             raise ValueError('CDR file must be loaded to calculate international features.')
+        key = self._features_fingerprint('international_feats')
+        if self._load_cached_features('international', 'international_feats', key):
+            return
         print('Calculating international features...')
 
         # Write international transactions to file
@@ -298,9 +436,7 @@ class Featurizer:
         feats_df= long_join_pandas(feats, on='caller_id', how='outer').rename({'caller_id': 'name'}, axis=1)
         feats_df['name'] = feats_df.index
         feats_df.columns = [c if c == 'name' else 'international_' + c for c in feats_df.columns]
-        feats_df.to_csv(self.outputs + '/datasets/international_feats.csv', index=False)
-        self.features['international'] = self.spark.read.csv(self.outputs + '/datasets/international_feats.csv',
-                                                             header=True, inferSchema=True)
+        self._save_features('international', 'international_feats', self.spark.createDataFrame(feats_df), key)
 
     def location_features(self) -> None:
 
@@ -309,6 +445,9 @@ class Featurizer:
             raise ValueError('CDR file must be loaded to calculate spatial features.')
         if self.ds.antennas is None:
             raise ValueError('Antenna file must be loaded to calculate spatial features.')
+        key = self._features_fingerprint('location_features')
+        if self._load_cached_features('location', 'location_features', key):
+            return
         print('Calculating spatial features...')
 
         # If CDR is not available in bandicoot format, calculate it
@@ -366,15 +505,16 @@ class Featurizer:
         # Merge counts and unique counts together, write to file
         feats = count_by_region.merge(unique_regions, on='name', how='outer')
         feats.columns = [c if c == 'name' else 'location_' + c for c in feats.columns]
-        feats.to_csv(self.outputs + '/datasets/location_features.csv', index=False)
-        self.features['location'] = self.spark.read.csv(self.outputs + '/datasets/location_features.csv',
-                                                        header=True, inferSchema=True)
+        self._save_features('location', 'location_features', self.spark.createDataFrame(feats), key)
 
     def mobiledata_features(self) -> None:
 
         # Check that mobile internet data is loaded
         if self.ds.mobiledata is None:
             raise ValueError('Mobile data file must be loaded to calculate mobile data features.')
+        key = self._features_fingerprint('mobiledata_features')
+        if self._load_cached_features('mobiledata', 'mobiledata_features', key):
+            return
         print('Calculating mobile data features...')
 
         # Perform set of aggregations on mobile data 
@@ -389,14 +529,16 @@ class Featurizer:
         # Save to file
         feats = feats.withColumnRenamed('caller_id', 'name')
         feats = feats.toDF(*[c if c == 'name' else 'mobiledata_' + c for c in feats.columns])
-        self.features['mobiledata'] = feats
-        save_df(feats, self.outputs + '/datasets/mobiledata_features.csv')
+        self._save_features('mobiledata', 'mobiledata_features', feats, key)
 
     def mobilemoney_features(self) -> None:
 
         # Check that mobile money is loaded
         if self.ds.mobilemoney is None:
             raise ValueError('Mobile money file must be loaded to calculate mobile money features.')
+        key = self._features_fingerprint('mobilemoney_feats')
+        if self._load_cached_features('mobilemoney', 'mobilemoney_feats', key):
+            return
         print('Calculating mobile money features...')
 
         # Get outgoing transactions
@@ -468,16 +610,17 @@ class Featurizer:
             features.append(aggs)
 
         # Combine all mobile money features together and save them
-        feats = long_join_pyspark(features, on='name', how='outer')
+        feats = wide_join_pyspark(features, on='name', how='outer')
         feats = feats.toDF(*[c if c == 'name' else 'mobilemoney_' + c for c in feats.columns])
-        save_df(feats, self.outputs + '/datasets/mobilemoney_feats.csv')
-        self.features['mobilemoney'] = self.spark.read.csv(self.outputs + '/datasets/mobilemoney_feats.csv',
-                                                           header=True, inferSchema=True)
+        self._save_features('mobilemoney', 'mobilemoney_feats', feats, key)
 
     def recharges_features(self) -> None:
 
         if self.ds.recharges is None:
             raise ValueError('Recharges file must be loaded to calculate recharges features.')
+        key = self._features_fingerprint('recharges_feats')
+        if self._load_cached_features('recharges', 'recharges_feats', key):
+            return
         print('Calculating recharges features...')
 
         feats = self.ds.recharges.groupby('caller_id').agg(sum('amount').alias('sum'),
@@ -489,44 +632,45 @@ class Featurizer:
 
         feats = feats.withColumnRenamed('caller_id', 'name')
         feats = feats.toDF(*[c if c == 'name' else 'recharges_' + c for c in feats.columns])
-        save_df(feats, self.outputs + '/datasets/recharges_feats.csv')
-        self.features['recharges'] = self.spark.read.csv(self.outputs + '/datasets/recharges_feats.csv',
-                                                         header=True, inferSchema=True)
+        self._save_features('recharges', 'recharges_feats', feats, key)
 
     def load_features(self) -> None:
         """
-        Load features from disk if already computed
+        Load features from disk if already computed from the same data, parameters and code; features that are out of
+        date are not loaded
         """
         data_path = self.outputs + '/datasets/'
 
         features = ['cdr', 'cdr', 'international', 'location', 'mobiledata', 'mobilemoney', 'recharges']
-        datasets = ['/bandicoot_features/all', 'cdr_features_spark/all', 'international_feats', 'location_features',
+        datasets = ['bandicoot_features/all', 'cdr_features_spark/all', 'international_feats', 'location_features',
                     'mobiledata_features', 'mobilemoney_feats', 'recharges_feats']
         # Read data from disk if requested
         for feature, dataset in zip(features, datasets):
             if not self.features[feature]:
-                try:
-                    self.features[feature] = self.spark.read.csv(data_path + dataset + '.csv',
-                                                                 header=True, inferSchema=True)
-                except AnalysisException:
-                    print(f"Could not locate or read data for '{dataset}'")
+                if not os.path.isdir(data_path + dataset + '.parquet'):
+                    print(f"Could not locate data for '{dataset}'")
+                elif not self._load_cached_features(feature, dataset, self._features_fingerprint(dataset)):
+                    print(f"Data for '{dataset}' was computed from other data, parameters or code: recompute it")
 
-    def all_features(self, read_from_disk: bool = False) -> None:
+    def all_features(self, read_from_disk: bool = False, csv: bool = False) -> None:
         """
-        Join all feature datasets together, save to disk, and assign to attribute
+        Join all feature datasets together, save to the feature store, and assign to attribute
 
         Args:
             read_from_disk: whether to load features from disk
+            csv: whether to also export the features to a single csv file, features.csv
         """
         if read_from_disk:
             self.load_features()
 
-        all_features_list = [self.features[key] for key in self.features.keys() if self.features[key] is not None]
+        all_features_list = [self.features[key] for key in self.features.keys()
+                             if key != 'all' and self.features[key] is not None]
         if all_features_list:
-            all_features = long_join_pyspark(all_features_list, how='left', on='name')
-            save_df(all_features, self.outputs + '/datasets/features.csv')
-            self.features['all'] = self.spark.read.csv(self.outputs + '/datasets/features.csv',
-                                                       header=True, inferSchema=True)
+            all_features = wide_join_pyspark(all_features_list, how='left', on='name')
+            save_feature_block(all_features, self.outputs + '/datasets/features.parquet', 'all')
+            self.features['all'] = load_feature_block(self.cfg, self.outputs + '/datasets/features.parquet')
+            if csv:
+                export_csv(self.features['all'], self.outputs + '/datasets/features.parquet')
         else:
             print('No features have been computed yet.')
 
@@ -2,6 +2,7 @@
 from collections import defaultdict
 from datastore import DataStore, DataType
 import geopandas as gpd  # type: ignore[import]
+from helpers.cache_utils import is_cached, stage_fingerprint, write_fingerprint
 from helpers.utils import get_spark_session, make_dir
 from helpers.plot_utils import voronoi_tessellation
 import matplotlib.pyplot as plt  # type: ignore[import]
@@ -42,14 +43,17 @@ class HomeLocator:
         spark = get_spark_session(self.cfg)
         self.spark = spark
 
-        # Load data into datastore
+        # Register data in datastore, to be loaded when first accessed
         dataframes = dataframes if dataframes else defaultdict(lambda: None)
         data_type_map = {DataType.CDR: dataframes['cdr'],
                          DataType.ANTENNAS: dataframes['antennas'],
                          DataType.SHAPEFILES: None,
                          DataType.HOME_GROUND_TRUTH: None,
                          DataType.POVERTY_SCORES: None}
-        self.ds.load_data(data_type_map=data_type_map)
+        self.ds.load_data(data_type_map=data_type_map, lazy=True)
+
+        # Fingerprint of the CDR before it is reshaped, to identify home locations computed from the same data
+        self.cdr_fingerprint = stage_fingerprint([self.ds.fingerprint('cdr')], 'home_location', self.ds.filter_hours)
 
         # Clean and merge CDR data
         outgoing = (self.ds.cdr
@@ -81,6 +85,19 @@ class HomeLocator:
 
         Returns: pandas df with inferred home location for each user
         """
+        # Reuse home locations computed from the same data, with the same parameters and code
+        fname = self.outputs + '/outputs/' + geo + '_' + algo + '.csv'
+        inputs = [self.cdr_fingerprint]
+        if geo == 'tower_id':
+            inputs.append(self.ds.fingerprint('antennas'))
+        elif geo in self.ds.shapefiles.keys():
+            inputs.extend([self.ds.fingerprint('antennas'), self.ds.fingerprint('shapefiles')])
+        key = stage_fingerprint(inputs, geo, algo)
+        if is_cached(fname, key):
+            grouped_df = pd.read_csv(fname, dtype={self.user_id: str, geo: str})
+            self.home_locations[(geo, algo)] = grouped_df
+            return grouped_df
+
         # Get tower ID for each transaction
         if geo == 'tower_id':
             if 'tower_id' not in self.ds.cdr.columns:
@@ -141,7 +158,8 @@ class HomeLocator:
                              'or count_modal_days')
 
         grouped_df = grouped.toPandas()
-        grouped_df.to_csv(self.outputs + '/outputs/' + geo + '_' + algo + '.csv', index=False)
+        grouped_df.to_csv(fname, index=False)
+        write_fingerprint(fname, key)
         self.home_locations[(geo, algo)] = grouped_df
         return grouped_df
 
@@ -1,4 +1,5 @@
 from autogluon.tabular import TabularPredictor  # type: ignore[import]
+from helpers.io_utils import source_files
 from helpers.utils import make_dir
 from helpers.plot_utils import clean_plot
 from helpers.ml_utils import auc_overall, DropMissing, load_model, metrics, Winsorizer
@@ -20,7 +21,7 @@ from sklearn.linear_model import LinearRegression, Lasso, Ridge  # type: ignore[
 from sklearn.model_selection import cross_validate, KFold, GridSearchCV, cross_val_predict, cross_val_score  # type: ignore[import]
 from sklearn.pipeline import Pipeline  # type: ignore[import]
 from sklearn.preprocessing import StandardScaler, OneHotEncoder, MinMaxScaler  # type: ignore[import]
-from typing import Dict, Optional, Tuple
+from typing import Dict, Iterator, Optional, Tuple
 
 
 class Learner:
@@ -331,14 +332,8 @@ class Learner:
         subdir = '/' + kind + '_models/'
         model_name, model = load_model(model_name, out_path=self.outputs, kind=kind)
 
-        columns = pd.read_csv(self.cfg.path.features, nrows=1).columns
-
-        chunksize = int(len(pd.read_csv(self.cfg.path.features, usecols=['name'])) / n_chunks)
-
         results = []
-        for chunk in range(n_chunks):
-            x = pd.read_csv(self.cfg.path.features, skiprows=1 + chunk * chunksize, nrows=chunksize, header=None)
-            x.columns = columns
+        for x in self._feature_chunks(n_chunks):
             results_chunk = x[['name']].copy()
             results_chunk['predicted'] = model.predict(x[self.ds.x.columns])
             results.append(results_chunk)
@@ -347,6 +342,33 @@ class Learner:
         results_df.to_csv(self.outputs + subdir + model_name + '/population_predictions.csv', index=False)
         return results_df
 
+    def _feature_chunks(self, n_chunks: int) -> Iterator[PandasDataFrame]:
+        """
+        Read the features of the full population in chunks, either from the feature store, where chunks are groups of
+        the files the features are written to, or from a csv export
+
+        Args:
+            n_chunks: The number of chunks to divide the full population dataset in.
+
+        Returns: Iterator over pandas dfs of features.
+        """
+        if not self.cfg.path.features.endswith('.csv'):
+            files = source_files(self.cfg.path.features)
+            if not files:
+                raise FileNotFoundError('No data files found at ' + self.cfg.path.features)
+            for chunk in np.array_split(np.array(files), min(n_chunks, len(files))):
+                yield pd.concat([pd.read_parquet(f) for f in chunk], ignore_index=True)
+            return
+
+        columns = pd.read_csv(self.cfg.path.features, nrows=1).columns
+
+        chunksize = int(len(pd.read_csv(self.cfg.path.features, usecols=['name'])) / n_chunks)
+
+        for chunk in range(n_chunks):
+            x = pd.read_csv(self.cfg.path.features, skiprows=1 + chunk * chunksize, nrows=chunksize, header=None)
+            x.columns = columns
+            yield x
+
     def scatter_plot(self, model_name: str, kind: str = 'tuned') -> None:
         """
         Charts the out-of-sample predictions and the true values as a scatter plot, computes the correlation coefficient
@@ -39,12 +39,12 @@ class Satellite:
         spark = get_spark_session(self.cfg)
         self.spark = spark
 
-        # Load data into datastore
+        # Register data in datastore, to be loaded when first accessed
         dataframes = dataframes if dataframes else defaultdict(lambda: None)
         data_type_map = {DataType.ANTENNAS: dataframes['antennas'],
                          DataType.SHAPEFILES: None,
                          DataType.RWI: None}
-        self.ds.load_data(data_type_map=data_type_map)
+        self.ds.load_data(data_type_map=data_type_map, lazy=True)
 
     def aggregate_scores(self,  geo: str, dataset: str = 'rwi') -> None:
         """
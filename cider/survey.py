@@ -46,9 +46,9 @@ class SurveyOutcomeGenerator:
                     grid[key2] = self.grids[key1][key2]
             self.grids[key1] = grid
 
-        # Load data into datastore
+        # Register data in datastore, to be loaded when first accessed
         data_type_map = {DataType.SURVEY_DATA: dataframe}
-        self.ds.load_data(data_type_map=data_type_map)
+        self.ds.load_data(data_type_map=data_type_map, lazy=True)
 
     def asset_index(self, cols: List[str], use_weights: bool = True) -> PandasDataFrame:
         """
@@ -1,13 +1,12 @@
 # TODO: parallelize lasso and forward selection
 from datastore import DataStore, DataType
 from helpers.plot_utils import clean_plot, mtick
-from helpers.ml_utils import confusion_matrix, strictly_increasing
-from helpers.utils import make_dir
+from helpers.utils import make_dir, strictly_increasing, weighted_corr
+from helpers.weighted_utils import confusion_matrix, roc_inputs, share_below, targeted_weights, weighted_spearman
 import matplotlib.pyplot as plt  # type: ignore[import]
 import numpy as np
 import pandas as pd
 from pandas import DataFrame as PandasDataFrame
-from scipy.stats import spearmanr  # type: ignore[import]
 import seaborn as sns  # type: ignore[import]
 from sklearn.metrics import roc_auc_score, roc_curve, auc  # type: ignore[import]
 from typing import Dict, List, Optional, Tuple, Union
@@ -24,9 +23,9 @@ class Targeting:
         make_dir(self.outputs, clean_folders)
         self.default_colors = sns.color_palette('Set2', 100)
 
-        # Load data into datastore
+        # Register data in datastore, to be loaded when first accessed
         data_type_map = {DataType.TARGETING: None}
-        self.ds.load_data(data_type_map=data_type_map)
+        self.ds.load_data(data_type_map=data_type_map, lazy=True)
 
     @staticmethod
     def threshold_to_percentile(p: Optional[Union[float, int]],
@@ -36,7 +35,7 @@ class Targeting:
                                 test_percentiles: bool = True) -> Union[float, int]:
         """
         If a percentile is provided, checks if it's between 0 and 100 and if so returns it; if a threshold is provided,
-        returns the fraction of records in the dataset and for column 'var' that are below the threshold.
+        returns the (weighted) fraction of records in the dataset and for column 'var' that are below the threshold.
 
         Args:
             p: The percentile.
@@ -62,17 +61,20 @@ class Targeting:
         
         # If t is provided, convert threshold to percentile
         if t is not None:
-            p = 100*(len(data[data[var] < t])/len(data))
+            weights = data['weight'] if 'weight' in data.columns else np.ones(len(data))
+            p = share_below(data[var].values, weights, t)
         
         return p
 
     def pearson(self, var1: str, var2: str, weighted: bool = False) -> float:
         data = self.ds.weighted_targeting if weighted else self.ds.unweighted_targeting
-        return np.corrcoef(data[var1].astype('float'), data[var2].astype('float'))[0][1]
+        return weighted_corr(data[var1].astype('float').values, data[var2].astype('float').values,
+                             data['weight'].astype('float').values)
 
     def spearman(self, var1: str, var2: str, weighted: bool = False) -> float:
         data = self.ds.weighted_targeting if weighted else self.ds.unweighted_targeting
-        return spearmanr(data[var1].astype('float'), data[var2].astype('float'))[0]
+        return weighted_spearman(data[var1].astype('float').values, data[var2].astype('float').values,
+                                 data['weight'].astype('float').values)
 
     def binary_metrics(self, var1: str, var2: str,
                        p1: Union[int, float], p2: Optional[Union[int, float]],
@@ -101,29 +103,16 @@ class Targeting:
         p1 = self.threshold_to_percentile(p1, t1, data, var1)
         p2 = self.threshold_to_percentile(p2, t2, data, var2)
 
-        # Stack var1 and var2 together
-        a = np.vstack([data[var1].values.flatten(), data[var2].values.flatten()])
+        # Order by var1, assign targeted weight of each record
+        weights = data['weight'].astype('float').values
+        targeted1 = targeted_weights(data[var1].values, weights, p1)
 
-        # Order by var1, assign targeting
-        num_ones = int((p1/100)*len(data))
-        num_zeros = len(data) - num_ones
-        targeting_vector = np.concatenate([np.ones(num_ones), np.zeros(num_zeros)])
-        a = a[:, a[0, :].argsort()]
-        a[0, :] = targeting_vector
-
-        # Reshuffle
+        # Order by var2 (breaking ties at random), assign targeted weight of each record
         np.random.seed(1)
-        a = a[:, np.random.rand(a.shape[1]).argsort()]
-    
-        # Order by var2, assign targeting
-        num_ones = int((p2/100)*len(data))
-        num_zeros = len(data) - num_ones
-        targeting_vector = np.concatenate([np.ones(num_ones), np.zeros(num_zeros)])
-        a = a[:, a[1, :].argsort()]
-        a[1, :] = targeting_vector
+        targeted2 = targeted_weights(data[var2].values, weights, p2, tiebreak=np.random.rand(len(data)))
 
         # Calculate confusion matrix and from there the binary metrics
-        tn, fp, fn, tp = confusion_matrix(a[0, :], a[1, :]).ravel()
+        tn, fp, fn, tp = confusion_matrix(targeted1, targeted2, weights)
         results['accuracy'] = (tp + tn)/(tp + tn + fp + fn)
         results['precision'] = tp/(tp + fp)
         results['recall'] = tp/(tp + fn)
@@ -152,19 +141,14 @@ class Targeting:
         # If threshold is provided, convert to percentile
         p = self.threshold_to_percentile(p, t, data, var1)
 
-        # Stack var1 and var2 together
-        a = np.vstack([data[var1].astype('float').values.flatten(), data[var2].astype('float').values.flatten()])
-
-        # Order by var1, assign targeting
-        num_ones = int((p/100)*len(data))
-        num_zeros = len(data) - num_ones
-        targeting_vector = np.concatenate([np.ones(num_ones), np.zeros(num_zeros)])
-        a = a[:, a[0, :].argsort()]
-        a[0, :] = targeting_vector
+        # Order by var1, assign targeted weight of each record
+        weights = data['weight'].astype('float').values
+        targeted = targeted_weights(data[var1].astype('float').values, weights, p)
 
-        # Record AUC, FPR grid, and TPR grid
-        results['auc'] = roc_auc_score(a[0, :], -a[1, :])
-        roc = roc_curve(a[0, :], -a[1, :])
+        # Record AUC, FPR grid, and TPR grid, weighting the targeted and non-targeted parts of each record
+        labels, scores, sample_weights = roc_inputs(targeted, -data[var2].astype('float').values, weights)
+        results['auc'] = roc_auc_score(labels, scores, sample_weight=sample_weights)
+        roc = roc_curve(labels, scores, sample_weight=sample_weights)
         results['fpr'] = roc[0]
         results['tpr'] = roc[1]
 
@@ -227,18 +211,18 @@ class Targeting:
 
         """
         data = self.ds.weighted_targeting if weighted else self.ds.unweighted_targeting
-        data = data[[var1, var2]].sort_values(var2, ascending=True)
+        data = data[[var1, var2, 'weight']].copy()
 
         # If threshold is provided, convert to percentile
         p = self.threshold_to_percentile(p, t, data, var1, test_percentiles=False)
 
-        # Calculate who is targeted
-        num_targeted = int((p/100)*len(data))
-        data['targeted'] = np.concatenate([np.ones(num_targeted), np.zeros(len(data) - num_targeted)])
+        # Calculate targeted weight of each record
+        data['targeted'] = targeted_weights(data[var2].values, data['weight'].values, p)
 
-        # Calculate total utility based on ground truth poverty and benefits
-        data['benefits'] = data['targeted']*transfer_size
-        data['utility'] = ((data[var1] + data['benefits'])**(1-rho))/(1-rho)
+        # Calculate total utility based on ground truth poverty and benefits, for targeted and non-targeted weight
+        utility_targeted = ((data[var1] + transfer_size)**(1-rho))/(1-rho)
+        utility_not_targeted = (data[var1]**(1-rho))/(1-rho)
+        data['utility'] = data['targeted']*utility_targeted + (data['weight'] - data['targeted'])*utility_not_targeted
 
         return data['utility'].sum()
     
@@ -434,14 +418,15 @@ class Targeting:
         data = self.ds.weighted_targeting if weighted else self.ds.unweighted_targeting
 
         # Set up grid and results 
-        budget = ubi_transfer_size*len(data)
+        population = data['weight'].sum()
+        budget = ubi_transfer_size*population
         grid = np.linspace(1, 100, n_grid)
         utilities: Dict[str, List[float]] = {proxy: [] for proxy in proxies}
         transfer_sizes = []
 
         # Calculate utility and transfer size for each proxy and each value in grid
         for p in grid:
-            num_targeted = int(len(data)*(p/100))
+            num_targeted = int(population*(p/100))
             transfer_size = budget/num_targeted
             transfer_sizes.append(transfer_size)
             for proxy in proxies:
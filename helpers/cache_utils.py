@@ -0,0 +1,97 @@
+"""
+Cache of intermediate outputs (daily profiles, spammers, feature blocks, home locations): each output is stored with a
+fingerprint of its inputs, parameters and code version, and is only reused if the fingerprint still matches.
+"""
+from functools import lru_cache
+import glob
+import hashlib
+import json
+import os
+from typing import Any, List, Optional
+
+
+def fingerprint(*parts: Any) -> str:
+    """
+    Hash json-serializable parts (input fingerprints, parameters, ...) into a fingerprint
+
+    Returns: hex digest
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def stage_fingerprint(inputs: List[Optional[str]], *params: Any) -> Optional[str]:
+    """
+    Fingerprint of a stage's output, from the fingerprints of its inputs, its parameters and the code version
+
+    Args:
+        inputs: fingerprints of the datasets the stage reads; None for datasets whose content is unknown, e.g. dfs
+            provided directly
+        params: parameters of the stage
+
+    Returns: fingerprint, or None if any of the inputs is unknown, in which case the output cannot be reused
+    """
+    if any(i is None for i in inputs):
+        return None
+    return fingerprint(inputs, params, code_version())
+
+
+@lru_cache(maxsize=None)
+def code_version() -> str:
+    """
+    Fingerprint of the source code of the cider and helpers packages, so that cached outputs are invalidated when the
+    code that produced them changes
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    digest = hashlib.sha256()
+    paths = glob.glob(os.path.join(root, 'cider', '*.py')) + glob.glob(os.path.join(root, 'helpers', '*.py'))
+    for path in sorted(paths):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def files_fingerprint(paths: List[str]) -> List[List[Any]]:
+    """
+    Describe files by path, size and modification time, e.g. for inputs that are not raw datasets such as shapefiles
+    """
+    return [[os.path.abspath(path), os.stat(path).st_size, os.stat(path).st_mtime] for path in paths]
+
+
+def fingerprint_path(fname: str) -> str:
+    """
+    Path of the fingerprint file stored alongside a cached output, e.g. features.csv -> features.fingerprint
+    """
+    return os.path.splitext(fname)[0] + '.fingerprint'
+
+
+def is_cached(fname: str, key: Optional[str]) -> bool:
+    """
+    Check whether an output on disk was produced with the given fingerprint
+
+    Args:
+        fname: path to the output
+        key: fingerprint of the output to produce, None if unknown
+
+    Returns: True if the output can be reused
+    """
+    if key is None or not os.path.exists(fname) or not os.path.isfile(fingerprint_path(fname)):
+        return False
+    with open(fingerprint_path(fname), 'r') as f:
+        return f.read() == key
+
+
+def write_fingerprint(fname: str, key: Optional[str]) -> None:
+    """
+    Store the fingerprint of an output next to it; if the fingerprint is unknown, any previous one is removed so that
+    the output is never reused
+
+    Args:
+        fname: path to the output
+        key: fingerprint of the output
+    """
+    if key is None:
+        if os.path.isfile(fingerprint_path(fname)):
+            os.remove(fingerprint_path(fname))
+        return
+    with open(fingerprint_path(fname), 'w') as f:
+        f.write(key)
@@ -1,21 +1,60 @@
 from box import Box
 from helpers.features_utils import *
-
-
-def all_spark(df: SparkDataFrame, antennas: SparkDataFrame, cfg: Box) -> List[SparkDataFrame]:
-    """
-    Compute cdr features starting from raw interaction data
+from helpers.sketch_utils import quantile_sketch, sketch_quantile
+from typing import Any, Dict, List, Optional
+
+SUMMARY_STATS = ['mean', 'std', 'median', 'skewness', 'kurtosis', 'min', 'max']
+
+# Features that aggregate the prepared CDR directly, computed together by aggregate_features: for each feature, the
+# columns to group by, the columns with an "all interactions" category (see add_all_cat), an optional condition on the
+# grouping columns, the aggregations as spark sql expressions by name, the columns to pivot, in order, and the values
+# of pivot columns where they differ from PIVOT_VALUES
+FUSED_FEATURES: Dict[str, Dict[str, Any]] = {
+    'active_days': {'by': ['caller_id'], 'cols': 'week_day',
+                    'aggs': {'active_days': 'count(DISTINCT day)'},
+                    'columns': ['weekday', 'daytime']},
+    'number_of_contacts': {'by': ['caller_id', 'txn_type'], 'cols': 'week_day',
+                           'aggs': {'number_of_contacts': 'count(DISTINCT recipient_id)'},
+                           'columns': ['weekday', 'daytime', 'txn_type']},
+    'call_duration': {'by': ['caller_id', 'txn_type'], 'cols': 'week_day', 'where': "txn_type = 'call'",
+                      'aggs': {name: summary_stats_exprs('duration')[name] for name in SUMMARY_STATS},
+                      'columns': ['weekday', 'daytime', 'txn_type'], 'pivot_values': {'txn_type': ['call']}},
+    'percent_nocturnal': {'by': ['caller_id', 'txn_type'], 'cols': 'week',
+                          'aggs': {'percent_nocturnal':
+                                   "sum(CASE WHEN daytime = 'night' THEN interactions ELSE 0 END) / sum(interactions)"},
+                          'columns': ['weekday', 'txn_type']},
+    'percent_initiated_interactions': {'by': ['caller_id', 'txn_type'], 'cols': 'week_day',
+                                       'where': "txn_type = 'call'",
+                                       'aggs': {'percent_initiated_interactions':
+                                                "sum(CASE WHEN direction = 'out' THEN interactions ELSE 0 END) / "
+                                                "sum(interactions)"},
+                                       'columns': ['weekday', 'daytime']},
+    'number_of_interactions': {'by': ['caller_id', 'txn_type'], 'cols': 'week_day_dir',
+                               'aggs': {'n': 'sum(interactions)'},
+                               'columns': ['direction', 'weekday', 'daytime', 'txn_type']},
+    'number_of_antennas': {'by': ['caller_id'], 'cols': 'week_day',
+                           'aggs': {'n_antennas': 'count(DISTINCT caller_antenna)'},
+                           'columns': ['weekday', 'daytime']}
+}
+
+
+def prepare_cdr(df: SparkDataFrame, cfg: Box) -> SparkDataFrame:
+    """
+    Prepare raw interaction data for the computation of cdr features: add weekday and daytime columns, duplicate rows
+    so that each interaction appears from the point of view of both parties, and tag conversations. The result is
+    partitioned by caller_id, so that the groupbys and windows of the feature functions, which all include caller_id,
+    do not need to shuffle it again
+
+    Each row also counts as one interaction ('interactions' column): features based on counts of interactions weigh
+    rows by it, so that they can be computed from partial aggregates as well (see daily_partials)
 
     Args:
         df: spark dataframe with cdr interactions
-        antennas: spark dataframe with antenna ids and coordinates
         cfg: config object
 
     Returns:
-        features: list of features as spark dataframes
+        df: prepared spark dataframe
     """
-    features = []
-
     df = (df
           # Add weekday and daytime columns for subsequent groupby(s)
           .withColumn('weekday', F.when(F.dayofweek('day').isin(cfg.weekend), 'weekend').otherwise('weekday'))
@@ -34,28 +73,58 @@ def all_spark(df: SparkDataFrame, antennas: SparkDataFrame, cfg: Box) -> List[Sp
                       F.when(col('direction') == 'in', col('recipient_antenna')).otherwise(col('caller_antenna')))
           .withColumn('recipient_antenna',
                       F.when(col('direction') == 'in', col('caller_antenna_copy')).otherwise(col('recipient_antenna')))
-          .drop('directions', 'caller_id_copy', 'recipient_antenna_copy'))
+          .drop('directions', 'caller_id_copy', 'caller_antenna_copy')
+          .withColumn('interactions', lit(1))
+          .repartition('caller_id'))
 
     # Assign interactions to conversations if relevant
     df = tag_conversations(df)
 
+    return df
+
+
+def all_spark(df: SparkDataFrame, antennas: SparkDataFrame, cfg: Box, prepared: bool = False) -> List[SparkDataFrame]:
+    """
+    Compute cdr features starting from raw interaction data
+
+    Args:
+        df: spark dataframe with cdr interactions
+        antennas: spark dataframe with antenna ids and coordinates
+        cfg: config object
+        prepared: whether df is already the output of prepare_cdr, e.g. persisted so that all feature functions share
+            a single computation of it
+
+    Returns:
+        features: list of features as spark dataframes
+    """
+    features = []
+
+    if not prepared:
+        df = prepare_cdr(df, cfg)
+
+    # Approximate distinct counts and quantiles, if requested
+    sketch_error = cfg.sketch_error if 'sketch_error' in cfg else None
+
+    # Compute the features that aggregate the CDR directly all at once
+    fused = dict(zip(FUSED_FEATURES, aggregate_features(df, list(FUSED_FEATURES), sketch_error=sketch_error)))
+
     # Compute features and append them to list
-    features.append(active_days(df))
-    features.append(number_of_contacts(df))
-    features.append(call_duration(df))
-    features.append(percent_nocturnal(df))
+    features.append(fused['active_days'])
+    features.append(fused['number_of_contacts'])
+    features.append(fused['call_duration'])
+    features.append(fused['percent_nocturnal'])
     features.append(percent_initiated_conversations(df))
-    features.append(percent_initiated_interactions(df))
-    features.append(response_delay_text(df))
+    features.append(fused['percent_initiated_interactions'])
+    features.append(response_delay_text(df, sketch_error=sketch_error))
     features.append(response_rate_text(df))
     features.append(entropy_of_contacts(df))
-    features.append((balance_of_contacts(df)))
-    features.append(interactions_per_contact(df))
-    features.append(interevent_time(df))
+    features.append((balance_of_contacts(df, sketch_error=sketch_error)))
+    features.append(interactions_per_contact(df, sketch_error=sketch_error))
+    features.append(interevent_time(df, sketch_error=sketch_error))
     features.append(percent_pareto_interactions(df))
     features.append((percent_pareto_durations(df)))
-    features.append(number_of_interactions(df))
-    features.append(number_of_antennas(df))
+    features.append(fused['number_of_interactions'])
+    features.append(fused['number_of_antennas'])
     features.append(entropy_of_antennas(df))
     features.append(radius_of_gyration(df, antennas))
     features.append(frequent_antennas(df))
@@ -64,52 +133,201 @@ def all_spark(df: SparkDataFrame, antennas: SparkDataFrame, cfg: Box) -> List[Sp
     return features
 
 
-def active_days(df: SparkDataFrame) -> SparkDataFrame:
+def daily_partials(df: SparkDataFrame, cfg: Box, accuracy: float,
+                   prepared: bool = False) -> Dict[str, SparkDataFrame]:
     """
-    Returns the number of active days per user, disaggregated by type and time of day
+    Compute per-user, per-day partial aggregates of cdr interactions, from which the features of any date window can be
+    assembled by merging those of the days in the window (see all_spark_partials)
+
+    Args:
+        df: spark dataframe with cdr interactions
+        cfg: config object
+        accuracy: relative accuracy of the sketches of call durations, from which their medians are estimated
+        prepared: whether df is already the output of prepare_cdr
+
+    Returns:
+        partials: {'interactions': number of interactions and total duration by user, contact, antenna, day, type and
+            time of day, transaction type and direction; 'durations': number of calls, sums of powers, min, max and
+            quantile sketch of call durations by user, day, and type and time of day}
     """
-    df = add_all_cat(df, cols='week_day')
+    if not prepared:
+        df = prepare_cdr(df, cfg)
 
-    out = (df
-           .groupby('caller_id', 'weekday', 'daytime')
-           .agg(F.countDistinct('day').alias('active_days')))
+    interactions = (df
+                    .groupby('caller_id', 'recipient_id', 'caller_antenna', 'day', 'weekday', 'daytime', 'txn_type',
+                             'direction')
+                    .agg(F.sum('interactions').alias('interactions'),
+                         F.sum('duration').alias('duration')))
 
-    out = pivot_df(out, index=['caller_id'], columns=['weekday', 'daytime'], values=['active_days'],
-                   indicator_name='active_days')
+    keys = ['caller_id', 'day', 'weekday', 'daytime']
+    calls = df.where(col('txn_type') == 'call')
+    durations = (calls
+                 .groupby(*keys)
+                 .agg(F.count('duration').alias('calls'),
+                      *[F.sum(col('duration').cast('double')**power).alias(f'duration_{power}')
+                        for power in range(1, 5)],
+                      F.min('duration').alias('duration_min'),
+                      F.max('duration').alias('duration_max'))
+                 .join(quantile_sketch(calls, keys, 'duration', accuracy, 'duration_sketch'), on=keys, how='left'))
 
-    return out
+    return {'interactions': interactions, 'durations': durations}
 
 
-def number_of_contacts(df: SparkDataFrame) -> SparkDataFrame:
+def all_spark_partials(partials: Dict[str, SparkDataFrame], antennas: SparkDataFrame, cfg: Box,
+                       accuracy: float) -> List[SparkDataFrame]:
     """
-    Returns the number of distinct contacts per user, disaggregated by type and time of day, and transaction type
+    Compute cdr features from partial aggregates, e.g. those of the days in a date window (see daily_partials). Features
+    that depend on the sequence of interactions (percent_initiated_conversations, response_delay_text,
+    response_rate_text and interevent_time) cannot be assembled from partial aggregates and are not computed
+
+    Args:
+        partials: partial aggregates, as returned by daily_partials
+        antennas: spark dataframe with antenna ids and coordinates
+        cfg: config object
+        accuracy: relative accuracy of the sketches of call durations
+
+    Returns:
+        features: list of features as spark dataframes
     """
-    df = add_all_cat(df, cols='week_day')
+    features = []
+    df = partials['interactions']
 
-    out = (df
-           .groupby('caller_id', 'weekday', 'daytime', 'txn_type')
-           .agg(F.countDistinct('recipient_id').alias('number_of_contacts')))
+    # Approximate distinct counts and quantiles, if requested
+    sketch_error = cfg.sketch_error if 'sketch_error' in cfg else None
 
-    out = pivot_df(out, index=['caller_id'], columns=['weekday', 'daytime', 'txn_type'], values=['number_of_contacts'],
-                   indicator_name='number_of_contacts')
+    # Compute the features that aggregate interactions directly all at once
+    names = [name for name in FUSED_FEATURES if name != 'call_duration']
+    fused = dict(zip(names, aggregate_features(df, names, sketch_error=sketch_error)))
 
-    return out
+    # Compute features and append them to list
+    features.append(fused['active_days'])
+    features.append(fused['number_of_contacts'])
+    features.append(call_duration_partials(partials['durations'], accuracy))
+    features.append(fused['percent_nocturnal'])
+    features.append(fused['percent_initiated_interactions'])
+    features.append(entropy_of_contacts(df))
+    features.append((balance_of_contacts(df, sketch_error=sketch_error)))
+    features.append(interactions_per_contact(df, sketch_error=sketch_error))
+    features.append(percent_pareto_interactions(df))
+    features.append((percent_pareto_durations(df)))
+    features.append(fused['number_of_interactions'])
+    features.append(fused['number_of_antennas'])
+    features.append(entropy_of_antennas(df))
+    features.append(radius_of_gyration(df, antennas))
+    features.append(frequent_antennas(df))
+    features.append(percent_at_home(df))
+
+    return features
+
+
+def aggregate_features(df: SparkDataFrame, names: List[str],
+                       sketch_error: Optional[float] = None) -> List[SparkDataFrame]:
+    """
+    Compute features defined in FUSED_FEATURES with a single aggregation: the grouping sets and aggregations of all
+    features are merged into one grouping sets query, from which the rows and columns of each feature are then selected
+    and pivoted. When the features are used in the same spark job, e.g. joined together, the shuffle of the aggregation
+    is reused by all of them
+
+    Args:
+        df: spark dataframe with prepared cdr interactions, see prepare_cdr
+        names: names of the features to compute
+        sketch_error: relative error of approximate distinct counts and quantiles, None for exact ones
+
+    Returns:
+        features: list of features as spark dataframes, in the same order as names
+    """
+    # Merge grouping sets, grouping columns and aggregations of all features
+    keys: List[str] = []
+    grouping_sets: List[List[str]] = []
+    all_values: Dict[str, str] = {}
+    aggs = []
+    for name in names:
+        spec = FUSED_FEATURES[name]
+        for grouping_set in all_cat_grouping_sets(spec['by'], spec['cols']):
+            keys += [key for key in grouping_set if key not in keys]
+            if grouping_set not in grouping_sets:
+                grouping_sets.append(grouping_set)
+        all_values.update(all_cat_mapping(spec['cols']))
+        aggs += [f'{approximate_sql(agg, sketch_error)} AS `{name}__{agg_name}`'
+                 for agg_name, agg in spec['aggs'].items()]
+
+    out = groupby_grouping_sets(df, keys, grouping_sets, aggs, all_values)
+
+    # Select each feature's grouping sets and aggregations, and pivot them
+    features = []
+    for name in names:
+        spec = FUSED_FEATURES[name]
+        ids = [grouping_set_id(keys, grouping_set) for grouping_set in all_cat_grouping_sets(spec['by'], spec['cols'])]
+        feature = out.where(col('grouping_id').isin(ids))
+        if 'where' in spec:
+            feature = feature.where(spec['where'])
+        feature = feature.select('caller_id', *spec['columns'],
+                                 *[col(f'{name}__{agg_name}').alias(agg_name) for agg_name in spec['aggs']])
+        features.append(pivot_df(feature, index=['caller_id'], columns=list(spec['columns']), values=list(spec['aggs']),
+                                 indicator_name=name,
+                                 pivot_values=spec['pivot_values'] if 'pivot_values' in spec else None))
+
+    return features
+
+
+def active_days(df: SparkDataFrame, sketch_error: Optional[float] = None) -> SparkDataFrame:
+    """
+    Returns the number of active days per user, disaggregated by type and time of day
+    """
+    return aggregate_features(df, ['active_days'], sketch_error=sketch_error)[0]
+
+
+def number_of_contacts(df: SparkDataFrame, sketch_error: Optional[float] = None) -> SparkDataFrame:
+    """
+    Returns the number of distinct contacts per user, disaggregated by type and time of day, and transaction type
+    """
+    return aggregate_features(df, ['number_of_contacts'], sketch_error=sketch_error)[0]
 
 
-def call_duration(df: SparkDataFrame) -> SparkDataFrame:
+def call_duration(df: SparkDataFrame, sketch_error: Optional[float] = None) -> SparkDataFrame:
     """
     Returns summary stats of users' call durations, disaggregated by type and time of day
     """
-    df = df.where(col('txn_type') == 'call')
-    df = add_all_cat(df, cols='week_day')
+    return aggregate_features(df, ['call_duration'], sketch_error=sketch_error)[0]
 
-    out = (df
-           .groupby('caller_id', 'weekday', 'daytime', 'txn_type')
-           .agg(*summary_stats('duration')))
+
+def call_duration_partials(df: SparkDataFrame, accuracy: float) -> SparkDataFrame:
+    """
+    Returns summary stats of users' call durations, disaggregated by type and time of day, from partial aggregates of
+    call durations (see daily_partials): moments are derived from the sums of powers of durations, and medians from the
+    merged quantile sketches
+
+    Args:
+        df: spark dataframe with partial aggregates of call durations
+        accuracy: relative accuracy of the quantile sketches
+    """
+    moments = (groupby_all_cat(df, by=['caller_id'], cols='week_day',
+                               aggs=['sum(calls) AS n'] + [f'sum(duration_{p}) AS s{p}' for p in range(1, 5)] +
+                                    ['min(duration_min) AS `min`', 'max(duration_max) AS `max`'])
+               .withColumn('mean', col('s1') / col('n'))
+               # Central moments, from sums of powers
+               .withColumn('m2', col('s2') - col('n') * col('mean')**2)
+               .withColumn('m3', col('s3') - 3 * col('mean') * col('s2') + 2 * col('n') * col('mean')**3)
+               .withColumn('m4', col('s4') - 4 * col('mean') * col('s3') + 6 * col('mean')**2 * col('s2') -
+                           3 * col('n') * col('mean')**4)
+               .withColumn('std', F.sqrt(F.greatest(col('m2'), lit(0)) / col('n')))
+               .withColumn('skewness', F.when(col('m2') > 0, F.sqrt(col('n')) * col('m3') / col('m2')**1.5))
+               .withColumn('kurtosis', F.when(col('m2') > 0, col('n') * col('m4') / col('m2')**2 - 3)))
+
+    # Merge the quantile sketches of all days, and of all types or times of day
+    sketches = df.select('caller_id', 'weekday', 'daytime', F.explode('duration_sketch').alias('bucket', 'n'))
+    medians = (groupby_all_cat(sketches, by=['caller_id', 'bucket'], cols='week_day', aggs=['sum(n) AS n'])
+               .groupby('caller_id', 'weekday', 'daytime')
+               .agg(F.map_from_entries(F.collect_list(F.struct('bucket', 'n'))).alias('duration_sketch'))
+               .withColumn('median', sketch_quantile('duration_sketch', 0.5, accuracy)))
+
+    out = (moments
+           .join(medians, on=['caller_id', 'weekday', 'daytime'], how='left')
+           .withColumn('txn_type', lit('call')))
 
     out = pivot_df(out, index=['caller_id'], columns=['weekday', 'daytime', 'txn_type'],
                    values=['mean', 'std', 'median', 'skewness', 'kurtosis', 'min', 'max'],
-                   indicator_name='call_duration')
+                   indicator_name='call_duration', pivot_values={'txn_type': ['call']})
 
     return out
 
@@ -118,30 +336,19 @@ def percent_nocturnal(df: SparkDataFrame) -> SparkDataFrame:
     """
     Returns the percentage of interactions done at night, per user, disaggregated by type of day and transaction type
     """
-    df = add_all_cat(df, cols='week')
-
-    out = (df
-           .withColumn('nocturnal', F.when(col('daytime') == 'night', 1).otherwise(0))
-           .groupby('caller_id', 'weekday', 'txn_type')
-           .agg(F.mean('nocturnal').alias('percent_nocturnal')))
-
-    out = pivot_df(out, index=['caller_id'], columns=['weekday', 'txn_type'], values=['percent_nocturnal'],
-                   indicator_name='percent_nocturnal')
-
-    return out
+    return aggregate_features(df, ['percent_nocturnal'])[0]
 
 
 def percent_initiated_conversations(df: SparkDataFrame) -> SparkDataFrame:
     """
     Returns the percentage of conversations initiated by the user, disaggregated by type and time of day
     """
-    df = add_all_cat(df, cols='week_day')
+    df = (df
+          .where(col('conversation') == col('timestamp').cast('long'))
+          .withColumn('initiated', F.when(col('direction') == 'out', 1).otherwise(0)))
 
-    out = (df
-           .where(col('conversation') == col('timestamp').cast('long'))
-           .withColumn('initiated', F.when(col('direction') == 'out', 1).otherwise(0))
-           .groupby('caller_id', 'weekday', 'daytime')
-           .agg(F.mean('initiated').alias('percent_initiated_conversations')))
+    out = groupby_all_cat(df, by=['caller_id'], cols='week_day',
+                          aggs=['avg(initiated) AS percent_initiated_conversations'])
 
     out = pivot_df(out, index=['caller_id'], columns=['weekday', 'daytime'], values=['percent_initiated_conversations'],
                    indicator_name='percent_initiated_conversations')
@@ -153,33 +360,21 @@ def percent_initiated_interactions(df: SparkDataFrame) -> SparkDataFrame:
     """
     Returns the percentage of interactions initiated by the user, disaggregated by type and time of day
     """
-    df = df.where(col('txn_type') == 'call')
-    df = add_all_cat(df, cols='week_day')
-
-    out = (df
-           .withColumn('initiated', F.when(col('direction') == 'out', 1).otherwise(0))
-           .groupby('caller_id', 'weekday', 'daytime')
-           .agg(F.mean('initiated').alias('percent_initiated_interactions')))
-
-    out = pivot_df(out, index=['caller_id'], columns=['weekday', 'daytime'], values=['percent_initiated_interactions'],
-                   indicator_name='percent_initiated_interactions')
-
-    return out
+    return aggregate_features(df, ['percent_initiated_interactions'])[0]
 
 
-def response_delay_text(df: SparkDataFrame) -> SparkDataFrame:
+def response_delay_text(df: SparkDataFrame, sketch_error: Optional[float] = None) -> SparkDataFrame:
     """
     Returns summary stats of users' delays in responding to texts, disaggregated by type and time of day
     """
     df = df.where(col('txn_type') == 'text')
-    df = add_all_cat(df, cols='week_day')
 
     w = Window.partitionBy('caller_id', 'recipient_id', 'conversation').orderBy('timestamp')
-    out = (df
-           .withColumn('prev_dir', F.lag(col('direction')).over(w))
-           .withColumn('response_delay', F.when((col('direction') == 'out') & (col('prev_dir') == 'in'), col('wait')))
-           .groupby('caller_id', 'weekday', 'daytime')
-           .agg(*summary_stats('response_delay')))
+    df = (df
+          .withColumn('prev_dir', F.lag(col('direction')).over(w))
+          .withColumn('response_delay', F.when((col('direction') == 'out') & (col('prev_dir') == 'in'), col('wait'))))
+
+    out = groupby_all_cat(df, by=['caller_id'], cols='week_day', aggs=summary_stats_sql('response_delay', sketch_error))
 
     out = pivot_df(out, index=['caller_id'], columns=['weekday', 'daytime'],
                    values=['mean', 'std', 'median', 'skewness', 'kurtosis', 'min', 'max'],
@@ -193,15 +388,14 @@ def response_rate_text(df: SparkDataFrame) -> SparkDataFrame:
     Returns the percentage of texts to which the users responded, disaggregated by type and time of day
     """
     df = df.where(col('txn_type') == 'text')
-    df = add_all_cat(df, cols='week_day')
 
     w = Window.partitionBy('caller_id', 'recipient_id', 'conversation')
-    out = (df
-           .withColumn('dir', F.when(col('direction') == 'out', 1).otherwise(0))
-           .withColumn('responded', F.max(col('dir')).over(w))
-           .where((col('conversation') == col('timestamp').cast('long')) & (col('direction') == 'in'))
-           .groupby('caller_id', 'weekday', 'daytime')
-           .agg(F.mean('responded').alias('response_rate_text')))
+    df = (df
+          .withColumn('dir', F.when(col('direction') == 'out', 1).otherwise(0))
+          .withColumn('responded', F.max(col('dir')).over(w))
+          .where((col('conversation') == col('timestamp').cast('long')) & (col('direction') == 'in')))
+
+    out = groupby_all_cat(df, by=['caller_id'], cols='week_day', aggs=['avg(responded) AS response_rate_text'])
 
     out = pivot_df(out, index=['caller_id'], columns=['weekday', 'daytime'], values=['response_rate_text'],
                    indicator_name='response_rate_text')
@@ -214,12 +408,9 @@ def entropy_of_contacts(df: SparkDataFrame) -> SparkDataFrame:
     Returns the entropy of interactions the users had with their contacts, disaggregated by type and time of day, and
     transaction type
     """
-    df = add_all_cat(df, cols='week_day')
-
     w = Window.partitionBy('caller_id', 'weekday', 'daytime', 'txn_type')
-    out = (df
-           .groupby('caller_id', 'recipient_id', 'weekday', 'daytime', 'txn_type')
-           .agg(F.count(lit(0)).alias('n'))
+    out = (groupby_all_cat(df, by=['caller_id', 'recipient_id', 'txn_type'], cols='week_day',
+                           aggs=['sum(interactions) AS n'])
            .withColumn('n_total', F.sum('n').over(w))
            .withColumn('n', (col('n')/col('n_total').cast('float')))
            .groupby('caller_id', 'weekday', 'daytime', 'txn_type')
@@ -231,16 +422,13 @@ def entropy_of_contacts(df: SparkDataFrame) -> SparkDataFrame:
     return out
 
 
-def balance_of_contacts(df: SparkDataFrame) -> SparkDataFrame:
+def balance_of_contacts(df: SparkDataFrame, sketch_error: Optional[float] = None) -> SparkDataFrame:
     """
     Returns summary stats for the balance of interactions (out/(in+out)) the users had with their contacts,
     disaggregated by type and time of day, and transaction type
     """
-    df = add_all_cat(df, cols='week_day')
-
-    out = (df
-           .groupby('caller_id', 'recipient_id', 'direction', 'weekday', 'daytime', 'txn_type')
-           .agg(F.count(lit(0)).alias('n'))
+    out = (groupby_all_cat(df, by=['caller_id', 'recipient_id', 'direction', 'txn_type'], cols='week_day',
+                           aggs=['sum(interactions) AS n'])
            .groupby('caller_id', 'recipient_id', 'weekday', 'daytime', 'txn_type')
            .pivot('direction')
            .agg(F.first('n').alias('n'))
@@ -248,7 +436,7 @@ def balance_of_contacts(df: SparkDataFrame) -> SparkDataFrame:
            .withColumn('n_total', col('in')+col('out'))
            .withColumn('n', (col('out')/col('n_total')))
            .groupby('caller_id', 'weekday', 'daytime', 'txn_type')
-           .agg(*summary_stats('n')))
+           .agg(*summary_stats('n', sketch_error)))
 
     out = pivot_df(out, index=['caller_id'], columns=['weekday', 'daytime', 'txn_type'],
                    values=['mean', 'std', 'median', 'skewness', 'kurtosis', 'min', 'max'],
@@ -257,18 +445,15 @@ def balance_of_contacts(df: SparkDataFrame) -> SparkDataFrame:
     return out
 
 
-def interactions_per_contact(df: SparkDataFrame) -> SparkDataFrame:
+def interactions_per_contact(df: SparkDataFrame, sketch_error: Optional[float] = None) -> SparkDataFrame:
     """
     Returns summary stats for the number of interactions the users had with their contacts, disaggregated by type and
     time of day, and transaction type
     """
-    df = add_all_cat(df, cols='week_day')
-
-    out = (df
-           .groupby('caller_id', 'recipient_id', 'weekday', 'daytime', 'txn_type')
-           .agg(F.count(lit(0)).alias('n'))
+    out = (groupby_all_cat(df, by=['caller_id', 'recipient_id', 'txn_type'], cols='week_day',
+                           aggs=['sum(interactions) AS n'])
            .groupby('caller_id', 'weekday', 'daytime', 'txn_type')
-           .agg(*summary_stats('n')))
+           .agg(*summary_stats('n', sketch_error)))
 
     out = pivot_df(out, index=['caller_id'], columns=['weekday', 'daytime', 'txn_type'],
                    values=['mean', 'std', 'median', 'skewness', 'kurtosis', 'min', 'max'],
@@ -277,7 +462,7 @@ def interactions_per_contact(df: SparkDataFrame) -> SparkDataFrame:
     return out
 
 
-def interevent_time(df: SparkDataFrame) -> SparkDataFrame:
+def interevent_time(df: SparkDataFrame, sketch_error: Optional[float] = None) -> SparkDataFrame:
     """
     Returns summary stats for the time between users' interactions, disaggregated by type and time of day, and
     transaction type
@@ -290,7 +475,7 @@ def interevent_time(df: SparkDataFrame) -> SparkDataFrame:
            .withColumn('prev_ts', F.lag(col('ts')).over(w))
            .withColumn('wait', col('ts') - col('prev_ts'))
            .groupby('caller_id', 'weekday', 'daytime', 'txn_type')
-           .agg(*summary_stats('wait')))
+           .agg(*summary_stats('wait', sketch_error)))
 
     out = pivot_df(out, index=['caller_id'], columns=['weekday', 'daytime', 'txn_type'],
                    values=['mean', 'std', 'median', 'skewness', 'kurtosis', 'min', 'max'],
@@ -304,14 +489,11 @@ def percent_pareto_interactions(df: SparkDataFrame, percentage: float = 0.8) ->
     Returns the percentage of a user's contacts that account for 80% of their interactions, disaggregated by type and
     time of day, and transaction type
     """
-    df = add_all_cat(df, cols='week_day')
-
     w = Window.partitionBy('caller_id', 'weekday', 'daytime', 'txn_type')
     w1 = Window.partitionBy('caller_id', 'weekday', 'daytime', 'txn_type').orderBy(col('n').desc())
     w2 = Window.partitionBy('caller_id', 'weekday', 'daytime', 'txn_type').orderBy('row_number')
-    out = (df
-           .groupby('caller_id', 'recipient_id', 'weekday', 'daytime', 'txn_type')
-           .agg(F.count(lit(0)).alias('n'))
+    out = (groupby_all_cat(df, by=['caller_id', 'recipient_id', 'txn_type'], cols='week_day',
+                           aggs=['sum(interactions) AS n'])
            .withColumn('row_number', F.row_number().over(w1))
            .withColumn('total', F.sum('n').over(w))
            .withColumn('cumsum', F.sum('n').over(w2))
@@ -334,14 +516,12 @@ def percent_pareto_durations(df: SparkDataFrame, percentage: float = 0.8) -> Spa
     time of day, and transaction type
     """
     df = df.where(col('txn_type') == 'call')
-    df = add_all_cat(df, cols='week_day')
 
     w = Window.partitionBy('caller_id', 'weekday', 'daytime')
     w1 = Window.partitionBy('caller_id', 'weekday', 'daytime').orderBy(col('duration').desc())
     w2 = Window.partitionBy('caller_id', 'weekday', 'daytime').orderBy('row_number')
-    out = (df
-           .groupby('caller_id', 'recipient_id', 'weekday', 'daytime')
-           .agg(F.sum('duration').alias('duration'))
+    out = (groupby_all_cat(df, by=['caller_id', 'recipient_id'], cols='week_day',
+                           aggs=['sum(duration) AS duration'])
            .withColumn('row_number', F.row_number().over(w1))
            .withColumn('total', F.sum('duration').over(w))
            .withColumn('cumsum', F.sum('duration').over(w2))
@@ -362,44 +542,22 @@ def number_of_interactions(df: SparkDataFrame) -> SparkDataFrame:
     """
     Returns the number of interactions per user, disaggregated by type and time of day, transaction type, and direction
     """
-    df = add_all_cat(df, cols='week_day_dir')
-
-    out = (df
-           .groupby('caller_id', 'weekday', 'daytime', 'txn_type', 'direction')
-           .agg(F.count(lit(0)).alias('n')))
-
-    out = pivot_df(out, index=['caller_id'], columns=['direction', 'weekday', 'daytime', 'txn_type'], values=['n'],
-                   indicator_name='number_of_interactions')
-
-    return out
+    return aggregate_features(df, ['number_of_interactions'])[0]
 
 
-def number_of_antennas(df: SparkDataFrame) -> SparkDataFrame:
+def number_of_antennas(df: SparkDataFrame, sketch_error: Optional[float] = None) -> SparkDataFrame:
     """
     Returns the number of antennas the handled users' interactions, disaggregated by type and time of day
     """
-    df = add_all_cat(df, cols='week_day')
-
-    out = (df
-           .groupby('caller_id', 'weekday', 'daytime')
-           .agg(F.countDistinct('caller_antenna').alias('n_antennas')))
-
-    out = pivot_df(out, index=['caller_id'], columns=['weekday', 'daytime'], values=['n_antennas'],
-                   indicator_name='number_of_antennas')
-
-    return out
+    return aggregate_features(df, ['number_of_antennas'], sketch_error=sketch_error)[0]
 
 
 def entropy_of_antennas(df: SparkDataFrame) -> SparkDataFrame:
     """
     Returns the entropy of a user's antennas' shares of handled interactions, disaggregated by type and time of day
     """
-    df = add_all_cat(df, cols='week_day')
-
     w = Window.partitionBy('caller_id', 'weekday', 'daytime')
-    out = (df
-           .groupby('caller_id', 'caller_antenna', 'weekday', 'daytime')
-           .agg(F.count(lit(0)).alias('n'))
+    out = (groupby_all_cat(df, by=['caller_id', 'caller_antenna'], cols='week_day', aggs=['sum(interactions) AS n'])
            .withColumn('n_total', F.sum('n').over(w))
            .withColumn('n', (col('n')/col('n_total').cast('float')))
            .groupby('caller_id', 'weekday', 'daytime')
@@ -415,8 +573,6 @@ def percent_at_home(df: SparkDataFrame) -> SparkDataFrame:
     """
     Returns the percentage of interactions handled by a user's home antenna, disaggregated by type and time of day
     """
-    df = add_all_cat(df, cols='week_day')
-
     df = df.dropna(subset=['caller_antenna'])
 
     # Compute home antennas for all users, if possible
@@ -424,17 +580,18 @@ def percent_at_home(df: SparkDataFrame) -> SparkDataFrame:
     home_antenna = (df
                     .where(col('daytime') == 'night')
                     .groupby('caller_id', 'caller_antenna')
-                    .agg(F.count(lit(0)).alias('n'))
+                    .agg(F.sum('interactions').alias('n'))
                     .withColumn('row_number', F.row_number().over(w))
                     .where(col('row_number') == 1)
                     .withColumnRenamed('caller_antenna', 'home_antenna')
                     .drop('n'))
 
-    out = (df
-           .join(home_antenna, on='caller_id', how='inner')
-           .withColumn('home_interaction', F.when(col('caller_antenna') == col('home_antenna'), 1).otherwise(0))
-           .groupby('caller_id', 'weekday', 'daytime')
-           .agg(F.mean('home_interaction').alias('mean')))
+    df = (df
+          .join(home_antenna, on='caller_id', how='inner')
+          .withColumn('home_interaction', F.when(col('caller_antenna') == col('home_antenna'), 1).otherwise(0)))
+
+    out = groupby_all_cat(df, by=['caller_id'], cols='week_day',
+                          aggs=['sum(home_interaction * interactions) / sum(interactions) AS `mean`'])
 
     out = pivot_df(out, index=['caller_id'], columns=['weekday', 'daytime'], values=['mean'],
                    indicator_name='percent_at_home')
@@ -460,9 +617,9 @@ def radius_of_gyration(df: SparkDataFrame, antennas: SparkDataFrame) -> SparkDat
 
     bar = (df
            .groupby('caller_id', 'weekday', 'daytime')
-           .agg(F.sum('latitude').alias('latitude'),
-                F.sum('longitude').alias('longitude'),
-                F.count(lit(0)).alias('n'))
+           .agg(F.sum(col('latitude') * col('interactions')).alias('latitude'),
+                F.sum(col('longitude') * col('interactions')).alias('longitude'),
+                F.sum('interactions').alias('n'))
            .withColumn('bar_lat', col('latitude')/col('n'))
            .withColumn('bar_lon', col('longitude') / col('n'))
            .drop('latitude', 'longitude'))
@@ -471,7 +628,7 @@ def radius_of_gyration(df: SparkDataFrame, antennas: SparkDataFrame) -> SparkDat
     df = great_circle_distance(df)
     out = (df
            .groupby('caller_id', 'weekday', 'daytime')
-           .agg(F.sqrt(F.sum(col('r')**2/col('n'))).alias('r')))
+           .agg(F.sqrt(F.sum(col('interactions')*col('r')**2/col('n'))).alias('r')))
 
     out = pivot_df(out, index=['caller_id'], columns=['weekday', 'daytime'], values=['r'],
                    indicator_name='radius_of_gyration')
@@ -483,14 +640,10 @@ def frequent_antennas(df: SparkDataFrame, percentage: float = 0.8) -> SparkDataF
     """
     Returns the percentage of antennas accounting for 80% of users' interactions, disaggregated by type and time of day
     """
-    df = add_all_cat(df, cols='week_day')
-
     w = Window.partitionBy('caller_id', 'weekday', 'daytime')
     w1 = Window.partitionBy('caller_id', 'weekday', 'daytime').orderBy(col('n').desc())
     w2 = Window.partitionBy('caller_id', 'weekday', 'daytime').orderBy('row_number')
-    out = (df
-           .groupby('caller_id', 'caller_antenna', 'weekday', 'daytime')
-           .agg(F.count(lit(0)).alias('n'))
+    out = (groupby_all_cat(df, by=['caller_id', 'caller_antenna'], cols='week_day', aggs=['sum(interactions) AS n'])
            .withColumn('row_number', F.row_number().over(w1))
            .withColumn('total', F.sum('n').over(w))
            .withColumn('cumsum', F.sum('n').over(w2))
@@ -1,23 +1,35 @@
-from pyspark.sql import DataFrame as SparkDataFrame
+from functools import reduce
+from itertools import product
+import math
+from pyspark.sql import Column, DataFrame as SparkDataFrame, SparkSession
 import pyspark.sql.functions as F
 from pyspark.sql.functions import col, lit
 from pyspark.sql.window import Window
-from typing import List
+import re
+from typing import Dict, List, Optional, Tuple
+import uuid
 
+# Values taken by the columns features are disaggregated by, including their "all interactions" category
+PIVOT_VALUES = {'weekday': ['allweek', 'weekday', 'weekend'],
+                'daytime': ['allday', 'day', 'night'],
+                'txn_type': ['call', 'text'],
+                'direction': ['alldir', 'in', 'out']}
 
-def add_all_cat(df: SparkDataFrame, cols: str) -> SparkDataFrame:
+# Largest relative error of sketch-based approximations: approx_count_distinct needs at least 16 HyperLogLog registers
+MAX_SKETCH_ERROR = 0.39
+
+
+def all_cat_mapping(cols: str) -> Dict[str, str]:
     """
-    Duplicate dataframe rows so that groupby result includes an "all interactions" category for specified column(s)
+    Define mapping from column name to the value denoting its "all interactions" category, e.g. the column daytime will
+    also have a value called "allday" to denote both day and night
 
     Args:
-        df: spark dataframe
-        cols: string defining columns to duplicate
+        cols: string defining columns with an "all interactions" category
 
     Returns:
-        df: spark dataframe
+        col_mapping: dict from column name to "all interactions" value
     """
-    # Define mapping from column name to column value
-    # e.g. the column daytime will also have a value called "allday" to denote both day and night
     if cols == 'week':
         col_mapping = {'weekday': 'allweek'}
     elif cols == 'week_day':
@@ -27,6 +39,25 @@ def add_all_cat(df: SparkDataFrame, cols: str) -> SparkDataFrame:
     else:
         raise ValueError("'cols' argument should be one of {week, week_day, week_day_dir}")
 
+    return col_mapping
+
+
+def add_all_cat(df: SparkDataFrame, cols: str) -> SparkDataFrame:
+    """
+    Duplicate dataframe rows so that groupby result includes an "all interactions" category for specified column(s)
+
+    Only needed when the "all interactions" rows are used other than for a groupby, e.g. by windows; otherwise
+    groupby_all_cat produces the same result without duplicating rows
+
+    Args:
+        df: spark dataframe
+        cols: string defining columns to duplicate
+
+    Returns:
+        df: spark dataframe
+    """
+    col_mapping = all_cat_mapping(cols)
+
     # For each of the columns defined in the mapping, duplicate entries
     for column, value in col_mapping.items():
         df = (df
@@ -36,36 +67,131 @@ def add_all_cat(df: SparkDataFrame, cols: str) -> SparkDataFrame:
     return df
 
 
+def all_cat_grouping_sets(by: List[str], cols: str) -> List[List[str]]:
+    """
+    Grouping sets equivalent to add_all_cat followed by a groupby: one per combination of the category columns, the
+    others being aggregated into their "all interactions" category
+
+    Args:
+        by: columns to group by, without "all interactions" category
+        cols: string defining columns with an "all interactions" category, see add_all_cat
+
+    Returns:
+        grouping_sets: list of lists of columns
+    """
+    col_mapping = all_cat_mapping(cols)
+
+    return [by + [column for column, keep in zip(col_mapping, mask) if keep]
+            for mask in product([True, False], repeat=len(col_mapping))]
+
+
+def grouping_set_id(keys: List[str], grouping_set: List[str]) -> int:
+    """
+    Identifier of a grouping set, as returned by spark's grouping_id(): one bit per grouping column, set if the column
+    is aggregated over, the first column being the most significant bit
+    """
+    return sum(1 << (len(keys) - 1 - i) for i, key in enumerate(keys) if key not in grouping_set)
+
+
+def groupby_grouping_sets(df: SparkDataFrame, keys: List[str], grouping_sets: List[List[str]], aggs: List[str],
+                          all_values: Optional[Dict[str, str]] = None) -> SparkDataFrame:
+    """
+    Aggregate dataframe by each of the grouping sets, in a single aggregation
+
+    Args:
+        df: spark dataframe
+        keys: all grouping columns
+        grouping_sets: subsets of the grouping columns to group by
+        aggs: aggregations as spark sql expressions, e.g. 'count(DISTINCT day) AS active_days'
+        all_values: value of grouping columns in the rows where they are aggregated over, e.g. 'allweek' for weekday;
+            null for the other columns
+
+    Returns:
+        df: aggregated spark dataframe, with the grouping columns, a 'grouping_id' column identifying the grouping set
+            of each row (see grouping_set_id), and the aggregations
+    """
+    all_values = all_values if all_values is not None else {}
+
+    select = [f"CASE WHEN grouping(`{key}`) = 1 THEN '{all_values[key]}' ELSE `{key}` END AS `{key}`"
+              if key in all_values else f'`{key}`' for key in keys]
+    select.append('grouping_id() AS grouping_id')
+    group_by = ', '.join(f'`{key}`' for key in keys)
+    sets = ', '.join('(' + ', '.join(f'`{key}`' for key in grouping_set) + ')' for grouping_set in grouping_sets)
+
+    # Grouping sets are only available in spark sql; the query is analyzed, and the view no longer needed, once it
+    # has been turned into a dataframe
+    spark = SparkSession.builder.getOrCreate()
+    view = 'grouping_sets_' + uuid.uuid4().hex
+    df.createOrReplaceTempView(view)
+    out = spark.sql(f"SELECT {', '.join(select + aggs)} FROM {view} GROUP BY {group_by} GROUPING SETS ({sets})")
+    spark.catalog.dropTempView(view)
+
+    return out
+
+
+def groupby_all_cat(df: SparkDataFrame, by: List[str], cols: str, aggs: List[str]) -> SparkDataFrame:
+    """
+    Group dataframe by some columns and by the specified category column(s), including an "all interactions" category
+    for the latter, and aggregate. The result is the same as that of add_all_cat followed by a groupby, but is computed
+    with grouping sets, so that rows are not duplicated before being shuffled
+
+    Args:
+        df: spark dataframe
+        by: columns to group by, without "all interactions" category
+        cols: string defining columns with an "all interactions" category, see add_all_cat
+        aggs: aggregations as spark sql expressions, e.g. 'count(DISTINCT day) AS active_days'
+
+    Returns:
+        df: aggregated spark dataframe, with the columns in 'by', the category columns and the aggregations
+    """
+    col_mapping = all_cat_mapping(cols)
+    out = groupby_grouping_sets(df, by + list(col_mapping), all_cat_grouping_sets(by, cols), aggs, col_mapping)
+
+    return out.drop('grouping_id')
+
+
 def pivot_df(df: SparkDataFrame,
-             index: List[str], columns: List[str], values: List[str], indicator_name: str) -> SparkDataFrame:
+             index: List[str], columns: List[str], values: List[str], indicator_name: str,
+             pivot_values: Optional[Dict[str, List[str]]] = None) -> SparkDataFrame:
     """
     Recreate pandas pivot method for dataframes
 
+    All wide columns are built in a single conditional aggregation, from the values each column can take (see
+    PIVOT_VALUES), rather than with successive spark pivots, which each need an extra job to find the values. Columns
+    are named as successive pivots would name them, e.g. 'call_duration_weekday_day_call_mean'
+
     Args:
         df: spark dataframe
         index: columns to use to make new frame’s index
         columns: columns to use to make new frame’s columns
         values: column(s) to use for populating new frame’s values
         indicator_name: name of indicator to prefix to new columns
+        pivot_values: values of the columns, where they differ from PIVOT_VALUES, e.g. if the df was filtered
 
     Returns:
         df: pivoted spark dataframe
     """
-    # Iterate through columns
-    while columns:
-        column = columns.pop()
-        # Pivot values based on current column selection
-        df = (df
-              .groupby(index + columns)
-              .pivot(column)
-              .agg(*[F.first(val).alias(val) for val in values]))
-        #  Update values for next pivot
-        values = [val for val in df.columns if val not in index and val not in columns]
+    catalog = {**PIVOT_VALUES, **(pivot_values if pivot_values is not None else {})}
+    missing = [column for column in columns if column not in catalog]
+    if missing:
+        raise ValueError(f'No pivot values defined for columns {missing}')
+
+    # Pivot from the innermost column outwards, as spark would, keeping track of the condition defining each new column;
+    # new columns are named after the pivot value, followed by the name of the pivoted column unless there is only one
+    pivoted = [(value, [], value) for value in values]
+    for column in reversed(columns):
+        pivoted = [(str(pivot_value) + ('_' + name if len(pivoted) > 1 else ''),
+                    [(column, pivot_value)] + conditions, value)
+                   for pivot_value in catalog[column] for name, conditions, value in pivoted]
+
+    def condition(conditions: List[Tuple[str, str]]) -> Column:
+        return reduce(lambda c1, c2: c1 & c2, [col(column) == lit(pivot_value) for column, pivot_value in conditions])
 
     # Rename columns by prefixing indicator name
-    col_selection = [col(col_name).alias(indicator_name + '_' + col_name) for col_name in df.columns
-                     if col_name != 'caller_id']
-    df = df.select('caller_id', *col_selection)
+    df = (df
+          .groupby(index)
+          .agg(*[F.first(F.when(condition(conditions), col(value)), ignorenulls=True).alias(indicator_name + '_' + name)
+                 for name, conditions, value in pivoted]))
 
     return df
 
@@ -125,16 +251,61 @@ def great_circle_distance(df: SparkDataFrame) -> SparkDataFrame:
     return df
 
 
-def summary_stats(col_name: str) -> list:
+def check_sketch_error(sketch_error: Optional[float]) -> None:
+    """
+    Check that the relative error of sketch-based approximations is supported, before any data is processed
+
+    Args:
+        sketch_error: relative error of the approximations, None for exact aggregations
+    """
+    if sketch_error is not None and not 0 < sketch_error < MAX_SKETCH_ERROR:
+        raise ValueError(f'The relative error of sketches should be between 0 and {MAX_SKETCH_ERROR}.')
+
+
+def approximate_sql(agg: str, sketch_error: Optional[float] = None) -> str:
+    """
+    Replace the exact distinct counts and the quantiles of an aggregation with cheaper sketch-based approximations:
+    HyperLogLog++ (approx_count_distinct) for distinct counts, and percentile_approx with a matching accuracy for
+    quantiles
+
+    Args:
+        agg: aggregation as a spark sql expression, e.g. 'count(DISTINCT day)'
+        sketch_error: relative error of the approximations, e.g. 0.01, below MAX_SKETCH_ERROR; None to keep the
+            aggregation as is
+
+    Returns:
+        agg: aggregation as a spark sql expression
+    """
+    if sketch_error is None:
+        return agg
+    check_sketch_error(sketch_error)
+    agg = re.sub(r'count\(DISTINCT ([^(),]+)\)', rf'approx_count_distinct(\1, {sketch_error})', agg)
+    accuracy = math.ceil(1 / sketch_error)
+    agg = re.sub(r'percentile_approx\(([^(),]+), ([^(),]+)\)', rf'percentile_approx(\1, \2, {accuracy})', agg)
+
+    return agg
+
+
+def summary_stats_exprs(col_name: str, sketch_error: Optional[float] = None) -> Dict[str, str]:
+    # Standard functions to be applied to column after group by, as spark sql expressions by name
+    functions = {
+        'mean': f'avg(`{col_name}`)',
+        'min': f'min(`{col_name}`)',
+        'max': f'max(`{col_name}`)',
+        'std': f'stddev_pop(`{col_name}`)',
+        'median': f'percentile_approx(`{col_name}`, 0.5)',
+        'skewness': f'skewness(`{col_name}`)',
+        'kurtosis': f'kurtosis(`{col_name}`)'
+    }
+
+    return {name: approximate_sql(function, sketch_error) for name, function in functions.items()}
+
+
+def summary_stats_sql(col_name: str, sketch_error: Optional[float] = None) -> List[str]:
+    # Standard list of functions to be applied to column after group by, as spark sql expressions
+    return [f'{function} AS `{name}`' for name, function in summary_stats_exprs(col_name, sketch_error).items()]
+
+
+def summary_stats(col_name: str, sketch_error: Optional[float] = None) -> list:
     # Standard list of functions to be applied to column after group by
-    functions = [
-        F.mean(col_name).alias('mean'),
-        F.min(col_name).alias('min'),
-        F.max(col_name).alias('max'),
-        F.stddev_pop(col_name).alias('std'),
-        F.expr(f'percentile_approx({col_name}, 0.5)').alias('median'),
-        F.skewness(col_name).alias('skewness'),
-        F.kurtosis(col_name).alias('kurtosis')
-    ]
-
-    return functions
+    return [F.expr(function) for function in summary_stats_sql(col_name, sketch_error)]
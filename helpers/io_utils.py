@@ -1,35 +1,87 @@
 from box import Box
 import geopandas as gpd  # type: ignore[import]
 from geopandas import GeoDataFrame
+import glob
+from helpers.cache_utils import fingerprint
+from helpers.schema_utils import COLUMN_TYPES, DEFAULT_TYPES, enforce_schema, raw_schema, read_schema, \
+    TIMESTAMP_FORMAT
 from helpers.utils import get_spark_session
-from pandas import DataFrame as PandasDataFrame
-from pyspark.sql import DataFrame as SparkDataFrame
-from pyspark.sql.functions import col, date_trunc, to_timestamp
-from typing import Dict, List, Optional, Union
+import json
+import os
+import pandas as pd
+import shutil
+from pandas import DataFrame as PandasDataFrame, Series
+from pyspark.sql import Column, DataFrame as SparkDataFrame
+from pyspark.sql.functions import col, count, date_trunc, lit, when
+from pyspark.sql.types import StructType
+from typing import Any, Callable, Dict, List, Optional, Union
+
+# Execution backends: spark, or pandas for datasets that fit in memory on a single machine
+BACKENDS = ['spark', 'pandas']
+
+# Raw data files, by format; csv files can be compressed
+DATA_EXTENSIONS = {'csv': ('.csv', '.csv.gz', '.csv.bz2', '.csv.zst'), 'parquet': ('.parquet',), 'orc': ('.orc',)}
+# Compressed files that cannot be split, and are parsed by a single task each
+NON_SPLITTABLE_EXTENSIONS = ('.gz', '.zst')
+# Raw data location: path to a file, a folder with files or a glob pattern, or a list of them
+Paths = Union[str, List[str]]
+# Version of the parsing of raw files into ingested datasets: bump it when a change to the loaders or to the cleaning
+# they apply changes the content of ingested datasets, so that ingested copies are parsed again
+INGEST_VERSION = 1
 
 
 def load_generic(cfg: Box,
-                 fname: Optional[str] = None,
-                 df: Optional[Union[SparkDataFrame, PandasDataFrame]] = None) -> SparkDataFrame:
+                 fname: Optional[Paths] = None,
+                 df: Optional[Union[SparkDataFrame, PandasDataFrame]] = None,
+                 dataset: Optional[str] = None,
+                 backend: str = 'spark') -> Union[SparkDataFrame, PandasDataFrame]:
     """
     Args:
         cfg: box object containing config data
-        fname: path to file or folder with files
+        fname: path to file or folder with files, or list of them
         df: pandas or spark df, if already loaded
+        dataset: name of the dataset in the schema registry, used to parse columns with the right types
+        backend: 'spark' or 'pandas'
 
-    Returns: loaded spark df
+    Returns: loaded spark or pandas df, depending on the backend
     """
+    if backend not in BACKENDS:
+        raise ValueError('Backend must be one of: ' + ', '.join(BACKENDS))
+    if backend == 'pandas':
+        return load_generic_pandas(fname=fname, df=df)
+
     spark = get_spark_session(cfg)
 
-    # Load from file
+    # Load from file(s): single file, folder (possibly partitioned, e.g. folder/day=2020-01-01/part-0.csv.gz) or glob
     if fname is not None:
-        # Load data if in a single file
-        if '.csv' in fname:
-            df = spark.read.csv(fname, header=True)
-
-        # Load data if in chunks
+        files = source_files(fname)
+        if not files:
+            raise FileNotFoundError('No data files found at ' + str(fname))
+        file_format = source_format(files)
+        reader = spark.read
+        # Keep partition columns of partitioned folders
+        if isinstance(fname, str) and os.path.isdir(fname):
+            reader = reader.option('basePath', fname)
+
+        # Parquet and orc files are already typed
+        if file_format != 'csv':
+            df = reader.format(file_format).load(files)
+
+        elif dataset is None:
+            df = reader.csv(files, header=True)
+
+        # Build schema from header and registry, so that columns are parsed with their types in a single pass
         else:
-            df = spark.read.csv(fname + '/*.csv', header=True)
+            header = spark.read.csv(files[0], header=True).columns
+            col_names = cfg.col_names[dataset] if dataset in cfg.col_names else None
+            mode = cfg.ingest.parse_mode if 'ingest' in cfg and 'parse_mode' in cfg.ingest else 'PERMISSIVE'
+            df = reader.csv(files, header=True, schema=raw_schema(dataset, header, col_names),
+                            timestampFormat=TIMESTAMP_FORMAT, mode=mode)
+
+        # Gzip and zstd files are decompressed by one task per file; spread their rows so that later stages (and the
+        # parquet copy written on first ingest) are processed in parallel
+        if any(f.endswith(NON_SPLITTABLE_EXTENSIONS) for f in files):
+            df = df.repartition(int(spark.conf.get('spark.sql.shuffle.partitions')))
 
     # Load from pandas dataframe
     elif df is not None:
@@ -43,6 +95,364 @@ def load_generic(cfg: Box,
     return df
 
 
+def load_generic_pandas(fname: Optional[Paths] = None,
+                        df: Optional[Union[SparkDataFrame, PandasDataFrame]] = None) -> PandasDataFrame:
+    """
+    Load dataset in memory with pandas; columns are read as strings, and typed by the loaders with enforce_schema
+
+    Args:
+        fname: path to file or folder with files, or list of them
+        df: pandas or spark df, if already loaded
+
+    Returns: pandas df
+    """
+    # Load from file(s), with the same layouts as load_generic
+    if fname is not None:
+        files = source_files(fname)
+        if not files:
+            raise FileNotFoundError('No data files found at ' + str(fname))
+        file_format = source_format(files)
+        frames = []
+        for f in files:
+            if f.endswith('.zst'):
+                raise ValueError('Zstandard-compressed files can only be loaded with the spark backend.')
+            if file_format == 'csv':
+                frame = pd.read_csv(f, dtype=str)
+            else:
+                frame = pd.read_parquet(f) if file_format == 'parquet' else pd.read_orc(f)
+            if isinstance(fname, str) and os.path.isdir(fname):
+                frame = frame.assign(**partition_values(f, fname))
+            frames.append(frame)
+        df = pd.concat(frames, ignore_index=True)
+
+    # Load from spark dataframe
+    elif df is not None:
+        if isinstance(df, SparkDataFrame):
+            df = df.toPandas()
+
+    # Issue with filename/dataframe provided
+    else:
+        raise ValueError('No filename or pandas/spark dataframe provided.')
+
+    return df
+
+
+def load_raw_input(cfg: Box,
+                   fname: Optional[Paths],
+                   df: Optional[Union[SparkDataFrame, PandasDataFrame]],
+                   dataset: str,
+                   backend: str) -> Union[SparkDataFrame, PandasDataFrame]:
+    """
+    Load raw dataset from the df provided or, if none, from file
+
+    Args:
+        cfg: box object containing config data
+        fname: path to file or folder with files, or list of them
+        df: pandas or spark df, if already loaded
+        dataset: name of the dataset in the schema registry
+        backend: 'spark' or 'pandas'
+
+    Returns: spark or pandas df, depending on the backend
+    """
+    if df is not None:
+        if not isinstance(df, (PandasDataFrame, SparkDataFrame)):
+            raise TypeError("The dataframe provided should be a spark or pandas df.")
+        return load_generic(cfg, df=df, backend=backend)
+    elif fname is not None:
+        return load_generic(cfg, fname=fname, dataset=dataset, backend=backend)
+    else:
+        raise ValueError('No filename or pandas/spark dataframe provided.')
+
+
+def with_day(df: Union[SparkDataFrame, PandasDataFrame]) -> Union[SparkDataFrame, PandasDataFrame]:
+    """
+    Add day column, with timestamps truncated to the day
+    """
+    if isinstance(df, PandasDataFrame):
+        return df.assign(day=df['timestamp'].dt.floor('D'))
+    return df.withColumn('day', date_trunc('day', col('timestamp')))
+
+
+def load_derived(cfg: Box, fname: str) -> SparkDataFrame:
+    """
+    Load csv dataset produced by cider (e.g. features), using the schema stored alongside it if available and falling
+    back to schema inference otherwise
+
+    Args:
+        cfg: box object containing config data
+        fname: path to csv file
+
+    Returns: spark df
+    """
+    spark = get_spark_session(cfg)
+    schema = read_schema(fname)
+    if schema is not None:
+        return spark.read.csv(fname, header=True, schema=schema)
+    return spark.read.csv(fname, header=True, inferSchema=True)
+
+
+def source_files(fname: Paths) -> List[str]:
+    """
+    List the raw files that make up a dataset: a single file, all data files in a folder and its subfolders, or all
+    data files matching a glob pattern; hidden files (e.g. '_SUCCESS', '.crc' files) are ignored
+
+    Args:
+        fname: path to file, folder with files, or glob pattern, e.g. 'cdr/2021-*.csv.gz', or list of them
+
+    Returns: sorted list of file paths
+    """
+    if isinstance(fname, list):
+        return sorted({f for path in fname for f in source_files(path)})
+    paths = glob.glob(fname, recursive=True) if glob.has_magic(fname) else [fname]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(glob.glob(os.path.join(path, '**', '*'), recursive=True))
+        elif os.path.isfile(path):
+            files.append(path)
+    extensions = tuple(ext for exts in DATA_EXTENSIONS.values() for ext in exts)
+    return sorted(f for f in files
+                  if os.path.isfile(f) and f.endswith(extensions) and not os.path.basename(f).startswith(('_', '.')))
+
+
+def source_format(files: List[str]) -> str:
+    """
+    Find the format of raw files - 'csv', 'parquet' or 'orc' - which must be the same for all files of a dataset
+    """
+    formats = {file_format for f in files for file_format, extensions in DATA_EXTENSIONS.items()
+               if f.endswith(extensions)}
+    if len(formats) != 1:
+        raise ValueError('All files of a dataset should have the same format, found: ' + ', '.join(sorted(formats)))
+    return formats.pop()
+
+
+def partition_values(path: str, root: str) -> Dict[str, str]:
+    """
+    Read partition values from the path of a file in a partitioned folder, e.g. {'day': '2020-01-01'} for
+    root/day=2020-01-01/part-0.csv.gz
+    """
+    segments = os.path.relpath(os.path.dirname(path), root).split(os.sep)
+    return dict(segment.split('=', 1) for segment in segments if '=' in segment)
+
+
+def source_fingerprint(fname: Paths) -> List[List[Any]]:
+    """
+    Describe the raw files of a dataset by path, size and modification time, so that changes can be detected cheaply
+
+    Args:
+        fname: path to file or folder with files, or list of them
+
+    Returns: list of [path, size, mtime] entries
+    """
+    fingerprint = []
+    for path in source_files(fname):
+        stats = os.stat(path)
+        fingerprint.append([os.path.abspath(path), stats.st_size, stats.st_mtime])
+    return fingerprint
+
+
+def appended_files(old: List[List[Any]], new: List[List[Any]]) -> Optional[List[str]]:
+    """
+    Compare two fingerprints of a dataset, and find the raw files that were added if none of the old ones changed
+
+    Args:
+        old: fingerprint the parquet dataset was built from
+        new: current fingerprint of the raw files
+
+    Returns: paths of the new files, or None if some of the old files were modified or removed
+    """
+    current = {path: [size, mtime] for path, size, mtime in new}
+    if any(current.get(path) != [size, mtime] for path, size, mtime in old):
+        return None
+    known = {path for path, _, _ in old}
+    return [path for path, _, _ in new if path not in known]
+
+
+def merge_reports(*reports: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Add up validation reports of disjoint parts of a dataset, e.g. of the files appended to an ingested dataset
+
+    Returns: validation report of the whole dataset
+    """
+    merged: Dict[str, Any] = {'rows': 0, 'nulls': {}, 'invalid': {}}
+    for report in reports:
+        merged['rows'] += report.get('rows', 0)
+        for key in ['nulls', 'invalid']:
+            for name, n in report.get(key, {}).items():
+                merged[key][name] = merged[key].get(name, 0) + n
+    return merged
+
+
+def day_counts(df: SparkDataFrame) -> Dict[str, int]:
+    """
+    Count records by day; on a parquet dataset partitioned by day only partition values are read
+
+    Returns: dict of counts by day - {'2020-01-01': 100, ...}
+    """
+    return {row['day'].strftime('%Y-%m-%d'): row['count'] for row in df.groupby('day').count().collect()}
+
+
+def parse_settings(cfg: Box, loader: Callable[..., SparkDataFrame], dataset: Optional[str]) -> str:
+    """
+    Fingerprint of the settings that determine how raw files are parsed into a typed dataset: the loader, the column
+    names and parse mode in the config, the types in the schema registry, and the version of the parsing
+    (INGEST_VERSION). Other changes to the code do not invalidate ingested datasets
+
+    Args:
+        cfg: box object containing config data
+        loader: io_utils function used to load and clean the dataset, e.g. load_cdr
+        dataset: name of the dataset in the schema registry and in the config's column names, e.g. 'cdr'
+
+    Returns: fingerprint
+    """
+    col_names = cfg.col_names[dataset] if dataset is not None and dataset in cfg.col_names else None
+    parse_mode = cfg.ingest.parse_mode if 'ingest' in cfg and 'parse_mode' in cfg.ingest else 'PERMISSIVE'
+    types = {c: t.simpleString() for c, t in COLUMN_TYPES.get(dataset, {}).items()} if dataset is not None else {}
+    default_type = DEFAULT_TYPES[dataset].simpleString() if dataset in DEFAULT_TYPES else None
+    return fingerprint(loader.__name__, col_names, parse_mode, types, default_type, INGEST_VERSION)
+
+
+def write_json(obj: Any, path: str) -> None:
+    """
+    Write a json file atomically: the file is written under a temporary name, then renamed, so that readers never see
+    a partly written file
+    """
+    with open(path + '.tmp', 'w') as f:
+        json.dump(obj, f)
+    os.replace(path + '.tmp', path)
+
+
+def rollback_append(journal_path: str, staging_path: str, source: List[List[Any]]) -> None:
+    """
+    Undo an append to an ingested dataset that was interrupted before its manifest was updated: files moved into the
+    dataset are removed, so that the new raw files are appended again from scratch. If the manifest was updated, the
+    append is complete and only the journal is removed
+
+    Args:
+        journal_path: path to the journal of the append
+        staging_path: folder in which new files are staged
+        source: fingerprint of the raw files in the manifest of the dataset
+    """
+    if os.path.isdir(staging_path):
+        shutil.rmtree(staging_path)
+    if not os.path.isfile(journal_path):
+        return
+    with open(journal_path, 'r') as f:
+        journal = json.load(f)
+    if journal['source'] != source:
+        for path in journal['files']:
+            if os.path.isfile(path):
+                os.remove(path)
+    os.remove(journal_path)
+
+
+def load_ingested(cfg: Box,
+                  loader: Callable[..., SparkDataFrame],
+                  fname: str,
+                  cache_path: str,
+                  report: Optional[Dict[str, Any]] = None,
+                  partition_by: Optional[List[str]] = None,
+                  info: Optional[Dict[str, Any]] = None,
+                  dataset: Optional[str] = None) -> SparkDataFrame:
+    """
+    Load a raw dataset through its loader, store the typed result as compressed parquet, and reuse the parquet copy on
+    later runs for as long as the raw files and the way they are parsed (column names, parse mode, schema registry and
+    code version) are unchanged. Transaction datasets are partitioned by day, so that date filters only read the
+    partitions they need
+
+    If appending is enabled in the config and the only change to the raw files is the addition of new ones (e.g. a
+    weekly delivery of CDR), only the new files are parsed and their day partitions added to the parquet dataset. Files
+    moved into the dataset are recorded in a journal until the manifest is updated, so that an interrupted append is
+    rolled back on the next call instead of being appended again
+
+    Args:
+        cfg: box object containing config data
+        loader: io_utils function used to load and clean the dataset, e.g. load_cdr
+        fname: path to file or folder with files, or list of them
+        cache_path: folder in which to store the parquet dataset
+        report: dict to fill with the validation report of the loader, which is stored with the parquet dataset
+        partition_by: columns by which to partition the parquet dataset, e.g. ['day']
+        info: dict to fill with the number of records by day in the parquet dataset ('days'), and the days that were
+            added or extended by this call ('new_days'); only for datasets partitioned by day
+        dataset: name of the dataset in the schema registry and in the config's column names, e.g. 'cdr'
+
+    Returns: spark df
+    """
+    spark = get_spark_session(cfg)
+    manifest_path = os.path.join(cache_path, '_manifest.json')
+    journal_path = os.path.join(cache_path, '_appending.json')
+    staging_path = os.path.join(cache_path, '_staging')
+    source = source_fingerprint(fname)
+    settings = parse_settings(cfg, loader, dataset)
+    by_day = partition_by is not None and 'day' in partition_by
+    append = by_day and 'append' in cfg.ingest and cfg.ingest.append
+    compression = cfg.ingest.compression if 'compression' in cfg.ingest else 'snappy'
+
+    manifest = None
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        rollback_append(journal_path, staging_path, manifest['source'])
+        if manifest.get('partition_by') != partition_by or manifest.get('settings') != settings:
+            manifest = None
+
+    # Reuse parquet dataset if it was built from the same raw files
+    if manifest is not None and manifest['source'] == source:
+        if report is not None:
+            report.update(manifest.get('validation', {}))
+        if info is not None:
+            info.update({'days': manifest.get('days', {}), 'new_days': []})
+        # Read with the stored schema, so that partition columns keep their type instead of being inferred
+        return spark.read.schema(StructType.fromJson(manifest['schema'])).parquet(cache_path)
+
+    # Append new raw files to the parquet dataset, if the files it was built from are unchanged
+    new_files = appended_files(manifest['source'], source) if append and manifest is not None else None
+    if new_files:
+        new_report: Dict[str, Any] = {}
+        delta = loader(cfg, new_files) if report is None else loader(cfg, new_files, report=new_report)
+        # Write to a hidden staging folder first, so that a failed load leaves the dataset untouched
+        delta.write.mode('overwrite').option('compression', compression).partitionBy(*partition_by) \
+            .parquet(staging_path)
+        new_day_counts = day_counts(spark.read.schema(delta.schema).parquet(staging_path))
+
+        # Record the files to move in the journal before moving them, until the manifest is updated
+        moves = [(os.path.join(root, file), os.path.join(cache_path, os.path.relpath(root, staging_path), file))
+                 for root, _, files in os.walk(staging_path) for file in files if file.endswith('.parquet')]
+        write_json({'source': source, 'files': [target for _, target in moves]}, journal_path)
+        for staged, target in moves:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(staged, target)
+        shutil.rmtree(staging_path)
+
+        days = manifest.get('days', {})
+        for day, n in new_day_counts.items():
+            days[day] = days.get(day, 0) + n
+        validation = merge_reports(manifest.get('validation', {}), new_report) if report is not None else {}
+        schema = StructType.fromJson(manifest['schema'])
+
+    # Otherwise parse raw files, and write them out as parquet
+    else:
+        df = loader(cfg, fname) if report is None else loader(cfg, fname, report=report)
+        writer = df.write.mode('overwrite').option('compression', compression)
+        if partition_by:
+            writer = writer.partitionBy(*partition_by)
+        writer.parquet(cache_path)
+        schema = df.schema
+        days = day_counts(spark.read.schema(schema).parquet(cache_path)) if by_day else {}
+        new_day_counts, validation = days, report or {}
+
+    write_json({'source': source, 'settings': settings, 'partition_by': partition_by, 'schema': schema.jsonValue(),
+                'validation': validation, 'days': days}, manifest_path)
+    if os.path.isfile(journal_path):
+        os.remove(journal_path)
+    if report is not None:
+        report.update(validation)
+    if info is not None:
+        info.update({'days': days, 'new_days': sorted(new_day_counts)})
+
+    return spark.read.schema(schema).parquet(cache_path)
+
+
 def check_cols(df: Union[GeoDataFrame, PandasDataFrame, SparkDataFrame],
                required_cols: List[str],
                error_msg: str) -> None:
@@ -58,67 +468,91 @@ def check_cols(df: Union[GeoDataFrame, PandasDataFrame, SparkDataFrame],
         raise ValueError(error_msg)
 
 
-def check_colvalues(df: SparkDataFrame, colname: str, colvalues: list, error_msg: str) -> None:
+def validate_dataset(df: Union[SparkDataFrame, PandasDataFrame],
+                     domains: Optional[Dict[str, List[str]]] = None,
+                     conditions: Optional[Dict[str, Union[Column, Series]]] = None) -> Dict[str, Any]:
     """
-    Check that a column has all required values
+    Validate a dataset in a single aggregation job: count rows, nulls in every column, values outside of the allowed
+    domain of some columns, and rows matching some custom conditions
 
     Args:
-        df: spark df
-        colname: column to check
-        colvalues: requires values
-        error_msg: error message to print if values don't match
-    """
-    if set(df.select(colname).distinct().rdd.map(lambda r: r[0]).collect()).union(set(colvalues)) != set(colvalues):
-        raise ValueError(error_msg)
-
+        df: spark or pandas df
+        domains: mapping between columns and the values they can take; nulls are counted as invalid
+        conditions: mapping between names and boolean spark expressions (or pandas series) flagging invalid rows
 
-def standardize_col_names(df: SparkDataFrame, col_names: Dict[str, str]) -> SparkDataFrame:
+    Returns: validation report - {'rows': 100, 'nulls': {'caller_id': 0, ...}, 'invalid': {'txn_type': 0, ...}}
+    """
+    domains = domains if domains is not None else {}
+    conditions = conditions if conditions is not None else {}
+
+    if isinstance(df, PandasDataFrame):
+        report = {'rows': len(df), 'nulls': {c: int(n) for c, n in df.isna().sum().items()}, 'invalid': {}}
+        report['invalid'].update({c: int((df[c].isna() | ~df[c].isin(values)).sum()) for c, values in domains.items()})
+        report['invalid'].update({name: int(condition.sum()) for name, condition in conditions.items()})
+        return report
+
+    # Use positional aliases so that column names never clash with each other
+    aggs = [count(lit(1)).alias('rows')]
+    aggs += [count(when(col(c).isNull(), 1)).alias('null_%i' % i) for i, c in enumerate(df.columns)]
+    aggs += [count(when(col(c).isNull() | ~col(c).isin(values), 1)).alias('domain_%i' % i)
+             for i, (c, values) in enumerate(domains.items())]
+    aggs += [count(when(condition, 1)).alias('condition_%i' % i) for i, condition in enumerate(conditions.values())]
+    row = df.agg(*aggs).collect()[0]
+
+    report: Dict[str, Any] = {'rows': row['rows'],
+                              'nulls': {c: row['null_%i' % i] for i, c in enumerate(df.columns)},
+                              'invalid': {}}
+    report['invalid'].update({c: row['domain_%i' % i] for i, c in enumerate(domains)})
+    report['invalid'].update({name: row['condition_%i' % i] for i, name in enumerate(conditions)})
+
+    return report
+
+
+def standardize_col_names(df: Union[SparkDataFrame, PandasDataFrame],
+                          col_names: Dict[str, str]) -> Union[SparkDataFrame, PandasDataFrame]:
     """
-    Rename columns, as specified in config file, to standard format
+    Rename columns, as specified in config file, to standard format. Columns that are not in the mapping, e.g. the
+    partition columns of partitioned folders ('day' for folder/day=2020-01-01/part-0.csv.gz), are left unchanged,
+    unless a mapped column is renamed to the same name
 
     Args:
-        df: spark df
+        df: spark or pandas df
         col_names: mapping between standard column names and existing ones
 
-    Returns: spark df with standardized column names
+    Returns: df with standardized column names
 
     """
     col_mapping = {v: k for k, v in col_names.items()}
+    dropped = [c for c in df.columns if c not in col_mapping and c in col_names]
 
-    for col in df.columns:
-        df = df.withColumnRenamed(col, col_mapping[col])
+    if isinstance(df, PandasDataFrame):
+        return df.drop(columns=dropped).rename(columns=col_mapping)
 
-    return df
+    df = df.drop(*dropped)
+    return df.toDF(*[col_mapping.get(c, c) for c in df.columns])
 
 
 def load_cdr(cfg: Box,
-             fname: Optional[str] = None,
+             fname: Optional[Paths] = None,
              df: Optional[Union[SparkDataFrame, PandasDataFrame]] = None,
-             verify: bool = True) -> SparkDataFrame:
+             verify: bool = True,
+             report: Optional[Dict[str, Any]] = None,
+             backend: str = 'spark') -> Union[SparkDataFrame, PandasDataFrame]:
     """
     Load CDR data into spark df
 
     Args:
         cfg: box object containing config data
-        fname: path to file or folder with files
+        fname: path to file or folder with files, or list of them
         df: pandas or spark df, if already loaded
         verify: whether to check if right columns and values are present
+        report: dict to fill with the validation report, if verifying
+        backend: 'spark' or 'pandas'
 
-    Returns: spark df
+    Returns: spark or pandas df, depending on the backend
     """
-    spark = get_spark_session(cfg)
     # load data as generic df and standardize column_names
-    if df is not None:
-        if isinstance(df, PandasDataFrame):
-            cdr = spark.createDataFrame(df)
-        elif isinstance(df, SparkDataFrame):
-            cdr = df
-        else:
-            raise TypeError("The dataframe provided should be a spark or pandas df.")
-    elif fname is not None:
-        cdr = load_generic(cfg, fname=fname, df=df)
-    else:
-        raise ValueError('No filename or pandas/spark dataframe provided.')
+    cdr = load_raw_input(cfg, fname, df, 'cdr', backend)
     cdr = standardize_col_names(cdr, cfg.col_names.cdr)
 
     if verify:
@@ -127,52 +561,47 @@ def load_cdr(cfg: Box,
         error_msg = 'CDR format incorrect. CDR must include the following columns: ' + ', '.join(required_cols)
         check_cols(cdr, required_cols, error_msg)
 
-        # Check txn_type column
-        error_msg = 'CDR format incorrect. Column txn_type can only include call and text.'
-        check_colvalues(cdr, 'txn_type', ['call', 'text'], error_msg)
-
-        # Clean international column
-        error_msg = 'CDR format incorrect. Column international can only include domestic, international, and other.'
-        check_colvalues(cdr, 'international', ['domestic', 'international', 'other'], error_msg)
+    # Cast columns that were not parsed with their types (e.g. dfs passed in), and add day column
+    cdr = enforce_schema(cdr, 'cdr', required=['timestamp', 'duration'])
 
-    # Clean timestamp column
-    cdr = cdr.withColumn('timestamp', to_timestamp(cdr['timestamp'], 'yyyy-MM-dd HH:mm:ss')) \
-        .withColumn('day', date_trunc('day', col('timestamp')))
-
-    # Clean duration column
-    cdr = cdr.withColumn('duration', col('duration').cast('float'))
+    if verify:
+        # Check txn_type and international columns
+        validation = validate_dataset(cdr, domains={'txn_type': ['call', 'text'],
+                                                    'international': ['domestic', 'international', 'other']})
+        if report is not None:
+            report.update(validation)
+        if validation['invalid']['txn_type'] > 0:
+            raise ValueError('CDR format incorrect. Column txn_type can only include call and text.')
+        if validation['invalid']['international'] > 0:
+            raise ValueError('CDR format incorrect. Column international can only include domestic, international, '
+                             'and other.')
+
+    cdr = with_day(cdr)
 
     return cdr
 
 
 def load_antennas(cfg: Box,
-                  fname: Optional[str] = None,
+                  fname: Optional[Paths] = None,
                   df: Optional[Union[SparkDataFrame, PandasDataFrame]] = None,
-                  verify: bool = True) -> SparkDataFrame:
+                  verify: bool = True,
+                  report: Optional[Dict[str, Any]] = None,
+                  backend: str = 'spark') -> Union[SparkDataFrame, PandasDataFrame]:
     """
-    Load antennas' dataset, and print % of antennas that are missing coordinates
+    Load antennas' dataset, and count antennas that are missing coordinates in the validation report ('location')
 
     Args:
         cfg: box object containing config data
         fname: path to file
         df: pandas or spark df, if already loaded
         verify: whether to check if right columns and values are present
+        report: dict to fill with the validation report, if verifying
+        backend: 'spark' or 'pandas'
 
-    Returns: spark df
+    Returns: spark or pandas df, depending on the backend
     """
-    spark = get_spark_session(cfg)
     # load data as generic df and standardize column_names
-    if df is not None:
-        if isinstance(df, PandasDataFrame):
-            antennas = spark.createDataFrame(df)
-        elif isinstance(df, SparkDataFrame):
-            antennas = df
-        else:
-            raise TypeError("The dataframe provided should be a spark or pandas df.")
-    elif fname is not None:
-        antennas = load_generic(cfg, fname=fname, df=df)
-    else:
-        raise ValueError('No filename or pandas/spark dataframe provided.')
+    antennas = load_raw_input(cfg, fname, df, 'antennas', backend)
     antennas = standardize_col_names(antennas, cfg.col_names.antennas)
 
     if verify:
@@ -181,120 +610,94 @@ def load_antennas(cfg: Box,
             required_cols)
         check_cols(antennas, required_cols, error_msg)
 
-        antennas = antennas.withColumn('latitude', col('latitude').cast('float')).withColumn('longitude',
-                                                                                             col('longitude').cast(
-                                                                                                 'float'))
-        print('Warning: %i antennas missing location' % (
-                antennas.count() - antennas.select(['latitude', 'longitude']).na.drop().count()))
+    antennas = enforce_schema(antennas, 'antennas')
+
+    if verify:
+        if isinstance(antennas, PandasDataFrame):
+            missing_location = antennas[['latitude', 'longitude']].isna().any(axis=1)
+        else:
+            missing_location = col('latitude').isNull() | col('longitude').isNull()
+        validation = validate_dataset(antennas, conditions={'location': missing_location})
+        if report is not None:
+            report.update(validation)
 
     return antennas
 
 
 def load_recharges(cfg: Box,
-                   fname: Optional[str] = None,
-                   df: Optional[Union[SparkDataFrame, PandasDataFrame]] = None) -> SparkDataFrame:
+                   fname: Optional[Paths] = None,
+                   df: Optional[Union[SparkDataFrame, PandasDataFrame]] = None,
+                   backend: str = 'spark') -> Union[SparkDataFrame, PandasDataFrame]:
     """
     Load recharges' dataset
 
     Args:
         cfg: box object containing config data
-        fname: path to file or folder with files
+        fname: path to file or folder with files, or list of them
         df: pandas or spark df, if already loaded
+        backend: 'spark' or 'pandas'
 
-    Returns: spark df
+    Returns: spark or pandas df, depending on the backend
     """
-    spark = get_spark_session(cfg)
     # load data as generic df and standardize column_names
-    if df is not None:
-        if isinstance(df, PandasDataFrame):
-            recharges = spark.createDataFrame(df)
-        elif isinstance(df, SparkDataFrame):
-            recharges = df
-        else:
-            raise TypeError("The dataframe provided should be a spark or pandas df.")
-    elif fname is not None:
-        recharges = load_generic(cfg, fname=fname, df=df)
-    else:
-        raise ValueError('No filename or pandas/spark dataframe provided.')
+    recharges = load_raw_input(cfg, fname, df, 'recharges', backend)
     recharges = standardize_col_names(recharges, cfg.col_names.recharges)
 
-    # Clean timestamp column
-    recharges = recharges.withColumn('timestamp', to_timestamp('timestamp', 'yyyy-MM-dd HH:mm:ss')) \
-        .withColumn('day', date_trunc('day', col('timestamp')))
-
-    # Clean duration column
-    recharges = recharges.withColumn('amount', col('amount').cast('float'))
+    # Cast columns that were not parsed with their types (e.g. dfs passed in), and add day column
+    recharges = enforce_schema(recharges, 'recharges', required=['timestamp', 'amount'])
+    recharges = with_day(recharges)
 
     return recharges
 
 
 def load_mobiledata(cfg: Box,
-                    fname: Optional[str] = None,
-                    df: Optional[Union[SparkDataFrame, PandasDataFrame]] = None) -> SparkDataFrame:
+                    fname: Optional[Paths] = None,
+                    df: Optional[Union[SparkDataFrame, PandasDataFrame]] = None,
+                    backend: str = 'spark') -> Union[SparkDataFrame, PandasDataFrame]:
     """
     Load mobile data dataset
 
     Args:
         cfg: box object containing config data
-        fname: path to file or folder with files
+        fname: path to file or folder with files, or list of them
         df: pandas or spark df, if already loaded
+        backend: 'spark' or 'pandas'
 
-    Returns: spark df
+    Returns: spark or pandas df, depending on the backend
     """
-    spark = get_spark_session(cfg)
     # load data as generic df and standardize column_names
-    if df is not None:
-        if isinstance(df, PandasDataFrame):
-            mobiledata = spark.createDataFrame(df)
-        elif isinstance(df, SparkDataFrame):
-            mobiledata = df
-        else:
-            raise TypeError("The dataframe provided should be a spark or pandas df.")
-    elif fname is not None:
-        mobiledata = load_generic(cfg, fname=fname, df=df)
-    else:
-        raise ValueError('No filename or pandas/spark dataframe provided.')
+    mobiledata = load_raw_input(cfg, fname, df, 'mobiledata', backend)
 
     mobiledata = standardize_col_names(mobiledata, cfg.col_names.mobiledata)
 
-    # Clean timestamp column
-    mobiledata = mobiledata.withColumn('timestamp', to_timestamp('timestamp', 'yyyy-MM-dd HH:mm:ss')) \
-        .withColumn('day', date_trunc('day', col('timestamp')))
-
-    # Clean duration column
-    mobiledata = mobiledata.withColumn('volume', col('volume').cast('float'))
+    # Cast columns that were not parsed with their types (e.g. dfs passed in), and add day column
+    mobiledata = enforce_schema(mobiledata, 'mobiledata', required=['timestamp', 'volume'])
+    mobiledata = with_day(mobiledata)
 
     return mobiledata
 
 
 def load_mobilemoney(cfg: Box,
-                     fname: Optional[str] = None,
+                     fname: Optional[Paths] = None,
                      df: Optional[Union[SparkDataFrame, PandasDataFrame]] = None,
-                     verify: bool = True) -> SparkDataFrame:
+                     verify: bool = True,
+                     report: Optional[Dict[str, Any]] = None,
+                     backend: str = 'spark') -> Union[SparkDataFrame, PandasDataFrame]:
     """
     Load mobile money dataset
 
     Args:
         cfg: box object containing config data
-        fname: path to file or folder with files
+        fname: path to file or folder with files, or list of them
         df: pandas or spark df, if already loaded
         verify: whether to check if right columns and values are present
+        report: dict to fill with the validation report, if verifying
+        backend: 'spark' or 'pandas'
 
-    Returns: spark df
+    Returns: spark or pandas df, depending on the backend
     """
-    spark = get_spark_session(cfg)
     # load data as generic df and standardize column_names
-    if df is not None:
-        if isinstance(df, PandasDataFrame):
-            mobilemoney = spark.createDataFrame(df)
-        elif isinstance(df, SparkDataFrame):
-            mobilemoney = df
-        else:
-            raise TypeError("The dataframe provided should be a spark or pandas df.")
-    elif fname is not None:
-        mobilemoney = load_generic(cfg, fname=fname, df=df)
-    else:
-        raise ValueError('No filename or pandas/spark dataframe provided.')
+    mobilemoney = load_raw_input(cfg, fname, df, 'mobilemoney', backend)
     mobilemoney = standardize_col_names(mobilemoney, cfg.col_names.mobilemoney)
 
     if verify:
@@ -304,22 +707,19 @@ def load_mobilemoney(cfg: Box,
                     ', '.join(required_cols)
         check_cols(mobilemoney, required_cols, error_msg)
 
+    # Cast columns that were not parsed with their types (e.g. dfs passed in), and add day column
+    mobilemoney = enforce_schema(mobilemoney, 'mobilemoney', required=['timestamp', 'amount'])
+
+    if verify:
         # Check txn_type column
         txn_types = ['cashin', 'cashout', 'p2p', 'billpay', 'other']
-        error_msg = 'Mobile money format incorrect. Column txn_type can only include ' + ', '.join(txn_types)
-        check_colvalues(mobilemoney, 'txn_type', txn_types, error_msg)
-
-    # Clean timestamp column
-    mobilemoney = mobilemoney.withColumn('timestamp', to_timestamp(mobilemoney['timestamp'], 'yyyy-MM-dd HH:mm:ss')) \
-        .withColumn('day', date_trunc('day', col('timestamp')))
-
-    # Clean duration column
-    mobilemoney = mobilemoney.withColumn('amount', col('amount').cast('float'))
+        validation = validate_dataset(mobilemoney, domains={'txn_type': txn_types})
+        if report is not None:
+            report.update(validation)
+        if validation['invalid']['txn_type'] > 0:
+            raise ValueError('Mobile money format incorrect. Column txn_type can only include ' + ', '.join(txn_types))
 
-    # Clean balance columns
-    for c in mobilemoney.columns:
-        if 'balance' in c:
-            mobilemoney = mobilemoney.withColumn(c, col(c).cast('float'))
+    mobilemoney = with_day(mobilemoney)
 
     return mobilemoney
 
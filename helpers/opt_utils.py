@@ -1,6 +1,6 @@
 from functools import reduce
 from pyspark.sql import DataFrame as SparkDataFrame
-from pyspark.sql.functions import lit
+from pyspark.sql.functions import coalesce, col, lit, min
 from typing import List
 
 
@@ -31,3 +31,26 @@ def generate_user_consent_list(data: List[SparkDataFrame], user_id_col: str, opt
         users = users.withColumn('include', lit(False))
 
     return users
+
+
+def apply_consent_changes(consent: SparkDataFrame, changes: SparkDataFrame) -> SparkDataFrame:
+    """
+    Apply a batch of consent changes to the user consent table, and checkpoint the result so that its lineage does not
+    grow with the number of updates
+
+    Args:
+        consent: spark df with user ID and 'include' columns
+        changes: spark df with user ID and new 'include' columns; users that are not in the consent table are ignored
+
+    Returns: updated spark df with user consent
+    """
+    user_id_col = consent.columns[0]
+    changes = (changes
+               .select(col(user_id_col).cast(consent.schema[user_id_col].dataType), col('include').alias('new_include'))
+               .groupby(user_id_col)
+               # If a user both opts in and out within a batch, opting out prevails
+               .agg(min('new_include').alias('new_include')))
+    consent = (consent
+               .join(changes, on=user_id_col, how='left')
+               .select(user_id_col, coalesce(col('new_include'), col('include')).alias('include')))
+    return consent.localCheckpoint()
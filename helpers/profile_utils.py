@@ -0,0 +1,59 @@
+"""
+Profiling of transaction datasets (CDR, recharges, mobile data, mobile money): summary statistics and daily timeseries
+are computed together, in a single pass over the data.
+"""
+from helpers.utils import to_pandas
+import pandas as pd
+from pandas import DataFrame as PandasDataFrame
+from pyspark.sql import DataFrame as SparkDataFrame
+from pyspark.sql.functions import count, countDistinct, grouping_id, lit, max, min
+from typing import Any, Dict, Union
+
+
+def profile_dataset(df: Union[SparkDataFrame, PandasDataFrame]) -> Dict[str, Any]:
+    """
+    Profile a transaction dataset in a single pass. With spark, all statistics come from one rollup aggregation over
+    transaction type and day, whose levels give the daily timeseries, the totals by transaction type, and the totals
+
+    Args:
+        df: spark or pandas df with 'caller_id', 'timestamp' and 'day' columns, and optionally 'txn_type' and
+            'recipient_id'
+
+    Returns: profile - {'statistics': {'Days': 60, 'Transactions': 1000, 'Subscribers': 100, 'Recipients': 90},
+        'daily': pandas df with columns 'txn_type', 'day', 'transactions', 'subscribers'}
+    """
+    has_recipients = 'recipient_id' in df.columns
+
+    if isinstance(df, PandasDataFrame):
+        if 'txn_type' not in df.columns:
+            df = df.assign(txn_type='txn')
+        daily = df.groupby(['txn_type', 'day']).agg(transactions=('caller_id', 'size'),
+                                                    subscribers=('caller_id', 'nunique')).reset_index()
+        totals = {'transactions': len(df), 'subscribers': df['caller_id'].nunique(),
+                  'first': df['timestamp'].min(), 'last': df['timestamp'].max()}
+        if has_recipients:
+            totals['recipients'] = df['recipient_id'].nunique()
+
+    else:
+        if 'txn_type' not in df.columns:
+            df = df.withColumn('txn_type', lit('txn'))
+        aggs = [count(lit(1)).alias('transactions'), countDistinct('caller_id').alias('subscribers'),
+                min('timestamp').alias('first'), max('timestamp').alias('last')]
+        if has_recipients:
+            aggs.append(countDistinct('recipient_id').alias('recipients'))
+        # Level 0 is (txn_type, day), 1 is (txn_type), 3 is the grand total
+        rollup = to_pandas(df.rollup('txn_type', 'day').agg(grouping_id().alias('level'), *aggs))
+        daily = rollup[rollup['level'] == 0][['txn_type', 'day', 'transactions', 'subscribers']]
+        # The grand total is missing if the dataset is empty
+        totals = rollup[rollup['level'] == 3].iloc[0].to_dict() if (rollup['level'] == 3).any() else \
+            {'transactions': 0, 'subscribers': 0, 'recipients': 0, 'first': None, 'last': None}
+
+    first, last = totals['first'], totals['last']
+    statistics = {'Days': (pd.to_datetime(last) - pd.to_datetime(first)).days + 1 if not pd.isna(first) else 0,
+                  'Transactions': int(totals['transactions']),
+                  'Subscribers': int(totals['subscribers'])}
+    if has_recipients:
+        statistics['Recipients'] = int(totals['recipients'])
+
+    daily = daily.assign(day=pd.to_datetime(daily['day'])).sort_values(['txn_type', 'day']).reset_index(drop=True)
+    return {'statistics': statistics, 'daily': daily}
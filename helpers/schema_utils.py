@@ -0,0 +1,166 @@
+import json
+import os
+import pandas as pd
+from pandas import DataFrame as PandasDataFrame
+from pyspark.sql import DataFrame as SparkDataFrame
+from pyspark.sql.functions import col, to_timestamp
+from pyspark.sql.types import DataType, DoubleType, FloatType, StringType, StructField, StructType, TimestampType
+from typing import Dict, List, Mapping, Optional, Union
+
+TIMESTAMP_FORMAT = 'yyyy-MM-dd HH:mm:ss'
+PANDAS_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Types of the standardized columns of each dataset; columns that are not listed take the dataset's default type
+COLUMN_TYPES: Dict[str, Dict[str, DataType]] = {
+    'cdr': {'txn_type': StringType(),
+            'caller_id': StringType(),
+            'recipient_id': StringType(),
+            'timestamp': TimestampType(),
+            'duration': FloatType(),
+            'caller_antenna': StringType(),
+            'recipient_antenna': StringType(),
+            'international': StringType()},
+    'antennas': {'antenna_id': StringType(),
+                 'tower_id': StringType(),
+                 'latitude': FloatType(),
+                 'longitude': FloatType()},
+    'recharges': {'caller_id': StringType(),
+                  'amount': FloatType(),
+                  'timestamp': TimestampType()},
+    'mobiledata': {'caller_id': StringType(),
+                   'volume': FloatType(),
+                   'timestamp': TimestampType()},
+    'mobilemoney': {'txn_type': StringType(),
+                    'caller_id': StringType(),
+                    'recipient_id': StringType(),
+                    'timestamp': TimestampType(),
+                    'amount': FloatType(),
+                    'sender_balance_before': FloatType(),
+                    'sender_balance_after': FloatType(),
+                    'recipient_balance_before': FloatType(),
+                    'recipient_balance_after': FloatType()},
+    'labels': {'name': StringType(),
+               'label': DoubleType(),
+               'weight': DoubleType()},
+    'features': {'name': StringType()}
+}
+
+DEFAULT_TYPES: Dict[str, DataType] = {'features': DoubleType()}
+
+
+def column_type(dataset: str, column: str) -> DataType:
+    """
+    Look up the type of a standardized column in the schema registry
+
+    Args:
+        dataset: name of the dataset, e.g. 'cdr'
+        column: standardized column name
+
+    Returns: spark data type, string if the column is unknown
+    """
+    if column in COLUMN_TYPES[dataset]:
+        return COLUMN_TYPES[dataset][column]
+    # Balance columns in mobile money data can have any name, as long as it includes 'balance'
+    if dataset == 'mobilemoney' and 'balance' in column:
+        return FloatType()
+    return DEFAULT_TYPES.get(dataset, StringType())
+
+
+def raw_schema(dataset: str, header: List[str], col_names: Optional[Mapping[str, str]] = None) -> StructType:
+    """
+    Build the schema of a raw file from its header, so that spark can parse it without inferring or casting types
+
+    Args:
+        dataset: name of the dataset in the schema registry
+        header: column names in the order they appear in the file
+        col_names: mapping between standard column names and the ones used in the file, as in the config file
+
+    Returns: spark schema
+    """
+    col_mapping = {v: k for k, v in col_names.items()} if col_names is not None else {}
+    return StructType([StructField(c, column_type(dataset, col_mapping.get(c, c)), True) for c in header])
+
+
+def enforce_schema(df: Union[SparkDataFrame, PandasDataFrame],
+                   dataset: str,
+                   required: Optional[List[str]] = None) -> Union[SparkDataFrame, PandasDataFrame]:
+    """
+    Cast the columns of a df with standardized column names to the types in the schema registry, in a single projection;
+    columns that already have the right type are left untouched
+
+    Args:
+        df: spark or pandas df
+        dataset: name of the dataset in the schema registry
+        required: columns that must be present; if any is missing spark raises an AnalysisException (ValueError
+            for pandas dfs)
+
+    Returns: df with registry types
+    """
+    if isinstance(df, PandasDataFrame):
+        return _enforce_schema_pandas(df, dataset, required)
+
+    dtypes = dict(df.dtypes)
+    columns = [col(c) for c in (required or []) if c not in dtypes]
+    for c in df.columns:
+        target = column_type(dataset, c)
+        if dtypes[c] == target.simpleString():
+            columns.append(col(c))
+        elif isinstance(target, TimestampType) and dtypes[c] == 'string':
+            columns.append(to_timestamp(col(c), TIMESTAMP_FORMAT).alias(c))
+        else:
+            columns.append(col(c).cast(target).alias(c))
+    return df.select(columns)
+
+
+def _enforce_schema_pandas(df: PandasDataFrame, dataset: str, required: Optional[List[str]] = None) -> PandasDataFrame:
+    missing = [c for c in (required or []) if c not in df.columns]
+    if missing:
+        raise ValueError('Missing columns: ' + ', '.join(missing))
+    columns = {}
+    for c in df.columns:
+        target, values = column_type(dataset, c), df[c]
+        if isinstance(target, TimestampType):
+            if not pd.api.types.is_datetime64_any_dtype(values):
+                values = pd.to_datetime(values, format=PANDAS_TIMESTAMP_FORMAT, errors='coerce')
+        elif isinstance(target, (FloatType, DoubleType)):
+            dtype = 'float32' if isinstance(target, FloatType) else 'float64'
+            values = pd.to_numeric(values, errors='coerce').astype(dtype)
+        elif isinstance(target, StringType):
+            # Keep nulls as nulls rather than the string 'nan'
+            values = values.where(values.isna(), values.astype(str))
+        columns[c] = values
+    return PandasDataFrame(columns, index=df.index)
+
+
+def schema_path(fname: str) -> str:
+    """
+    Path of the schema file stored alongside a derived csv dataset, e.g. features.csv -> features.schema.json
+    """
+    return os.path.splitext(fname)[0] + '.schema.json'
+
+
+def write_schema(schema: StructType, fname: str) -> None:
+    """
+    Store the schema of a derived dataset next to its csv file, so that it can be read back without inference
+
+    Args:
+        schema: spark schema of the dataset
+        fname: path to the csv file
+    """
+    with open(schema_path(fname), 'w') as f:
+        f.write(schema.json())
+
+
+def read_schema(fname: str) -> Optional[StructType]:
+    """
+    Read the schema stored alongside a derived csv dataset, if any
+
+    Args:
+        fname: path to the csv file
+
+    Returns: spark schema, or None if no schema was stored
+    """
+    if not os.path.isfile(schema_path(fname)):
+        return None
+    with open(schema_path(fname), 'r') as f:
+        return StructType.fromJson(json.load(f))
@@ -0,0 +1,74 @@
+"""
+Per-user quantile sketches, built with spark: log-bucketed histograms (DDSketch) stored as map columns from bucket to
+count, so that sketches of different periods (e.g. the days of stored partial aggregates) can be merged by adding up
+the counts of each bucket, and queried, without rescanning the data.
+"""
+import math
+from pyspark.sql import Column, DataFrame as SparkDataFrame
+import pyspark.sql.functions as F
+from pyspark.sql.functions import col
+from typing import List
+
+# Bucket of the quantile sketches in which values that are zero or negative are counted
+ZERO_BUCKET = -2147483648
+
+
+def quantile_gamma(accuracy: float) -> float:
+    """
+    Ratio between consecutive bucket boundaries of a quantile sketch whose quantiles have the given relative accuracy
+    """
+    if not 0 < accuracy < 1:
+        raise ValueError('The relative accuracy of sketches should be between 0 and 1.')
+    return (1 + accuracy) / (1 - accuracy)
+
+
+def quantile_sketch(df: SparkDataFrame, keys: List[str], col_name: str, accuracy: float, alias: str) -> SparkDataFrame:
+    """
+    Build DDSketch quantile sketches of a column: positive values are counted in logarithmic buckets, so that the
+    quantiles derived from the sketch are within the given relative accuracy of the true ones; other values are counted
+    as zero
+
+    Args:
+        df: spark dataframe
+        keys: columns to group by, e.g. ['caller_id']
+        col_name: column whose distribution is sketched
+        accuracy: relative accuracy of the quantiles, e.g. 0.01
+        alias: name of the sketch column
+
+    Returns:
+        df: spark dataframe with the keys and the sketch, a map from bucket to count
+    """
+    gamma = quantile_gamma(accuracy)
+    return (df
+            .where(col(col_name).isNotNull())
+            .withColumn('bucket', F.when(col(col_name) > 0, F.ceil(F.log(col(col_name)) / math.log(gamma)).cast('int'))
+                        .otherwise(ZERO_BUCKET))
+            .groupby(*keys, 'bucket')
+            .agg(F.count(F.lit(1)).alias('n'))
+            .groupby(*keys)
+            .agg(F.map_from_entries(F.collect_list(F.struct('bucket', 'n'))).alias(alias)))
+
+
+def sketch_quantile(col_name: str, quantile: float, accuracy: float) -> Column:
+    """
+    Quantile estimated from quantile sketches
+
+    Args:
+        col_name: column with quantile sketches
+        quantile: quantile to estimate, e.g. 0.5 for the median
+        accuracy: relative accuracy the sketches were built with
+
+    Returns:
+        column with the estimated quantiles, null for empty sketches
+    """
+    gamma = quantile_gamma(accuracy)
+    sketch = f'`{col_name}`'
+    total = f'aggregate(map_values({sketch}), 0L, (acc, n) -> acc + n)'
+    value = f'CASE WHEN e.key = {ZERO_BUCKET} THEN 0D ELSE 2 * pow({gamma}, e.key) / {gamma + 1} END'
+    # Walk through buckets in increasing order until the rank of the quantile is reached
+    start = "named_struct('seen', 0L, 'value', CAST(NULL AS DOUBLE))"
+    return F.expr(f"aggregate(array_sort(map_entries({sketch})), {start}, "
+                  f"(acc, e) -> named_struct('seen', acc.seen + e.value, 'value', "
+                  f"CASE WHEN acc.value IS NULL AND acc.seen + e.value > {quantile} * ({total} - 1) THEN {value} "
+                  f"ELSE acc.value END), acc -> acc.value)")
+
@@ -0,0 +1,118 @@
+"""
+Feature store: each feature block is written as a typed parquet dataset, one file per spark partition so that the
+block is written in parallel, together with a manifest of its columns and provenance. Csv copies, e.g. for use outside
+of cider, are only exported on request.
+"""
+from box import Box
+from datetime import datetime
+from helpers.cache_utils import code_version
+from helpers.utils import get_spark_session, save_df
+import json
+import os
+from pyspark.sql import DataFrame as SparkDataFrame
+from pyspark.sql.types import StructType
+from typing import Any, Dict, Optional
+
+# Name of the manifest file within a parquet dataset; spark ignores files starting with '_' when reading the dataset
+MANIFEST = '_manifest.json'
+
+
+def manifest_path(path: str) -> str:
+    """
+    Path of the manifest of a feature block, e.g. features.parquet -> features.parquet/_manifest.json
+    """
+    return os.path.join(path, MANIFEST)
+
+
+def csv_path(path: str) -> str:
+    """
+    Path of the csv copy of a feature block, e.g. features.parquet -> features.csv
+    """
+    return os.path.splitext(path)[0] + '.csv'
+
+
+def save_feature_block(df: SparkDataFrame,
+                       path: str,
+                       block: str,
+                       key: Optional[str] = None,
+                       n_partitions: Optional[int] = None) -> None:
+    """
+    Write a feature block to the feature store as a parquet dataset, with a manifest of its columns and provenance
+
+    Args:
+        df: spark df with a 'name' column and one column per feature
+        path: path to the parquet dataset, e.g. outputs/datasets/features.parquet
+        block: name of the feature block, e.g. 'recharges'
+        key: fingerprint of the inputs, parameters and code the block was computed from, None if unknown
+        n_partitions: number of files to write the block to; by default, one per partition of df
+    """
+    if 'name' not in df.columns:
+        raise ValueError('Feature blocks must include a name column.')
+    if n_partitions is not None:
+        df = df.repartition(n_partitions, 'name')
+    df.write.mode('overwrite').parquet(path)
+
+    manifest: Dict[str, Any] = {
+        'block': block,
+        'columns': [{'name': field.name, 'type': field.dataType.simpleString()} for field in df.schema.fields],
+        'schema': df.schema.jsonValue(),
+        'files': len([f for f in os.listdir(path) if f.endswith('.parquet')]),
+        'fingerprint': key,
+        'code_version': code_version(),
+        'created': datetime.now().isoformat(timespec='seconds')
+    }
+    with open(manifest_path(path), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_manifest(path: str) -> Optional[Dict[str, Any]]:
+    """
+    Read the manifest of a feature block
+
+    Args:
+        path: path to the parquet dataset
+
+    Returns: manifest, or None if the block was not written to the feature store
+    """
+    if not os.path.isfile(manifest_path(path)):
+        return None
+    with open(manifest_path(path), 'r') as f:
+        return json.load(f)
+
+
+def load_feature_block(cfg: Box, path: str) -> SparkDataFrame:
+    """
+    Load a feature block from the feature store, with the schema recorded in its manifest
+
+    Args:
+        cfg: box object containing config data
+        path: path to the parquet dataset
+
+    Returns: spark df
+    """
+    manifest = read_manifest(path)
+    if manifest is None:
+        raise FileNotFoundError('No feature block found at ' + path)
+    spark = get_spark_session(cfg)
+    return spark.read.schema(StructType.fromJson(manifest['schema'])).parquet(path)
+
+
+def export_csv(df: SparkDataFrame, path: str) -> str:
+    """
+    Export a feature block to a single csv file next to its parquet dataset, with the schema stored alongside; the
+    manifest records the export
+
+    Args:
+        df: spark df of the feature block, as loaded with load_feature_block so that it is not recomputed
+        path: path to the parquet dataset
+
+    Returns: path to the csv file
+    """
+    fname = csv_path(path)
+    save_df(df, fname)
+    manifest = read_manifest(path)
+    if manifest is not None:
+        manifest['csv'] = os.path.abspath(fname)
+        with open(manifest_path(path), 'w') as f:
+            json.dump(manifest, f, indent=2)
+    return fname
@@ -1,15 +1,20 @@
+import bandicoot as bc  # type: ignore[import]
 from box import Box
+from collections import Counter
+from datetime import datetime
+from helpers.schema_utils import write_schema
 import numpy as np
 from numpy import ndarray
 import os
 import pandas as pd
 from pandas import DataFrame as PandasDataFrame
+from pyspark import Accumulator, StorageLevel
 from pyspark.sql import DataFrame as SparkDataFrame
-from pyspark.sql.types import IntegerType, StringType
-from pyspark.sql.functions import col, date_format, lit
+from pyspark.sql.types import DecimalType, DoubleType, IntegerType, StringType
+from pyspark.sql.functions import broadcast, col, date_format, lit
 from pyspark.sql import SparkSession
 import shutil
-from typing import List, Tuple, Union
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 from typing_extensions import Literal
 from pathlib import Path
@@ -20,25 +25,112 @@ def get_project_root() -> Path:
     return Path(__file__).parent
 
 
+# Default spark settings for each deployment size; settings in the config file take precedence
+SPARK_PROFILES: Dict[str, Dict[str, Any]] = {
+    'laptop': {'spark.driver.memory': '4g',
+               'spark.driver.maxResultSize': '1g',
+               'spark.sql.shuffle.partitions': 8,
+               'spark.sql.adaptive.enabled': True,
+               'spark.sql.adaptive.coalescePartitions.enabled': True,
+               'spark.sql.adaptive.skewJoin.enabled': True,
+               'spark.sql.execution.arrow.pyspark.enabled': True,
+               'spark.serializer': 'org.apache.spark.serializer.KryoSerializer'},
+    'single_node': {'spark.driver.memory': '32g',
+                    'spark.driver.maxResultSize': '8g',
+                    'spark.sql.shuffle.partitions': 200,
+                    'spark.sql.adaptive.enabled': True,
+                    'spark.sql.adaptive.coalescePartitions.enabled': True,
+                    'spark.sql.adaptive.skewJoin.enabled': True,
+                    'spark.sql.execution.arrow.pyspark.enabled': True,
+                    'spark.serializer': 'org.apache.spark.serializer.KryoSerializer'},
+    'cluster': {'spark.driver.memory': '16g',
+                'spark.driver.maxResultSize': '8g',
+                'spark.executor.memory': '16g',
+                'spark.executor.cores': 4,
+                'spark.sql.shuffle.partitions': 800,
+                'spark.sql.adaptive.enabled': True,
+                'spark.sql.adaptive.coalescePartitions.enabled': True,
+                'spark.sql.adaptive.skewJoin.enabled': True,
+                'spark.sql.execution.arrow.pyspark.enabled': True,
+                'spark.serializer': 'org.apache.spark.serializer.KryoSerializer'}
+}
+
+# Mapping between keys of the spark block of the config file and spark settings
+SPARK_CONFIG_KEYS: Dict[Tuple[str, ...], str] = {
+    ('files', 'max_partition_bytes'): 'spark.sql.files.maxPartitionBytes',
+    ('driver', 'memory'): 'spark.driver.memory',
+    ('driver', 'max_result_size'): 'spark.driver.maxResultSize',
+    ('executor', 'memory'): 'spark.executor.memory',
+    ('executor', 'cores'): 'spark.executor.cores',
+    ('sql', 'shuffle_partitions'): 'spark.sql.shuffle.partitions',
+    ('sql', 'adaptive', 'enabled'): 'spark.sql.adaptive.enabled',
+    ('sql', 'adaptive', 'coalesce_partitions'): 'spark.sql.adaptive.coalescePartitions.enabled',
+    ('sql', 'adaptive', 'skew_join'): 'spark.sql.adaptive.skewJoin.enabled',
+    ('sql', 'arrow'): 'spark.sql.execution.arrow.pyspark.enabled',
+    ('serializer',): 'spark.serializer',
+    ('local_dir',): 'spark.local.dir'
+}
+
+SPARK_SERIALIZERS = {'kryo': 'org.apache.spark.serializer.KryoSerializer',
+                     'java': 'org.apache.spark.serializer.JavaSerializer'}
+
+
+def spark_conf(cfg: Box) -> Dict[str, str]:
+    """
+    Build spark settings from the spark block of the config file: start from the defaults of the profile, if any, and
+    override them with the settings given explicitly
+
+    Args:
+        cfg: box object containing config data
+
+    Returns: dict of spark settings
+    """
+    spark_cfg = cfg.spark
+    # Arrow is used to convert spark dfs to pandas, unless disabled
+    conf: Dict[str, Any] = {'spark.sql.execution.arrow.pyspark.enabled': True}
+
+    # Defaults for the deployment size
+    if 'profile' in spark_cfg and spark_cfg.profile is not None:
+        if spark_cfg.profile not in SPARK_PROFILES:
+            raise ValueError('Spark profile must be one of: ' + ', '.join(SPARK_PROFILES))
+        conf.update(SPARK_PROFILES[spark_cfg.profile])
+
+    # Settings given explicitly
+    for keys, spark_key in SPARK_CONFIG_KEYS.items():
+        value: Any = spark_cfg
+        for key in keys:
+            value = value[key] if isinstance(value, dict) and key in value else None
+        if value is None:
+            continue
+        if spark_key == 'spark.serializer':
+            if value not in SPARK_SERIALIZERS:
+                raise ValueError('Spark serializer must be one of: ' + ', '.join(SPARK_SERIALIZERS))
+            value = SPARK_SERIALIZERS[value]
+        conf[spark_key] = value
+
+    # Fall back to regular conversion if a type is not supported by Arrow
+    conf['spark.sql.execution.arrow.pyspark.fallback.enabled'] = True
+
+    return {k: str(v).lower() if isinstance(v, bool) else str(v) for k, v in conf.items()}
+
+
 def get_spark_session(cfg: Box) -> SparkSession:
     """
     Gets or creates spark session, with context and logging preferences set
     """
     # Build spark session
-    spark = SparkSession \
-        .builder \
-        .appName(cfg.spark.app_name) \
-        .config("spark.sql.files.maxPartitionBytes", cfg.spark.files.max_partition_bytes) \
-        .config("spark.driver.memory", cfg.spark.driver.memory) \
-        .config("spark.driver.maxResultSize", cfg.spark.driver.max_result_size)\
-        .getOrCreate()
+    builder = SparkSession.builder.appName(cfg.spark.app_name)
+    for key, value in spark_conf(cfg).items():
+        builder = builder.config(key, value)
+    spark = builder.getOrCreate()
     spark.sparkContext.setLogLevel(cfg.spark.loglevel)
     return spark
 
 
 def save_df(df: SparkDataFrame, outfname: str, sep: str = ',') -> None:
     """
-    Saves spark dataframe to csv file, using work-around to deal with spark's automatic partitioning and naming
+    Saves spark dataframe to csv file, using work-around to deal with spark's automatic partitioning and naming; the
+    schema is stored alongside so that the file can be read back without inference
     """
     outfolder = outfname[:-4]
     df.repartition(1).write.csv(path=outfolder, mode="overwrite", header="true", sep=sep)
@@ -46,6 +138,17 @@ def save_df(df: SparkDataFrame, outfname: str, sep: str = ',') -> None:
     old_fname = [fname for fname in os.listdir(outfolder) if fname[-4:] == '.csv'][0]
     os.rename(outfolder + '/' + old_fname, outfname)
     shutil.rmtree(outfolder)
+    write_schema(df.schema, outfname)
+
+
+def to_pandas(df: SparkDataFrame) -> PandasDataFrame:
+    """
+    Convert spark dataframe to pandas directly (through Arrow, if enabled), rather than via a csv file on disk; decimal
+    columns are cast to double so that they are converted to numeric rather than object columns
+    """
+    df = df.select([col(c).cast(DoubleType()).alias(c) if isinstance(df.schema[c].dataType, DecimalType) else col(c)
+                    for c in df.columns])
+    return df.toPandas()
 
 
 def save_parquet(df: SparkDataFrame, outfname: str) -> None:
@@ -55,27 +158,85 @@ def save_parquet(df: SparkDataFrame, outfname: str) -> None:
     df.write.mode('overwrite').parquet(outfname)
 
 
-def filter_dates_dataframe(df: SparkDataFrame,
-                           start_date: str, end_date: str, colname: str = 'timestamp') -> SparkDataFrame:
+def persist_df(df: SparkDataFrame, storage: str, path: Optional[str] = None) -> SparkDataFrame:
+    """
+    Materialize a spark dataframe that several computations read, so that its lineage is executed only once
+
+    Args:
+        df: spark dataframe
+        storage: name of a spark storage level, e.g. 'MEMORY_AND_DISK', or 'parquet' to checkpoint the df to disk
+        path: path of the parquet checkpoint
+
+    Returns: materialized df; dfs persisted with a storage level should be unpersisted once no longer needed
+    """
+    if storage == 'parquet':
+        if path is None:
+            raise ValueError('A path is needed to checkpoint a dataframe to parquet.')
+        save_parquet(df, path)
+        return SparkSession.builder.getOrCreate().read.parquet(path)
+    if not isinstance(getattr(StorageLevel, storage, None), StorageLevel):
+        raise ValueError(f"'storage' should be 'parquet' or a spark storage level, not '{storage}'")
+    df = df.persist(getattr(StorageLevel, storage))
+    df.count()
+    return df
+
+
+def filter_dates_dataframe(df: Union[SparkDataFrame, PandasDataFrame],
+                           start_date: str, end_date: str,
+                           colname: str = 'timestamp') -> Union[SparkDataFrame, PandasDataFrame]:
     """
     Filter dataframe rows whose timestamp is outside [start_date, end_date)
 
+    If the df has a day column, the filter is also expressed on it, so that day-partitioned datasets (see the ingest
+    cache) only read the partitions inside the date range
+
     Args:
-        df: spark df
+        df: spark or pandas df
         start_date: initial date to keep
         end_date: first date to exclude
         colname: name of timestamp column
 
-    Returns: filtered spark df
+    Returns: filtered df
 
     """
     if colname not in df.columns:
         raise ValueError('Cannot filter dates because missing timestamp column')
+    if isinstance(df, PandasDataFrame):
+        keep = ((df[colname] >= pd.to_datetime(start_date)) &
+                (df[colname] < pd.to_datetime(end_date) + pd.Timedelta(value=1, unit='days')))
+        return df[keep]
+    if 'day' in df.columns:
+        df = df.where(col('day') >= pd.to_datetime(start_date).floor('D'))
+        df = df.where(col('day') <= pd.to_datetime(end_date).floor('D'))
     df = df.where(col(colname) >= pd.to_datetime(start_date))
     df = df.where(col(colname) < pd.to_datetime(end_date) + pd.Timedelta(value=1, unit='days'))
     return df
 
 
+def remove_ids(df: SparkDataFrame,
+               ids: SparkDataFrame,
+               colnames: List[str],
+               broadcast_ids: bool = True) -> SparkDataFrame:
+    """
+    Remove rows whose value in any of the columns appears in a df of IDs, using left-anti joins rather than literal
+    lists of IDs in the query plan
+
+    Args:
+        df: spark df
+        ids: single-column spark df of IDs to remove
+        colnames: columns of df to match against the IDs, e.g. ['caller_id', 'recipient_id']
+        broadcast_ids: whether to broadcast the IDs to all executors; should be disabled when there are too many IDs
+            to fit in memory, in which case spark falls back to a shuffled anti-join
+
+    Returns: filtered spark df
+    """
+    id_col = ids.columns[0]
+    for c in colnames:
+        right = ids.select(col(id_col).alias(c))
+        df = df.join(broadcast(right) if broadcast_ids else right, on=c, how='left_anti')
+    return df
+
+
 def make_dir(fname: str, remove: bool = False) -> None:
     """
     Create new directory
@@ -93,18 +254,6 @@ def flatten_lst(lst: List[List]) -> List:
     return [item for sublist in lst for item in sublist]
 
 
-def flatten_folder(args: Tuple) -> List[str]:
-    ids, recs_folder = args
-    unmatched: List[str] = []
-    for p in ids:
-        try:
-            fname = 'name=' + p
-            os.system('mv ' + recs_folder + '/' + fname + '/*.csv ' + recs_folder + '/' + p + '.csv')
-        except:
-            unmatched = unmatched + [p]
-    return unmatched
-
-
 def cdr_bandicoot_format(cdr: SparkDataFrame, antennas: SparkDataFrame, cfg: Box) -> SparkDataFrame:
     """
     Convert CDR df into format that can be used by bandicoot
@@ -152,6 +301,45 @@ def cdr_bandicoot_format(cdr: SparkDataFrame, antennas: SparkDataFrame, cfg: Box
     return cdr_bandicoot
 
 
+def bandicoot_user(name: str, records: Iterable[Dict[str, Any]], skipped: Optional[Accumulator] = None) -> Any:
+    """
+    Build a bandicoot user in memory from its records in bandicoot format, as bc.read_csv would from a csv file with
+    the user's records, so that features can be computed without writing one file per user. As with bc.read_csv,
+    records that cannot be parsed are skipped rather than failing the whole user
+
+    Args:
+        name: user id
+        records: records of the user, as dicts with the columns of cdr_bandicoot_format
+        skipped: spark accumulator to which the number of records skipped is added, if provided
+
+    Returns: bandicoot User object
+    """
+    def to_record(r: Dict[str, Any]) -> Any:
+        location = (float(r['latitude']), float(r['longitude'])) \
+            if r.get('latitude') not in (None, '') and r.get('longitude') not in (None, '') else None
+        return bc.core.Record(interaction=r['interaction'] if r['interaction'] else None,
+                              direction=r['direction'],
+                              correspondent_id=r['correspondent_id'],
+                              datetime=datetime.strptime(r['datetime'], '%Y-%m-%d %H:%M:%S') if r['datetime'] else None,
+                              call_duration=int(r['call_duration']) if r['call_duration'] else None,
+                              position=bc.core.Position(antenna=r['antenna_id'] if r['antenna_id'] else None,
+                                                        location=location))
+
+    parsed = []
+    n_skipped = 0
+    for r in records:
+        try:
+            parsed.append(to_record(r))
+        except ValueError:
+            n_skipped += 1
+    if skipped is not None and n_skipped > 0:
+        skipped.add(n_skipped)
+
+    # Depending on the bandicoot version, load returns the user alone or along with the records it rejected
+    user = bc.io.load(name, parsed, {}, describe=False, warnings=False)
+    return user[0] if isinstance(user, tuple) else user
+
+
 def long_join_pandas(dfs: List[PandasDataFrame], on: str,
                      how: Union[Literal['left'], Literal['right'],
                                 Literal['outer'], Literal['inner']]) -> PandasDataFrame:
@@ -188,6 +376,48 @@ def long_join_pyspark(dfs: List[SparkDataFrame], on: str, how: str) -> SparkData
     return df
 
 
+def wide_join_pyspark(dfs: List[SparkDataFrame], on: str, how: str) -> SparkDataFrame:
+    """
+    Join list of spark dfs with one row per key and distinct columns, e.g. feature blocks, without reshuffling the
+    joined df at each step: every df is hash partitioned on the join column into the same number of partitions, and
+    each df is then joined onto a base that keeps this partitioning - the first df for left and inner joins, the
+    distinct keys of all dfs for outer joins - so that each join only needs to shuffle the df it adds once
+
+    Args:
+        dfs: list of spark df
+        on: column on which to join
+        how: type of join - 'outer', 'left' (keys of the first df) or 'inner'
+
+    Returns: single joined spark df
+    """
+    if how not in ['outer', 'full', 'left', 'inner']:
+        raise ValueError('Join type must be one of: outer, full, left, inner')
+    columns = [c for df in dfs for c in df.columns if c != on]
+    duplicated = sorted(c for c, n in Counter(columns).items() if n > 1)
+    if duplicated:
+        raise ValueError('Columns to join should only appear in one df, found duplicates: ' + ', '.join(duplicated))
+    if len(dfs) == 1:
+        return dfs[0]
+
+    # Partition all dfs as the joins require, so that the joins themselves do not shuffle them
+    n_partitions = int(dfs[0].sql_ctx.getConf('spark.sql.shuffle.partitions'))
+    dfs = [df.repartition(n_partitions, on) for df in dfs]
+
+    # Left and inner joins keep the partitioning of their left side, unlike outer joins: outer joins are made as left
+    # joins onto the keys of all dfs
+    if how in ['outer', 'full']:
+        keys = dfs[0].select(on)
+        for df in dfs[1:]:
+            keys = keys.union(df.select(on))
+        df = keys.distinct().repartition(n_partitions, on)
+        how = 'left'
+    else:
+        df, dfs = dfs[0], dfs[1:]
+    for other in dfs:
+        df = df.join(other, on=on, how=how)
+    return df.select(on, *columns)
+
+
 def strictly_increasing(L: List[float]) -> bool:
     # Check that the list's values are strictly increasing
     return all(x < y for x, y in zip(L, L[1:]))
@@ -0,0 +1,194 @@
+"""
+Weighted versions of the statistics used to evaluate targeting and fairness. Each record carries a weight, and results
+are the same as if each record was repeated 'weight' times (weights being normalized so that the smallest is 1), but
+memory stays proportional to the number of records.
+"""
+from helpers.utils import weighted_corr, weighted_mean
+import numpy as np
+from numpy import ndarray
+from scipy.stats import f  # type: ignore[import]
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def targeted_weights(values: ndarray, weights: ndarray, p: float, tiebreak: Optional[ndarray] = None) -> ndarray:
+    """
+    Simulate targeting of the bottom p% of the (weighted) population according to 'values'. The record at the boundary
+    can be partly targeted, as only some of its repetitions would be in the expanded data.
+
+    Args:
+        values: Values by which to rank records, the lowest ones being targeted first.
+        weights: Weight of each record.
+        p: Percentage of the population to target.
+        tiebreak: Secondary values used to rank records with equal values.
+
+    Returns: Targeted weight of each record, between 0 and its weight.
+    """
+    values, weights = np.asarray(values, dtype='float'), np.asarray(weights, dtype='float')
+    order = np.lexsort((tiebreak, values)) if tiebreak is not None else np.argsort(values, kind='mergesort')
+
+    # Fill the budget of targeted weight following the ranking
+    num_targeted = int((p/100)*weights.sum())
+    sorted_weights = weights[order]
+    weight_before = np.cumsum(sorted_weights) - sorted_weights
+    targeted = np.empty_like(weights)
+    targeted[order] = np.clip(num_targeted - weight_before, 0, sorted_weights)
+    return targeted
+
+
+def share_below(values: ndarray, weights: ndarray, t: float) -> float:
+    """
+    Percentage of the (weighted) population whose value is below a threshold.
+
+    Args:
+        values: Vector of values.
+        weights: Weight of each record.
+        t: The threshold.
+
+    Returns: Percentage between 0 and 100.
+    """
+    values, weights = np.asarray(values), np.asarray(weights, dtype='float')
+    return 100*weights[values < t].sum()/weights.sum()
+
+
+def targeted_overlap(targeted1: ndarray, targeted2: ndarray, weights: ndarray) -> ndarray:
+    """
+    Weight of each record that is targeted by both methods; when a record is only partly targeted, its repetitions are
+    assumed to be targeted independently by the two methods.
+
+    Args:
+        targeted1: Targeted weight of each record according to the first method.
+        targeted2: Targeted weight of each record according to the second method.
+        weights: Weight of each record.
+
+    Returns: Weight of each record targeted by both methods.
+    """
+    return np.asarray(targeted1)*np.asarray(targeted2)/np.asarray(weights, dtype='float')
+
+
+def confusion_matrix(targeted1: ndarray, targeted2: ndarray, weights: ndarray) -> Tuple[float, float, float, float]:
+    """
+    Weighted confusion matrix of two targeting methods, the first one being the ground truth.
+
+    Args:
+        targeted1: Targeted weight of each record according to the ground truth.
+        targeted2: Targeted weight of each record according to the proxy.
+        weights: Weight of each record.
+
+    Returns: Tuple with weight of true negatives, false positives, false negatives, true positives.
+    """
+    tp = targeted_overlap(targeted1, targeted2, weights).sum()
+    fp = np.sum(targeted2) - tp
+    fn = np.sum(targeted1) - tp
+    tn = np.sum(weights) - tp - fp - fn
+    return tn, fp, fn, tp
+
+
+def roc_inputs(targeted: ndarray, scores: ndarray, weights: ndarray) -> Tuple[ndarray, ndarray, ndarray]:
+    """
+    Split each record into a positive and a negative part, weighted by its targeted and non-targeted weight, to be
+    passed to sklearn's roc_auc_score and roc_curve as labels, scores and sample weights.
+
+    Args:
+        targeted: Targeted weight of each record according to the ground truth.
+        scores: Scores of the records.
+        weights: Weight of each record.
+
+    Returns: Tuple with labels, scores and sample weights.
+    """
+    targeted, scores = np.asarray(targeted, dtype='float'), np.asarray(scores, dtype='float')
+    labels = np.concatenate([np.ones(len(targeted)), np.zeros(len(targeted))])
+    sample_weights = np.concatenate([targeted, np.asarray(weights, dtype='float') - targeted])
+    scores = np.concatenate([scores, scores])
+    keep = sample_weights > 0
+    return labels[keep], scores[keep], sample_weights[keep]
+
+
+def weighted_ranks(values: ndarray, weights: ndarray) -> ndarray:
+    """
+    Ranks of the records in the (weighted) population, ties getting the average of the ranks they span, as in
+    scipy.stats.rankdata.
+
+    Args:
+        values: Vector of values.
+        weights: Weight of each record.
+
+    Returns: Rank of each record, starting from 1.
+    """
+    values, weights = np.asarray(values, dtype='float'), np.asarray(weights, dtype='float')
+    unique_values, inverse = np.unique(values, return_inverse=True)
+    group_weights = np.bincount(inverse, weights=weights, minlength=len(unique_values))
+    weight_before = np.cumsum(group_weights) - group_weights
+    return (weight_before + (group_weights + 1)/2)[inverse]
+
+
+def weighted_spearman(x: ndarray, y: ndarray, w: ndarray) -> float:
+    return weighted_corr(weighted_ranks(x, w), weighted_ranks(y, w), np.asarray(w, dtype='float'))
+
+
+def weighted_std(x: ndarray, w: ndarray) -> float:
+    return np.sqrt(np.sum(w * (x - weighted_mean(x, w))**2) / np.sum(w))
+
+
+def weighted_f_oneway(samples: List[Tuple[ndarray, ndarray]]) -> Tuple[float, float]:
+    """
+    One-way ANOVA on weighted samples, as scipy.stats.f_oneway.
+
+    Args:
+        samples: List of (values, weights) tuples, one for each group.
+
+    Returns: Tuple with F statistic and p-value.
+    """
+    values = [np.asarray(x, dtype='float') for x, _ in samples]
+    weights = [np.asarray(w, dtype='float') for _, w in samples]
+    n_groups, n_total = len(samples), np.sum([w.sum() for w in weights])
+    grand_mean = np.sum([np.sum(x*w) for x, w in zip(values, weights)])/n_total
+
+    # Between- and within-group sums of squares
+    ss_between = np.sum([w.sum()*(weighted_mean(x, w) - grand_mean)**2 for x, w in zip(values, weights)])
+    ss_within = np.sum([np.sum(w*(x - weighted_mean(x, w))**2) for x, w in zip(values, weights)])
+
+    f_stat = (ss_between/(n_groups - 1))/(ss_within/(n_total - n_groups))
+    return f_stat, f.sf(f_stat, n_groups - 1, n_total - n_groups)
+
+
+def weighted_quantile(values: ndarray, weights: ndarray, q: float) -> float:
+    """
+    Quantile of the (weighted) population, with linear interpolation as in numpy.percentile.
+
+    Args:
+        values: Vector of values.
+        weights: Weight of each record.
+        q: Quantile, between 0 and 1.
+
+    Returns: Value of the quantile.
+    """
+    values, weights = np.asarray(values, dtype='float'), np.asarray(weights, dtype='float')
+    order = np.argsort(values, kind='mergesort')
+    values, cum_weights = values[order], np.cumsum(weights[order])
+
+    # Position of the quantile among repetitions, and the records found at the positions around it
+    position = q*(cum_weights[-1] - 1)
+    lower = values[np.searchsorted(cum_weights, np.floor(position), side='right')]
+    upper = values[min(np.searchsorted(cum_weights, np.ceil(position), side='right'), len(values) - 1)]
+    return lower + (upper - lower)*(position - np.floor(position))
+
+
+def boxplot_stats(values: ndarray, weights: ndarray, label: Any, whis: float = 1.5) -> Dict[str, Any]:
+    """
+    Box plot statistics of the (weighted) population without fliers, as in matplotlib.cbook.boxplot_stats, to be
+    passed to matplotlib's Axes.bxp.
+
+    Args:
+        values: Vector of values.
+        weights: Weight of each record.
+        label: Label of the box.
+        whis: Length of the whiskers, as a multiple of the interquartile range.
+
+    Returns: Dict with box plot statistics.
+    """
+    values = np.asarray(values, dtype='float')
+    q1, med, q3 = [weighted_quantile(values, weights, q) for q in [.25, .5, .75]]
+    iqr = q3 - q1
+    low, high = values[values >= q1 - whis*iqr], values[values <= q3 + whis*iqr]
+    return {'label': label, 'med': med, 'q1': q1, 'q3': q3, 'fliers': [],
+            'whislo': min(low.min(), q1) if len(low) else q1, 'whishi': max(high.max(), q3) if len(high) else q3}
@@ -9,13 +9,17 @@ from pandas import DataFrame as PandasDataFrame, Series
 from pyspark.sql import DataFrame as SparkDataFrame
 from pyspark.sql import functions as F
 from pyspark.sql.functions import col
+from pyspark.sql.types import StructType
 from pyspark.sql.utils import AnalysisException
 from typing import Dict, MutableMapping, Type
 
 import pytest
 from pytest_mock import mocker, MockerFixture
 
+import cider.datastore
+import helpers.io_utils
 from cider.datastore import DataStore, DataType, OptDataStore
+from helpers.store_utils import read_manifest, save_feature_block
 from helpers.utils import get_project_root, get_spark_session
 
 malformed_dataframes_and_errors = {
@@ -93,6 +97,8 @@ class TestDatastoreClasses:
         assert ds.cdr.count() == 1e5
         assert 'day' in ds.cdr.columns
         assert len(ds.cdr.columns) == 9
+        assert ds.validation_reports['cdr']['rows'] == 1e5
+        assert ds.validation_reports['cdr']['invalid'] == {'txn_type': 0, 'international': 0}
 
         test_df = pd.DataFrame(data={'txn_type': ['text'], 'caller_id': ['A'], 'recipient_id': ['B'],
                                      'timestamp': ['2021-01-01'], 'duration': [60], 'international': ['domestic']})
@@ -117,6 +123,160 @@ class TestDatastoreClasses:
         with pytest.raises(expected_error):
             ds._load_cdr(dataframe=dataframe)
 
+    @pytest.mark.unit_test
+    def test_load_cdr_ingest_cache(self, mocker: MockerFixture, ds: DataStore, tmp_path) -> None:
+        ds.ingest_cache = True
+        ds.outputs = str(tmp_path)
+        ds._load_cdr()
+        assert os.path.isfile(os.path.join(str(tmp_path), 'ingest', 'cdr', '_manifest.json'))
+        assert any(d.startswith('day=') for d in os.listdir(os.path.join(str(tmp_path), 'ingest', 'cdr')))
+
+        # Second load should be served from parquet without going through the loader
+        mock_load_cdr = mocker.patch("cider.datastore.load_cdr", autospec=True)
+        ds._load_cdr()
+        assert not mock_load_cdr.called
+        assert ds.cdr.count() == 1e5
+        assert dict(ds.cdr.dtypes)['timestamp'] == 'timestamp'
+        assert dict(ds.cdr.dtypes)['day'] == 'timestamp'
+        assert ds.validation_reports['cdr']['rows'] == 1e5
+
+    @pytest.mark.unit_test
+    def test_load_cdr_ingest_settings(self, mocker: MockerFixture, ds: DataStore, tmp_path) -> None:
+        ds.ingest_cache = True
+        ds.outputs = str(tmp_path)
+        ds._load_cdr()
+
+        # Raw files are unchanged, but they are parsed differently: the parquet copy should not be reused
+        ds.cfg.ingest.parse_mode = 'DROPMALFORMED'
+        spy_load_cdr = mocker.spy(cider.datastore, 'load_cdr')
+        ds._load_cdr()
+        assert spy_load_cdr.call_count == 1
+        ds._load_cdr()
+        assert spy_load_cdr.call_count == 1
+
+        # A new version of the parsing also invalidates the parquet copy
+        mocker.patch('helpers.io_utils.INGEST_VERSION', helpers.io_utils.INGEST_VERSION + 1)
+        ds._load_cdr()
+        assert spy_load_cdr.call_count == 2
+
+    @pytest.mark.unit_test
+    def test_load_cdr_ingest_append(self, mocker: MockerFixture, ds: DataStore, tmp_path) -> None:
+        cdr = pd.read_csv(os.path.join(ds.data, ds.file_names.cdr))
+        days = pd.to_datetime(cdr['timestamp']).dt.strftime('%Y-%m-%d')
+        last_day = days.max()
+        os.makedirs(os.path.join(str(tmp_path), 'cdr'))
+        cdr[days < last_day].to_csv(os.path.join(str(tmp_path), 'cdr', 'week1.csv'), index=False)
+        ds.cfg.ingest.append = True
+        ds.ingest_cache = True
+        ds.outputs = str(tmp_path)
+        ds.data = str(tmp_path)
+        ds.file_names.cdr = 'cdr'
+        ds._load_cdr()
+        assert last_day not in ds.ingest_info['cdr']['days']
+
+        # A new delivery only goes through the loader for the new file, and adds its days to the parquet dataset
+        cdr[days == last_day].to_csv(os.path.join(str(tmp_path), 'cdr', 'week2.csv'), index=False)
+        spy_load_cdr = mocker.spy(cider.datastore, 'load_cdr')
+        ds._load_cdr()
+        assert spy_load_cdr.call_count == 1
+        assert [os.path.basename(f) for f in spy_load_cdr.call_args[0][1]] == ['week2.csv']
+        assert ds.ingest_info['cdr']['new_days'] == [last_day]
+        assert ds.cdr.count() == len(cdr)
+        assert ds.new_data('cdr').count() == (days == last_day).sum()
+        assert ds.validation_reports['cdr']['rows'] == len(cdr)
+
+    @pytest.mark.unit_test
+    def test_load_cdr_ingest_append_interrupted(self, mocker: MockerFixture, ds: DataStore, tmp_path) -> None:
+        cdr = pd.read_csv(os.path.join(ds.data, ds.file_names.cdr))
+        days = pd.to_datetime(cdr['timestamp']).dt.strftime('%Y-%m-%d')
+        os.makedirs(os.path.join(str(tmp_path), 'cdr'))
+        cdr[days < days.max()].to_csv(os.path.join(str(tmp_path), 'cdr', 'week1.csv'), index=False)
+        ds.cfg.ingest.append = True
+        ds.ingest_cache = True
+        ds.outputs = str(tmp_path)
+        ds.data = str(tmp_path)
+        ds.file_names.cdr = 'cdr'
+        ds._load_cdr()
+
+        # The process stops after the new files are moved into the dataset, but before the manifest is updated
+        cdr[days == days.max()].to_csv(os.path.join(str(tmp_path), 'cdr', 'week2.csv'), index=False)
+        write_json = helpers.io_utils.write_json
+
+        def write_json_interrupted(obj, path):
+            if path.endswith('_manifest.json'):
+                raise KeyboardInterrupt
+            write_json(obj, path)
+        mocker.patch("helpers.io_utils.write_json", side_effect=write_json_interrupted)
+        with pytest.raises(KeyboardInterrupt):
+            ds._load_cdr()
+        mocker.stopall()
+
+        # The next load rolls back the interrupted append and appends the new file once
+        ds._load_cdr()
+        assert ds.cdr.count() == len(cdr)
+        assert not os.path.isfile(os.path.join(str(tmp_path), 'ingest', 'cdr', '_appending.json'))
+
+    @pytest.mark.unit_test
+    def test_load_cdr_compressed(self, ds: DataStore, tmp_path) -> None:
+        cdr = pd.read_csv(os.path.join(ds.data, ds.file_names.cdr))
+        for i, day in enumerate(['2020-01-01', '2020-01-02']):
+            os.makedirs(os.path.join(str(tmp_path), 'day=' + day))
+            cdr.iloc[i::2].to_csv(os.path.join(str(tmp_path), 'day=' + day, 'part-0.csv.gz'), index=False)
+        ds.data = str(tmp_path)
+        ds.file_names.cdr = '.'
+        ds._load_cdr()
+        assert ds.cdr.count() == len(cdr)
+        assert dict(ds.cdr.dtypes)['timestamp'] == 'timestamp'
+        # The day partition column of the folder is replaced by the day of the timestamp
+        assert dict(ds.cdr.dtypes)['day'] == 'timestamp'
+        assert len(ds.cdr.columns) == 9
+
+    @pytest.mark.unit_test
+    def test_load_cdr_partitioned_pandas_backend(self, datastore_class: Type[DataStore], tmp_path) -> None:
+        ds = datastore_class(cfg_dir="configs/test_config.yml", spark=False)
+        cdr = pd.read_csv(os.path.join(ds.data, ds.file_names.cdr))
+        for i, day in enumerate(['2020-01-01', '2020-01-02']):
+            os.makedirs(os.path.join(str(tmp_path), 'day=' + day))
+            cdr.iloc[i::2].to_csv(os.path.join(str(tmp_path), 'day=' + day, 'part-0.csv'), index=False)
+        ds.data = str(tmp_path)
+        ds.file_names.cdr = '.'
+        ds._load_cdr()
+        assert len(ds.cdr) == len(cdr)
+        assert pd.api.types.is_datetime64_any_dtype(ds.cdr['day'])
+        assert (ds.cdr['day'] == ds.cdr['timestamp'].dt.floor('D')).all()
+
+    @pytest.mark.unit_test
+    def test_load_cdr_pandas_backend(self, datastore_class: Type[DataStore]) -> None:
+        ds = datastore_class(cfg_dir="configs/test_config.yml", spark=False)
+        assert ds.spark is None
+        test_df = pd.DataFrame(data={'txn_type': ['text', 'call'], 'caller_id': ['A', 'A'], 'recipient_id': ['B', 'C'],
+                                     'timestamp': ['2021-01-01 10:00:00', '2021-01-03 10:00:00'],
+                                     'duration': ['60', '120'], 'international': ['domestic'] * 2})
+        ds._load_cdr(dataframe=test_df)
+        assert isinstance(ds.cdr, PandasDataFrame)
+        assert pd.api.types.is_datetime64_any_dtype(ds.cdr['day'])
+        assert ds.cdr['duration'].dtype == 'float32'
+        assert ds.validation_reports['cdr']['invalid'] == {'txn_type': 0, 'international': 0}
+
+        ds.filter_dates('2021-01-01', '2021-01-02')
+        assert len(ds.cdr) == 1
+        assert len(ds.remove_spammers(spammer_threshold=0)) == 1
+        assert len(ds.cdr) == 0
+
+    @pytest.mark.unit_test
+    def test_new_data_pandas_backend(self, datastore_class: Type[DataStore]) -> None:
+        ds = datastore_class(cfg_dir="configs/test_config.yml", spark=False)
+        test_df = pd.DataFrame(data={'txn_type': ['text', 'call'], 'caller_id': ['A', 'A'], 'recipient_id': ['B', 'C'],
+                                     'timestamp': ['2021-01-01 10:00:00', '2021-01-03 10:00:00'],
+                                     'duration': ['60', '120'], 'international': ['domestic'] * 2})
+        ds._load_cdr(dataframe=test_df)
+        assert len(ds.new_data('cdr')) == 2
+
+        ds.ingest_info['cdr'] = {'days': {'2021-01-01': 1, '2021-01-03': 1}, 'new_days': ['2021-01-03']}
+        new_cdr = ds.new_data('cdr')
+        assert isinstance(new_cdr, PandasDataFrame)
+        assert list(new_cdr['recipient_id']) == ['C']
+
     @pytest.mark.unit_test
     def test_load_antennas(self, ds: Type[DataStore]) -> None:
         ds._load_antennas()
@@ -124,6 +284,7 @@ class TestDatastoreClasses:
         assert ds.antennas.count() == 297
         assert dict(ds.antennas.dtypes)['latitude'] == 'float'
         assert len(ds.antennas.columns) == 4
+        assert ds.validation_reports['antennas']['rows'] == 297
 
         test_df = pd.DataFrame(data={'antenna_id': ['1'], 'latitude': ['10'], 'longitude': ['25.3']})
         ds._load_antennas(dataframe=test_df)
@@ -263,6 +424,18 @@ class TestDatastoreClasses:
         assert isinstance(ds.features, SparkDataFrame)
         assert ds.features.count() == 1e3
 
+    @pytest.mark.unit_test
+    def test_load_features_store(self, ds: Type[DataStore], tmp_path) -> None:
+        ds._load_features()
+        path = os.path.join(str(tmp_path), 'features.parquet')
+        save_feature_block(ds.features, path, 'all')
+        assert read_manifest(path)['columns'][0] == {'name': 'name', 'type': 'string'}
+
+        ds.cfg.path.features = path
+        ds._load_features()
+        assert ds.features.schema == StructType.fromJson(read_manifest(path)['schema'])
+        assert ds.features.count() == 1e3
+
     @pytest.mark.unit_test
     def test_load_features_raises(self, mock_dataframe_reader: MockerFixture, ds: Type[DataStore]) -> None:
         dataframe = pd.DataFrame(data={'user_id': ['X'], 'feat0': [50]})
@@ -293,8 +466,8 @@ class TestDatastoreClasses:
         assert isinstance(ds.unweighted_targeting, PandasDataFrame)
         assert 'random' in ds.targeting.columns
         assert (ds.unweighted_targeting['weight'].values == np.ones(1000)).all()
-        new_len = ds.weighted_targeting.drop_duplicates()['weight'].sum()
-        assert ds.weighted_targeting.shape[0] == new_len
+        assert ds.weighted_targeting.shape[0] == ds.targeting.shape[0]
+        assert ds.weighted_targeting['weight'].min() == 1
 
     @pytest.mark.unit_test
     def test_load_fairness(self, ds: Type[DataStore]) -> None:
@@ -304,8 +477,8 @@ class TestDatastoreClasses:
         assert isinstance(ds.unweighted_fairness, PandasDataFrame)
         assert 'random' in ds.fairness.columns
         assert (ds.unweighted_fairness['weight'].values == np.ones(1000)).all()
-        new_len = ds.weighted_fairness.drop_duplicates()['weight'].sum()
-        assert ds.weighted_fairness.shape[0] == new_len
+        assert ds.weighted_fairness.shape[0] == ds.fairness.shape[0]
+        assert ds.weighted_fairness['weight'].min() == 1
 
     @pytest.mark.unit_test
     def test_load_survey(self, ds: Type[DataStore]) -> None:
@@ -330,6 +503,7 @@ class TestDatastoreClasses:
 
         assert isinstance(ds.merged, PandasDataFrame)
         assert ds.merged.shape[0] == 50
+        assert ds.merged['label'].dtype == 'float64'
 
         assert isinstance(ds.x, PandasDataFrame)
         assert all(col not in ds.x.columns for col in ['name', 'label', 'weight'])
@@ -364,6 +538,26 @@ class TestDatastoreClasses:
     def test_load_data(self, ds: Type[DataStore], data_type_map) -> None:
         ds.load_data(data_type_map)
 
+    @pytest.mark.unit_test
+    def test_load_data_lazy(self, mocker: MockerFixture, ds: DataStore) -> None:
+        spy_load_cdr = mocker.spy(ds, '_load_cdr')
+        spy_load_recharges = mocker.spy(ds, '_load_recharges')
+        ds.data_type_to_fn_map[DataType.CDR] = ds._load_cdr
+        ds.data_type_to_fn_map[DataType.RECHARGES] = ds._load_recharges
+        ds.load_data({DataType.CDR: None, DataType.RECHARGES: None}, lazy=True)
+        assert not spy_load_cdr.called and not spy_load_recharges.called
+
+        # Only the dataset accessed is loaded, once
+        assert ds.recharges.count() > 0
+        assert ds.recharges is ds.recharges
+        assert spy_load_recharges.call_count == 1
+        assert not spy_load_cdr.called
+
+        # Datasets that are neither loaded nor registered are None, other attributes do not exist
+        assert ds.mobilemoney is None
+        with pytest.raises(AttributeError):
+            _ = ds.not_a_dataset
+
     @pytest.mark.unit_test
     def test_filter_dates(self, ds: Type[DataStore]):
         # Load two datasets
@@ -434,15 +628,61 @@ class TestDatastoreClasses:
         mock_dataframe_reader.return_value.csv.return_value = ds.spark.createDataFrame(df)
         ds._load_cdr()
         spammers = ds.remove_spammers(spammer_threshold=threshold)
+        assert isinstance(spammers, list)
         assert len(spammers) == n_spammers
         assert ds.cdr.where(col('caller_id').isin(spammers)).count() == 0
 
+        spammers_df = ds.remove_spammers(spammer_threshold=threshold, as_df=True)
+        assert isinstance(spammers_df, SparkDataFrame)
+        assert spammers_df.count() == n_spammers
+
     @pytest.mark.unit_test
     def test_remove_spammers_raises(self, ds: DataStore):
         ds._load_recharges()
         with pytest.raises(ValueError):
             _ = ds.remove_spammers(spammer_threshold=1)
 
+    @pytest.mark.unit_test
+    def test_profile(self, mocker: MockerFixture, ds: DataStore):
+        ds._load_cdr()
+        spy_profile = mocker.spy(cider.datastore, 'profile_dataset')
+        profile = ds.profile('cdr')
+        assert profile['statistics']['Transactions'] == 1e5
+        assert profile['statistics']['Subscribers'] == ds.cdr.select('caller_id').distinct().count()
+        assert profile['daily']['transactions'].sum() == 1e5
+
+        # The profile is reused until the dataset changes
+        assert ds.profile('cdr') is profile
+        assert spy_profile.call_count == 1
+        ds.deduplicate()
+        ds.profile('cdr')
+        assert spy_profile.call_count == 2
+
+    @pytest.mark.unit_test
+    def test_fingerprint(self, ds: DataStore, tmp_path):
+        ds.outputs = str(tmp_path) + '/'
+        os.makedirs(str(tmp_path) + '/datasets')
+        ds._load_cdr()
+        raw = ds.fingerprint('cdr')
+        assert raw is not None
+        ds.deduplicate()
+        assert ds.fingerprint('cdr') not in [None, raw]
+
+        # Spammers found on the same data are read back from disk, and the cleaned datasets get the same fingerprint
+        ds.remove_spammers(spammer_threshold=1)
+        cleaned = ds.fingerprint('cdr')
+        assert os.path.isfile(str(tmp_path) + '/datasets/spammers.fingerprint')
+        ds._load_cdr()
+        ds.deduplicate()
+        ds.remove_spammers(spammer_threshold=1)
+        assert ds.fingerprint('cdr') == cleaned
+
+        # Datasets provided as dataframes, or modified outside of the datastore, have unknown content
+        ds.cdr = ds.cdr.limit(10)
+        assert ds.fingerprint('cdr') is None
+        ds._load_cdr(dataframe=ds.cdr.toPandas())
+        assert ds.fingerprint('cdr') is None
+
     timeseries_df = pd.DataFrame(data={'day': pd.date_range(start='2020-01-01', periods=6),
                                        'count': [10, 8, 9, 12, 8, 13]})
 
@@ -451,11 +691,11 @@ class TestDatastoreClasses:
                                                          (timeseries_df, 1.4, 1),
                                                          (timeseries_df, 0.9, 4)])
     def test_filter_outlier_days(self, mocker: MockerFixture, ds: DataStore, df, num_sds, n_outliers):
-        mock_dataframe_reader = mocker.patch("cider.datastore.pd.read_csv", autospec=True)
-        mock_dataframe_reader.return_value = df
         ds._load_cdr()
+        mocker.patch.object(ds, '_transactions_by_day', return_value=df)
         outliers = ds.filter_outlier_days(num_sds=num_sds)
         assert len(outliers) == n_outliers
+        assert ds.cdr.where(col('day').isin(list(pd.to_datetime(outliers)))).count() == 0
 
     survey_df = pd.DataFrame(data={'unique_id': [str(x) for x in range(10)],
                                    'con1': [1.7, 1.8, 0.9, 1.1, 0.5, 1.5, 1.0, 1.8, None, 0.1],
@@ -555,4 +795,18 @@ class TestOptDatastoreClass:
         with pytest.raises(expected_exception):
             ds.initialize_user_consent_table(read_from_file=True)
 
-    # TODO: write opt_in/out tests
+    @pytest.mark.unit_test
+    def test_opt_in_opt_out(self, ds: OptDataStore):
+        ds.load_data(data_type_map={DataType.RECHARGES: None})
+        ds.initialize_user_consent_table()
+        n_users = ds.user_consent.count()
+        user_ids = ['WzwHpoldPp', 'xkThzuCDAY']
+
+        ds.opt_in(user_ids=user_ids)
+        assert ds.user_consent.count() == n_users
+        assert ds.recharges.where(col('caller_id').isin(user_ids)).count() == ds.recharges.count()
+
+        ds.opt_out(user_ids=user_ids[:1])
+        assert ds.user_consent.count() == n_users
+        assert ds.recharges.where(col('caller_id').isin(user_ids[:1])).count() == 0
+        assert ds.recharges.where(col('caller_id').isin(user_ids[1:])).count() == ds.recharges.count()
@@ -0,0 +1,100 @@
+from datetime import datetime
+import os
+import sys
+from typing import List
+
+import pandas as pd
+from pyspark.sql.functions import col
+import pytest
+
+# The featurizer imports the datastore as a top-level module, as when running from the cider folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cider'))
+from datastore import DataStore  # noqa: E402
+from featurizer import Featurizer  # noqa: E402
+from helpers.cache_utils import is_cached  # noqa: E402
+from helpers.features import all_spark  # noqa: E402
+from helpers.store_utils import read_manifest  # noqa: E402
+from helpers.utils import wide_join_pyspark  # noqa: E402
+
+
+class TestFeaturizer:
+    """Tests of the computation of features from the synthetic test data."""
+
+    @pytest.fixture()
+    def featurizer(self, tmp_path) -> Featurizer:
+        ds = DataStore(cfg_dir="configs/test_config.yml")
+        ds.outputs = str(tmp_path) + '/'
+        return Featurizer(datastore=ds)
+
+    @pytest.mark.unit_test
+    def test_cdr_features(self, featurizer: Featurizer) -> None:
+        featurizer.cdr_features(bc_chunksize=250, bc_processes=2)
+        feats = featurizer.features['cdr']
+        n_subscribers = featurizer.ds.cdr_bandicoot.select('name').distinct().count()
+        assert feats.count() == n_subscribers
+        assert feats.select('name').distinct().count() == n_subscribers
+        assert 'cdr_reporting__number_of_records' in feats.columns
+        assert all(c == 'name' or c.startswith('cdr_') for c in feats.columns)
+        # Users are split into partitions of at most 250 users, each written to its own file
+        users_folder = featurizer.outputs + '/datasets/bandicoot_features/users'
+        assert len(os.listdir(users_folder)) >= max(2, n_subscribers // 250)
+
+    @pytest.mark.unit_test
+    def test_cdr_features_window(self, featurizer: Featurizer) -> None:
+        featurizer.cdr_partials_spark()
+        days = sorted(row['day'] for row in featurizer.ds.cdr.select('day').distinct().collect())
+        start_date, end_date = str(days[1].date()), str(days[-2].date())
+        featurizer.cdr_features_window(start_date, end_date)
+        window = featurizer.features['cdr'].toPandas().set_index('name').sort_index()
+        # The block is written to the feature store with a fingerprint, and reused while the partials are unchanged
+        fname = featurizer.outputs + '/datasets/cdr_features_spark/' + start_date + '_' + end_date + '.parquet'
+        assert is_cached(fname, read_manifest(fname)['fingerprint'])
+
+        # Features assembled from partial aggregates match those computed from the CDR of the same days
+        cdr = featurizer.ds.cdr.where((col('day') >= pd.to_datetime(start_date)) &
+                                      (col('day') <= pd.to_datetime(end_date)))
+        expected = wide_join_pyspark(all_spark(cdr, featurizer.ds.antennas, cfg=featurizer.cfg.params.cdr),
+                                     on='caller_id', how='outer')
+        expected = expected.withColumnRenamed('caller_id', 'name').toPandas().set_index('name').sort_index()
+        columns = [c for c in window.columns if c in expected.columns and
+                   c.split('__')[0] in ['active_days', 'number_of_contacts', 'number_of_interactions']]
+        assert columns
+        pd.testing.assert_frame_equal(window[columns].fillna(0), expected[columns].fillna(0),
+                                      check_dtype=False, check_names=False)
+
+    @pytest.mark.unit_test
+    def test_cdr_partials_refresh(self, featurizer: Featurizer) -> None:
+        featurizer.cdr_partials_spark()
+        cdr = featurizer.ds.cdr
+        days = sorted(row['day'] for row in cdr.select('day').distinct().collect())
+
+        def stored_days() -> List[datetime]:
+            stored = featurizer.spark.read.parquet(featurizer.outputs + '/datasets/cdr_partials/interactions')
+            return sorted(row['day'] for row in stored.select('day').distinct().collect())
+
+        # Refreshing from the CDR of recent days keeps older days in the store
+        featurizer.ds.cdr = cdr.where(col('day') >= days[-2])
+        featurizer.cdr_partials_spark()
+        assert stored_days() == days
+        # Days that are no longer in the CDR are removed from the store, within the range of days of the CDR
+        featurizer.ds.cdr = cdr.where(col('day') != days[1])
+        featurizer.cdr_partials_spark()
+        assert stored_days() == [days[0]] + days[2:]
+        # Days whose records changed are recomputed, even if the content of the CDR is unknown, and only days from
+        # since onwards are checked
+        caller_id = cdr.where(col('day') == days[-1]).first()['caller_id']
+        featurizer.ds.cdr = cdr.where((col('day') != days[-1]) | (col('caller_id') != caller_id))
+        featurizer.cdr_partials_spark(since=str(days[-1].date()))
+        assert stored_days() == [days[0]] + days[2:]
+        stored = featurizer.spark.read.parquet(featurizer.outputs + '/datasets/cdr_partials/interactions')
+        # Each record is counted as an interaction of both parties
+        expected = 2 * featurizer.ds.cdr.where(col('day') == days[-1]).count()
+        assert stored.where(col('day') == days[-1]).groupby().sum('interactions').collect()[0][0] == expected
+
+    @pytest.mark.unit_test
+    def test_cdr_features_spark_checkpoint(self, featurizer: Featurizer) -> None:
+        featurizer.cfg.params.cdr.prepared_storage = 'parquet'
+        featurizer.cdr_features_spark()
+        assert featurizer.features['cdr'].count() > 0
+        # The checkpoint of the prepared CDR is removed once features are written
+        assert not os.path.exists(featurizer.outputs + '/datasets/cdr_prepared.parquet')
@@ -0,0 +1,247 @@
+from box import Box
+import numpy as np
+import pandas as pd
+from pyspark.sql import SparkSession
+import pyspark.sql.functions as F
+import pytest
+from scipy.stats import f_oneway, rankdata, spearmanr  # type: ignore[import]
+from sklearn.metrics import roc_auc_score  # type: ignore[import]
+import yaml
+
+from helpers.features import response_delay_text
+from helpers.features_utils import approximate_sql, MAX_SKETCH_ERROR, tag_conversations
+from helpers.sketch_utils import quantile_sketch, sketch_quantile
+from helpers.utils import bandicoot_user, get_spark_session, spark_conf, SPARK_PROFILES, wide_join_pyspark
+from helpers.weighted_utils import roc_inputs, targeted_weights, weighted_f_oneway, weighted_quantile, \
+    weighted_ranks, weighted_spearman
+
+
+@pytest.fixture(scope='module')
+def spark() -> SparkSession:
+    with open('configs/test_config.yml', 'r') as ymlfile:
+        return get_spark_session(Box(yaml.load(ymlfile, Loader=yaml.FullLoader)))
+
+
+class TestWeightedUtils:
+    """Weighted statistics should match the same statistics on data where each record is repeated 'weight' times."""
+
+    values = np.array([3., 1., 4., 1., 5., 9., 2., 6., 5., 3.])
+    other = np.array([2., 7., 1., 8., 2., 8., 1., 8., 2., 8.])
+    weights = np.array([1, 3, 2, 1, 4, 1, 2, 5, 1, 2])
+
+    def expand(self, x: np.ndarray) -> np.ndarray:
+        return np.repeat(x, self.weights)
+
+    @pytest.mark.unit_test
+    @pytest.mark.parametrize("p", [0, 10, 40.5, 75, 100])
+    def test_targeted_weights(self, p: float) -> None:
+        targeted = targeted_weights(self.values, self.weights, p)
+        # Target the bottom p% of the expanded population, ties being ranked in the order of the records
+        expanded = self.expand(self.values)
+        n_targeted = int((p/100)*len(expanded))
+        expanded_targeted = np.zeros(len(expanded))
+        expanded_targeted[np.argsort(expanded, kind='mergesort')[:n_targeted]] = 1
+        record = np.repeat(np.arange(len(self.values)), self.weights)
+        assert np.allclose(targeted, np.bincount(record, weights=expanded_targeted, minlength=len(self.values)))
+
+    @pytest.mark.unit_test
+    @pytest.mark.parametrize("q", [0, .1, .25, .5, .77, 1])
+    def test_weighted_quantile(self, q: float) -> None:
+        expected = np.percentile(self.expand(self.values), 100*q)
+        assert np.isclose(weighted_quantile(self.values, self.weights, q), expected)
+
+    @pytest.mark.unit_test
+    def test_weighted_ranks(self) -> None:
+        expanded_ranks = rankdata(self.expand(self.values))
+        first_repetition = np.cumsum(self.weights) - self.weights
+        assert np.allclose(weighted_ranks(self.values, self.weights), expanded_ranks[first_repetition])
+
+    @pytest.mark.unit_test
+    def test_weighted_spearman(self) -> None:
+        expected = spearmanr(self.expand(self.values), self.expand(self.other))[0]
+        assert np.isclose(weighted_spearman(self.values, self.other, self.weights), expected)
+
+    @pytest.mark.unit_test
+    def test_weighted_f_oneway(self) -> None:
+        groups = [self.values[:3], self.values[3:7], self.values[7:]]
+        group_weights = [self.weights[:3], self.weights[3:7], self.weights[7:]]
+        f_stat, p_value = weighted_f_oneway(list(zip(groups, group_weights)))
+        expected = f_oneway(*[np.repeat(x, w) for x, w in zip(groups, group_weights)])
+        assert np.isclose(f_stat, expected[0])
+        assert np.isclose(p_value, expected[1])
+
+    @pytest.mark.unit_test
+    def test_roc_inputs(self) -> None:
+        targeted = targeted_weights(self.values, self.weights, 40.5)
+        labels, scores, sample_weights = roc_inputs(targeted, self.other, self.weights)
+        auc = roc_auc_score(labels, scores, sample_weight=sample_weights)
+
+        expanded = self.expand(self.values)
+        expanded_labels = np.zeros(len(expanded))
+        expanded_labels[np.argsort(expanded, kind='mergesort')[:int(.405*len(expanded))]] = 1
+        assert np.isclose(auc, roc_auc_score(expanded_labels, self.expand(self.other)))
+
+
+class TestSparkConf:
+    """Spark settings are built from the defaults of the profile, overridden by the settings given explicitly."""
+
+    @pytest.mark.unit_test
+    @pytest.mark.parametrize("profile", list(SPARK_PROFILES))
+    def test_profile_defaults(self, profile: str) -> None:
+        conf = spark_conf(Box({'spark': {'profile': profile}}))
+        for key, value in SPARK_PROFILES[profile].items():
+            assert conf[key] == (str(value).lower() if isinstance(value, bool) else str(value))
+        assert conf['spark.sql.execution.arrow.pyspark.fallback.enabled'] == 'true'
+
+    @pytest.mark.unit_test
+    def test_no_profile(self) -> None:
+        conf = spark_conf(Box({'spark': {'driver': {'memory': '2g'}}}))
+        assert conf == {'spark.sql.execution.arrow.pyspark.enabled': 'true',
+                        'spark.driver.memory': '2g',
+                        'spark.sql.execution.arrow.pyspark.fallback.enabled': 'true'}
+
+    @pytest.mark.unit_test
+    def test_overrides(self) -> None:
+        conf = spark_conf(Box({'spark': {'profile': 'cluster',
+                                         'driver': {'memory': '64g'},
+                                         'sql': {'shuffle_partitions': 100, 'adaptive': {'skew_join': False},
+                                                 'arrow': False},
+                                         'serializer': 'java',
+                                         'local_dir': '/tmp/spark'}}))
+        assert conf['spark.driver.memory'] == '64g'
+        assert conf['spark.sql.shuffle.partitions'] == '100'
+        assert conf['spark.sql.adaptive.skewJoin.enabled'] == 'false'
+        assert conf['spark.sql.execution.arrow.pyspark.enabled'] == 'false'
+        assert conf['spark.serializer'] == 'org.apache.spark.serializer.JavaSerializer'
+        assert conf['spark.local.dir'] == '/tmp/spark'
+        # Settings that are not given explicitly keep the defaults of the profile
+        assert conf['spark.executor.memory'] == SPARK_PROFILES['cluster']['spark.executor.memory']
+        assert conf['spark.sql.adaptive.enabled'] == 'true'
+
+    @pytest.mark.unit_test
+    @pytest.mark.parametrize("spark_cfg", [{'profile': 'supercomputer'}, {'serializer': 'pickle'},
+                                           {'profile': 'laptop', 'serializer': 'pickle'}])
+    def test_raises(self, spark_cfg: dict) -> None:
+        with pytest.raises(ValueError):
+            spark_conf(Box({'spark': spark_cfg}))
+
+
+class TestSketches:
+    """Sketch-based approximations should be within their relative error of exact results."""
+
+    @pytest.mark.unit_test
+    def test_approximate_sql(self) -> None:
+        assert approximate_sql('count(DISTINCT day)') == 'count(DISTINCT day)'
+        assert approximate_sql('count(DISTINCT day)', 0.1) == 'approx_count_distinct(day, 0.1)'
+        assert approximate_sql('percentile_approx(`duration`, 0.5)', 0.1) == 'percentile_approx(`duration`, 0.5, 10)'
+        assert approximate_sql('sum(interactions)', 0.1) == 'sum(interactions)'
+
+    @pytest.mark.unit_test
+    @pytest.mark.parametrize("sketch_error", [0, MAX_SKETCH_ERROR, 0.5, 1])
+    def test_approximate_sql_raises(self, sketch_error: float) -> None:
+        with pytest.raises(ValueError):
+            approximate_sql('count(DISTINCT day)', sketch_error)
+
+    @pytest.mark.unit_test
+    def test_approx_count_distinct(self, spark: SparkSession) -> None:
+        df = spark.createDataFrame(pd.DataFrame({'caller_id': ['A'] * 500 + ['B'] * 30,
+                                                 'recipient_id': list(range(250)) * 2 + list(range(30))}))
+        counts = (df.groupby('caller_id').agg(F.expr(approximate_sql('count(DISTINCT recipient_id)', 0.05)).alias('n'))
+                  .toPandas().set_index('caller_id')['n'])
+        # Allow for three standard deviations
+        assert abs(counts['A'] - 250) <= 3 * 0.05 * 250
+        assert abs(counts['B'] - 30) <= 3 * 0.05 * 30
+
+    @pytest.mark.unit_test
+    @pytest.mark.parametrize("accuracy", [0.01, 0.05])
+    def test_sketch_quantile(self, spark: SparkSession, accuracy: float) -> None:
+        rng = np.random.default_rng(0)
+        durations = {'A': rng.lognormal(4, 1, 1000), 'B': np.array([0., 0., 0., 5., 10.])}
+        callers = np.repeat(list(durations), [len(d) for d in durations.values()])
+        df = spark.createDataFrame(pd.DataFrame({'caller_id': callers,
+                                                 'duration': np.concatenate(list(durations.values()))}))
+        sketches = quantile_sketch(df, ['caller_id'], 'duration', accuracy, 'sketch')
+        for q in [0, 0.1, 0.5, 0.9, 1]:
+            estimates = (sketches.select('caller_id', sketch_quantile('sketch', q, accuracy).alias('q'))
+                         .toPandas().set_index('caller_id')['q'])
+            for caller_id, values in durations.items():
+                exact = np.sort(values)[int(np.floor(q * (len(values) - 1)))]
+                assert abs(estimates[caller_id] - exact) <= accuracy * exact + 1e-9
+
+    @pytest.mark.unit_test
+    def test_merge_quantile_sketches(self, spark: SparkSession) -> None:
+        rng = np.random.default_rng(1)
+        df = spark.createDataFrame(pd.DataFrame({'caller_id': ['A'] * 200, 'day': [1, 2] * 100,
+                                                 'duration': rng.exponential(60, 200)}))
+        whole = quantile_sketch(df, ['caller_id'], 'duration', 0.01, 'sketch').collect()[0]['sketch']
+        # Sketches of each day merge into the sketch of all days by adding up the counts of each bucket
+        merged = (quantile_sketch(df, ['caller_id', 'day'], 'duration', 0.01, 'sketch')
+                  .select(F.explode('sketch').alias('bucket', 'n'))
+                  .groupby('bucket').agg(F.sum('n').alias('n'))
+                  .toPandas())
+        assert dict(zip(merged['bucket'], merged['n'])) == whole
+
+
+class TestFeatures:
+    """Spark features on small hand-made interactions, with known values."""
+
+    @pytest.mark.unit_test
+    def test_response_delay_text(self, spark: SparkSession) -> None:
+        # A replies to B's texts after 60 and 300 seconds, on a weekday during the day
+        df = pd.DataFrame({'caller_id': ['A'] * 4, 'recipient_id': ['B'] * 4, 'txn_type': ['text'] * 4,
+                           'timestamp': pd.to_datetime(['2020-01-06 12:00:00', '2020-01-06 12:01:00',
+                                                        '2020-01-06 12:01:40', '2020-01-06 12:06:40']),
+                           'direction': ['in', 'out', 'in', 'out'], 'weekday': ['weekday'] * 4,
+                           'daytime': ['day'] * 4})
+        out = response_delay_text(tag_conversations(spark.createDataFrame(df))).toPandas().set_index('caller_id')
+        # Delays are computed on the interactions themselves, then summarized for each category and for all of them
+        for category in ['weekday_day', 'allweek_allday', 'weekday_allday', 'allweek_day']:
+            assert out.loc['A', f'response_delay_text_{category}_mean'] == 180
+            assert out.loc['A', f'response_delay_text_{category}_min'] == 60
+            assert out.loc['A', f'response_delay_text_{category}_max'] == 300
+
+
+class TestBandicootUser:
+    """Bandicoot users are built from records in bandicoot format, skipping records that cannot be parsed."""
+
+    @pytest.mark.unit_test
+    def test_bandicoot_user(self, spark: SparkSession) -> None:
+        record = {'interaction': 'call', 'direction': 'out', 'correspondent_id': 'B',
+                  'datetime': '2020-01-01 12:00:00', 'call_duration': '60', 'antenna_id': 'a1',
+                  'latitude': '10.0', 'longitude': '20.0'}
+        records = [record,
+                   dict(record, interaction='text', datetime='2020-01-02 13:00:00', call_duration=''),
+                   dict(record, datetime='not a date'),
+                   dict(record, call_duration='1.5')]
+        skipped = spark.sparkContext.accumulator(0)
+        user = bandicoot_user('A', records, skipped)
+        assert len(user.records) == 2
+        assert skipped.value == 2
+
+
+class TestWideJoin:
+    """Joining feature blocks should match a chain of pandas merges, keeping the keys required by the type of join."""
+
+    blocks = [pd.DataFrame({'name': ['a', 'b', 'c'], 'x': [1., 2., None]}),
+              pd.DataFrame({'name': ['b', 'c', 'd'], 'y': [20., 30., 40.]}),
+              pd.DataFrame({'name': ['c', 'b', 'e'], 'z': ['3', '2', '5']})]
+
+    @pytest.mark.unit_test
+    @pytest.mark.parametrize("how", ['outer', 'left', 'inner'])
+    def test_wide_join(self, spark: SparkSession, how: str) -> None:
+        dfs = [spark.createDataFrame(block) for block in self.blocks]
+        joined = wide_join_pyspark(dfs, on='name', how=how).toPandas()
+        expected = self.blocks[0]
+        for block in self.blocks[1:]:
+            expected = expected.merge(block, on='name', how=how)
+        assert list(joined.columns) == ['name', 'x', 'y', 'z']
+        pd.testing.assert_frame_equal(joined.sort_values('name').reset_index(drop=True),
+                                      expected.sort_values('name').reset_index(drop=True))
+
+    @pytest.mark.unit_test
+    def test_wide_join_raises(self, spark: SparkSession) -> None:
+        dfs = [spark.createDataFrame(block) for block in self.blocks] + [spark.createDataFrame(self.blocks[1])]
+        with pytest.raises(ValueError):
+            wide_join_pyspark(dfs, on='name', how='outer')
+        with pytest.raises(ValueError):
+            wide_join_pyspark(dfs[:2], on='name', how='right')